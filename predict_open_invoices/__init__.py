@@ -1,4 +1,27 @@
+import os
 ID_COLUMNS = ["id", "company_id", "invoice_id", "account_id", "customer_id"]
 DATA_FOLDER = '../data_analysis/data'
+CACHE_FOLDER = DATA_FOLDER + '/cache'
+STAGE_CACHE_FOLDER = CACHE_FOLDER + '/stages'
+STAGE_CACHE_MAX_BYTES = 2 * 2 ** 30
+MODEL_REGISTRY_FOLDER = CACHE_FOLDER + '/models'
+REFRESH_STORE = CACHE_FOLDER + '/refresh_state.sqlite'
+STUDY_STORAGE = 'sqlite:///' + CACHE_FOLDER + '/optuna.sqlite'
+STUDY_NAME = 'csv-data-automl'
+# profile pipeline stages and filter rules, see profiling.py
+PROFILING = os.getenv('PIPELINE_PROFILING', '0') == '1'
+# synthetic data, results and the baseline of pipeline benchmarks
+BENCHMARK_FOLDER = CACHE_FOLDER + '/benchmarks'
+# experiment tracking journal and local backend, and the backend records are applied to: neptune or local
+TRACKING_FOLDER = CACHE_FOLDER + '/tracking'
+TRACKING_BACKEND = os.getenv('TRACKING_BACKEND', 'neptune')
+# address of the local scoring service, see scoring_service.py
+SCORING_HOST = os.getenv('SCORING_HOST', '127.0.0.1')
+SCORING_PORT = int(os.getenv('SCORING_PORT', 8765))
+# loaded H2O models kept per process
+MODEL_CACHE_SIZE = 4
 NEPTUNE_PROJECT_NAME = "open-invoices-model"
-NEPTUNE_MODEL_ID = "CSVDATA"
\ No newline at end of file
+NEPTUNE_MODEL_ID = "CSVDATA"
+# H2O cluster settings, started on first use: all cores and 12 GB unless overridden by the environment
+H2O_NTHREADS = int(os.getenv('H2O_NTHREADS', -1))
+H2O_MAX_MEM_SIZE = os.getenv('H2O_MAX_MEM_SIZE', '12G')
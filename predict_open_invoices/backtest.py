@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import h2o
+import pandas
+from predict_open_invoices.dates import month_index, month_start
+from predict_open_invoices.utils import get_h2o_frame
+from predict_open_invoices.training import get_training_frame_from_csvs, train_model
+from predict_open_invoices.evaluation_on_csv_data import get_monthly_forecast_errors
+
+
+def backtest_windows(forecast_months: numpy.ndarray, n_origins: int, test_months: int = 1,
+                     train_months: int = None) -> pandas.DataFrame:
+    """Rolling forecast origins over month indexes of forecast dates: the last n_origins periods of test_months each.
+    Each window trains on all months before its origin (expanding) or on the train_months before it (sliding).
+    Month bounds are inclusive starts and exclusive ends."""
+    first_month, end_month = forecast_months.min(), forecast_months.max() + 1
+    origins = end_month - test_months * numpy.arange(n_origins, 0, -1)
+    train_starts = numpy.full(n_origins, first_month) if train_months is None else \
+        numpy.maximum(origins - train_months, first_month)
+    assert (origins > train_starts).all(), 'Not enough forecast months before the first origin'
+    return pandas.DataFrame({'train_start': train_starts, 'origin': origins, 'test_end': origins + test_months})
+
+
+def _backtest_window(window: pandas.Series, training_data: pandas.DataFrame, forecast_months: numpy.ndarray,
+                     training_h2o: h2o.H2OFrame, params: dict) -> OrderedDict:
+    """Train on one window's slice of the uploaded training data and score the month(s) after its origin."""
+    train = training_h2o[(training_h2o['forecast_month'] >= int(window.train_start))
+                         & (training_h2o['forecast_month'] < int(window.origin))]
+    test = training_h2o[(training_h2o['forecast_month'] >= int(window.origin))
+                        & (training_h2o['forecast_month'] < int(window.test_end))]
+    test_df = training_data[(forecast_months >= window.origin) & (forecast_months < window.test_end)]
+    h2o_model = train_model(train, test, **params)
+    monthly_mape = get_monthly_forecast_errors(OrderedDict([('test', test_df)]), h2o_model)['test']
+    return OrderedDict([('origin', window.origin),
+                        ('train_rows', train.nrow), ('test_rows', test.nrow), ('algo', h2o_model.algo),
+                        (params['metric'], h2o_model.model_performance(test)[params['metric']]),
+                        ('monthly_mape', monthly_mape)])
+
+
+def run_backtest(training_data: pandas.DataFrame, windows: pandas.DataFrame, params: dict,
+                 n_jobs: int = 1) -> pandas.DataFrame:
+    """Train and score a model per backtest window, n_jobs windows at a time in the H2O cluster. The training data
+    is uploaded once and sliced per window by forecast month. Returns the test metric and the company-weighted monthly
+    MAPE per origin."""
+    forecast_months = month_index(training_data.forecast_date).to_numpy(dtype=numpy.int64)
+    training_h2o = get_h2o_frame(training_data.assign(forecast_month=forecast_months))
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(lambda window: _backtest_window(window, training_data, forecast_months,
+                                                                    training_h2o, params),
+                                    [window for _, window in windows.iterrows()]))
+    results = pandas.DataFrame(results)
+    results['origin'] = month_start(results.origin)
+    return results.set_index('origin')
+
+
+def _test_backtest_on_csvs(n_origins: int = 6, train_months: int = None) -> pandas.DataFrame:
+    """Backtest the baseline model over the last months of forecast dates in the local CSV data."""
+    training_data, _ = get_training_frame_from_csvs()
+    windows = backtest_windows(month_index(training_data.forecast_date).to_numpy(dtype=numpy.int64), n_origins,
+                               train_months=train_months)
+    params = dict(metric='mae', y='collected_per_month', distribution='huber', predictors=['due_per_month'],
+                  max_runtime_secs=60)
+    return run_backtest(training_data, windows, params, n_jobs=3)
+
+
+if __name__ == "__main__":
+    pandas.set_option('expand_frame_repr', False)
+    print(_test_backtest_on_csvs())
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import shutil
+import functools
+import platform
+import tracemalloc
+from datetime import datetime
+from collections import OrderedDict
+import numpy
+import pandas
+try:
+    import numba
+except ImportError:
+    numba = None
+from predict_open_invoices import BENCHMARK_FOLDER
+from predict_open_invoices.csv_test_data_io import get_csv_test_data
+from predict_open_invoices.pre_processing import preprocess_invoices_with_payments
+from predict_open_invoices.feature_engineering import feature_engineering
+from predict_open_invoices.training import _post_process_invoice_outcomes, _get_h2o_training_data, train_model
+from predict_open_invoices.synthetic_data import write_synthetic_csvs
+# multiples of the CSV test data size to benchmark
+BENCHMARK_SCALES = [10, 100, 1000]
+BASELINE_PATH = BENCHMARK_FOLDER + '/baseline.json'
+# slowdowns and memory growth beyond these ratios to the baseline are regressions, unless the slowdown is below
+# the noise of timing a single run
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.25
+MIN_SLOWDOWN_SECS = 0.1
+
+
+def _measure(stage_function, *args, repeats: int = 1, profile_memory: bool = True) -> (object, OrderedDict):
+    """Time the fastest of repeated runs of a stage, then run it again under tracemalloc for the peak memory allocated
+    in Python and numpy. Memory allocated by pyarrow or the H2O cluster is not traced."""
+    seconds = numpy.inf
+    for _ in range(repeats):
+        timer = time.perf_counter()
+        output = stage_function(*args)
+        seconds = min(seconds, time.perf_counter() - timer)
+    peak_mb = None
+    if profile_memory:
+        tracemalloc.start()
+        stage_function(*args)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    first_output = output[0] if isinstance(output, tuple) else output
+    rows = first_output.__len__() if isinstance(first_output, (pandas.DataFrame, pandas.Series)) else None
+    return output, OrderedDict([('rows', rows), ('seconds', seconds), ('peak_mb', peak_mb)])
+
+
+def _read_uncached(data_folder: str) -> (pandas.DataFrame, pandas.DataFrame):
+    """Read the CSVs of a data folder after removing their columnar cache, so that they are parsed again."""
+    shutil.rmtree(f'{data_folder}/cache', ignore_errors=True)
+    return get_csv_test_data(data_folder=data_folder)
+
+
+def _benchmark_scale(scale: float, seed: int, include_h2o: bool, repeats: int, profile_memory: bool) \
+        -> list[OrderedDict]:
+    """Benchmark each pipeline stage on synthetic data of one scale, each stage taking the output of the previous."""
+    data_folder = write_synthetic_csvs(f'{BENCHMARK_FOLDER}/data/scale-{scale:g}-seed-{seed}', scale, seed)
+    measure = functools.partial(_measure, repeats=repeats, profile_memory=profile_memory)
+    measurements = OrderedDict()
+    _, measurements['get_csv_test_data (parse)'] = measure(_read_uncached, data_folder)
+    (invoices, payments), measurements['get_csv_test_data'] = measure(
+        lambda: get_csv_test_data(data_folder=data_folder))
+    (invoices_with_payments, _), measurements['preprocess_invoices_with_payments'] = measure(
+        preprocess_invoices_with_payments, invoices, payments)
+    (invoices_to_model, _), measurements['_post_process_invoice_outcomes'] = measure(
+        _post_process_invoice_outcomes, invoices_with_payments)
+    feature_data, measurements['feature_engineering'] = measure(feature_engineering, invoices_to_model)
+    if include_h2o:
+        import h2o
+        from predict_open_invoices.prediction import predict
+        # frames already in the cluster would be reused instead of uploaded, so H2O stages are timed once
+        h2o.remove_all()
+        h2o_frames, measurements['_get_h2o_training_data'] = _measure(_get_h2o_training_data, feature_data,
+                                                                      profile_memory=False)
+        measurements['_get_h2o_training_data']['rows'] = sum(frame.nrow for frame in h2o_frames.values())
+        model = train_model(h2o_frames['train'], h2o_frames['test'], max_runtime_secs=30)
+        _, measurements['predict'] = _measure(predict, feature_data, model, profile_memory=False)
+    return [OrderedDict([('scale', scale), ('stage', stage)], **measurement)
+            for stage, measurement in measurements.items()]
+
+
+def _environment() -> OrderedDict:
+    return OrderedDict([('python', platform.python_version()), ('platform', platform.platform()),
+                        ('cpus', os.cpu_count()), ('numpy', numpy.__version__), ('pandas', pandas.__version__),
+                        ('numba', numba.__version__ if numba is not None else None)])
+
+
+def run_benchmarks(scales: list[float] = BENCHMARK_SCALES, seed: int = 0, include_h2o: bool = True, repeats: int = 3,
+                   profile_memory: bool = True, results_folder: str = BENCHMARK_FOLDER) -> (pandas.DataFrame, str):
+    """Time and memory-profile the pipeline stages on synthetic data at each scale of the CSV test data, and store the
+    results as JSON in the results folder. Synthetic data is generated once per scale and seed. The H2O stages need a
+    cluster dedicated to the benchmark, since its frames are removed. Returns the results and the path of the JSON."""
+    created = datetime.now()
+    records = [record for scale in scales
+               for record in _benchmark_scale(scale, seed, include_h2o, repeats, profile_memory)]
+    os.makedirs(results_folder, exist_ok=True)
+    results_path = f"{results_folder}/results-{created:%Y%m%dT%H%M%S}.json"
+    with open(results_path, 'w') as results_file:
+        json.dump(OrderedDict([('created', created.isoformat()), ('seed', seed), ('environment', _environment()),
+                               ('results', records)]), results_file, indent=2)
+    return load_results(results_path), results_path
+
+
+def load_results(results_path: str) -> pandas.DataFrame:
+    with open(results_path) as results_file:
+        return pandas.DataFrame(json.load(results_file)['results']).set_index(['scale', 'stage'])
+
+
+def save_baseline(results_path: str, baseline_path: str = BASELINE_PATH):
+    """Make stored benchmark results the baseline that later results are compared to."""
+    shutil.copyfile(results_path, baseline_path)
+
+
+def compare_to_baseline(results: pandas.DataFrame, baseline_path: str = BASELINE_PATH,
+                        time_tolerance: float = TIME_TOLERANCE, memory_tolerance: float = MEMORY_TOLERANCE,
+                        min_slowdown_secs: float = MIN_SLOWDOWN_SECS) -> pandas.DataFrame:
+    """Ratios of results to the baseline per scale and stage present in both, flagging time and memory
+    regressions."""
+    comparison = results.join(load_results(baseline_path), rsuffix='_baseline', how='inner')
+    comparison['time_ratio'] = comparison.seconds / comparison.seconds_baseline
+    comparison['memory_ratio'] = comparison.peak_mb.astype(float) / comparison.peak_mb_baseline.astype(float)
+    comparison['time_regression'] = (comparison.time_ratio > 1 + time_tolerance) \
+        & (comparison.seconds - comparison.seconds_baseline > min_slowdown_secs)
+    comparison['memory_regression'] = comparison.memory_ratio > 1 + memory_tolerance
+    return comparison[['rows', 'seconds', 'seconds_baseline', 'time_ratio', 'time_regression',
+                       'peak_mb', 'peak_mb_baseline', 'memory_ratio', 'memory_regression']]
+
+
+def _test_benchmarks(scales: list[float] = [0.1], include_h2o: bool = False) -> pandas.DataFrame:
+    """Benchmark small scales, comparing to the baseline if there is one and otherwise making them the baseline."""
+    results, results_path = run_benchmarks(scales, include_h2o=include_h2o)
+    if not os.path.exists(BASELINE_PATH):
+        save_baseline(results_path)
+        return results
+    comparison = compare_to_baseline(results)
+    regressions = comparison[comparison.time_regression | comparison.memory_regression]
+    assert regressions.__len__() == 0, f'Regressions against the baseline:\n{regressions}'
+    return comparison
+
+
+if __name__ == "__main__":
+    pandas.set_option('expand_frame_repr', False)
+    print(_test_benchmarks([float(scale) for scale in sys.argv[1:]] or [10], include_h2o=True))
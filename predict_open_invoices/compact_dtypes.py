@@ -0,0 +1,52 @@
+import numpy
+import pandas
+from collections import OrderedDict
+from predict_open_invoices import ID_COLUMNS
+CATEGORICAL_COLUMNS = ['currency', 'status']
+# ID columns that refer to the same entity share one dictionary of codes, so they can be joined on codes
+ID_DICTIONARIES = {'id': 'invoice_id', 'invoice_id': 'invoice_id', 'company_id': 'company_id',
+                   'account_id': 'account_id', 'customer_id': 'customer_id'}
+
+
+def _downcast_floats(df: pandas.DataFrame):
+    """Store float columns as float32 where every value survives the round trip exactly."""
+    for col in df.select_dtypes(include='float64').columns:
+        downcast = df[col].astype(numpy.float32)
+        if (downcast.astype(numpy.float64) == df[col]).sum() == df[col].count():
+            df[col] = downcast
+
+
+def compact_dtypes(*frames: pandas.DataFrame) -> list[pandas.DataFrame]:
+    """Dictionary-encode ID columns, across all frames, as categoricals with sorted string categories, so that codes
+    sort, join and group like the original strings and map back to them. Currency and status become categoricals and
+    exact float columns become float32."""
+    frames = [df.copy() for df in frames]
+    dictionaries = OrderedDict()
+    for df in frames:
+        for col in [col for col in ID_COLUMNS if col in df.columns]:
+            dictionaries.setdefault(ID_DICTIONARIES[col], []).append(df[col].dropna().unique())
+    for dictionary, values in dictionaries.items():
+        dictionaries[dictionary] = pandas.CategoricalDtype(numpy.unique(numpy.concatenate(values)))
+    for df in frames:
+        for col in [col for col in ID_COLUMNS if col in df.columns]:
+            df[col] = df[col].astype(dictionaries[ID_DICTIONARIES[col]])
+        for col in [col for col in CATEGORICAL_COLUMNS if col in df.columns]:
+            df[col] = df[col].astype('category')
+        _downcast_floats(df)
+    return frames
+
+
+def restore_ids(df: pandas.DataFrame) -> pandas.DataFrame:
+    """Map dictionary-encoded ID columns back to strings, e.g. before upload to H2O or output of predictions."""
+    encoded = [col for col in df.columns if col in ID_COLUMNS and isinstance(df[col].dtype, pandas.CategoricalDtype)]
+    if len(encoded) == 0:
+        return df
+    return df.assign(**{col: df[col].astype(object) for col in encoded})
+
+
+def memory_report(stages: OrderedDict) -> pandas.DataFrame:
+    """Summarize rows and memory (MB, including Python string objects) of the data frame output at each stage."""
+    report = pandas.DataFrame(columns=['Rows', 'Memory (MB)'])
+    for stage, df in stages.items():
+        report.loc[stage] = [df.__len__(), df.memory_usage(deep=True).sum() / 2 ** 20]
+    return report.astype({'Rows': int})
@@ -1,19 +1,99 @@
+import os
+import json
+import hashlib
+from collections.abc import Iterator
 import pandas
-from predict_open_invoices import ID_COLUMNS, DATA_FOLDER
+import pyarrow.feather
+from predict_open_invoices import ID_COLUMNS, DATA_FOLDER, CACHE_FOLDER
+from predict_open_invoices.compact_dtypes import compact_dtypes
+from predict_open_invoices.profiling import profiled_stage
 # truncate datetimes to dates
 DATE_FORMAT = '%Y-%m-%d'
 ID_COLUMN_TYPES = dict(zip(ID_COLUMNS, [str] * len(ID_COLUMNS)))
+CSV_DATE_COLUMNS = {'invoice.csv': ['invoice_date', 'due_date', 'cleared_date'],
+                    'invoice_payments.csv': ['transaction_date']}
 
 
-def get_csv_test_data() -> (pandas.DataFrame, pandas.DataFrame):
-    """Get local CSV data as properly formatted pandas dataframes"""
-    invoices = pandas.read_csv(DATA_FOLDER + '/invoice.csv', na_values='inf', dtype=ID_COLUMN_TYPES,
-                               parse_dates=['invoice_date', 'due_date', 'cleared_date'], date_format=DATE_FORMAT)
-    assert invoices.__len__() == 113085, "Rows in invoices test CSV have been modified. Future checks will not be valid"
-    assert invoices.cleared_date.isnull().sum() == 0, "Columns in invoices test CSV have been modified"
-    payments = pandas.read_csv(DATA_FOLDER + '/invoice_payments.csv', na_values='inf', dtype=ID_COLUMN_TYPES,
-                               parse_dates=['transaction_date'], date_format=DATE_FORMAT)
-    assert payments.__len__() == 111623, "Rows in payments test CSV have been modified. Future checks will not be valid"
+def _fingerprint(csv_path: str) -> str:
+    """Identify the version of a source file by its size, modification time and content hash."""
+    stat = os.stat(csv_path)
+    content_hash = hashlib.sha256()
+    with open(csv_path, 'rb') as csv_file:
+        for block in iter(lambda: csv_file.read(1 << 20), b''):
+            content_hash.update(block)
+    return hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}:{content_hash.hexdigest()}".encode()).hexdigest()[:16]
+
+
+def _write_cache(csv_path: str, cache_path: str, metadata_path: str) -> dict:
+    """Parse a CSV file once and store it as an uncompressed Feather (Arrow IPC) file with typed dates and IDs, along
+    with the row and null counts needed to validate it later without a rescan."""
+    df = pandas.read_csv(csv_path, na_values='inf', dtype=ID_COLUMN_TYPES,
+                         parse_dates=CSV_DATE_COLUMNS[os.path.basename(csv_path)], date_format=DATE_FORMAT)
+    metadata = {'rows': df.__len__(), 'null_counts': df.isnull().sum().astype(int).to_dict()}
+    # remove caches of previous versions of the source file
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    cache_folder = os.path.dirname(cache_path)
+    for file_name in os.listdir(cache_folder):
+        if file_name.startswith(stem + '-'):
+            os.remove(os.path.join(cache_folder, file_name))
+    # uncompressed so that reads can be memory-mapped; write to temp paths so partial files are never read
+    pyarrow.feather.write_feather(df, cache_path + '.tmp', compression='uncompressed')
+    os.replace(cache_path + '.tmp', cache_path)
+    with open(metadata_path + '.tmp', 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(metadata_path + '.tmp', metadata_path)
+    return metadata
+
+
+def read_csv_cached(file_name: str, columns: list[str] = None, use_cache: bool = True,
+                    data_folder: str = DATA_FOLDER) -> (pandas.DataFrame, dict):
+    """Read a CSV from the data folder through a columnar cache keyed by the source file's fingerprint. Returns the
+    requested columns and the cached metadata (row count and null counts per column). The cache is kept in the cache
+    folder of the data folder."""
+    csv_path = f'{data_folder}/{file_name}'
+    cache_folder = CACHE_FOLDER if data_folder == DATA_FOLDER else f'{data_folder}/cache'
+    if not use_cache:
+        df = pandas.read_csv(csv_path, na_values='inf', dtype=ID_COLUMN_TYPES,
+                             parse_dates=CSV_DATE_COLUMNS[file_name], date_format=DATE_FORMAT)
+        metadata = {'rows': df.__len__(), 'null_counts': df.isnull().sum().astype(int).to_dict()}
+        return df[columns] if columns else df, metadata
+    os.makedirs(cache_folder, exist_ok=True)
+    cache_path = f'{cache_folder}/{os.path.splitext(file_name)[0]}-{_fingerprint(csv_path)}.feather'
+    metadata_path = cache_path.replace('.feather', '.json')
+    if os.path.exists(cache_path) and os.path.exists(metadata_path):
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+    else:
+        metadata = _write_cache(csv_path, cache_path, metadata_path)
+    df = pyarrow.feather.read_table(cache_path, columns=columns, memory_map=True).to_pandas()
+    return df, metadata
+
+
+def read_csv_chunks(file_name: str, chunk_rows: int = 1_000_000) -> Iterator[pandas.DataFrame]:
+    """Read a CSV from the data folder in chunks of rows, typed like the full read, for files that do not fit in
+    memory."""
+    yield from pandas.read_csv(f'{DATA_FOLDER}/{file_name}', na_values='inf', dtype=ID_COLUMN_TYPES,
+                               parse_dates=CSV_DATE_COLUMNS[file_name], date_format=DATE_FORMAT, chunksize=chunk_rows)
+
+
+@profiled_stage
+def get_csv_test_data(invoice_columns: list[str] = None, payment_columns: list[str] = None,
+                      use_cache: bool = True, compact: bool = False, data_folder: str = DATA_FOLDER) \
+        -> (pandas.DataFrame, pandas.DataFrame):
+    """Get local CSV data as properly formatted pandas dataframes, optionally limited to the columns a stage needs
+    and with compact dtypes (dictionary-encoded IDs, categorical currencies and statuses). The row counts of the test
+    CSVs are only checked in the default data folder, so that other folders can hold data of the same schema, such as
+    synthetic data."""
+    invoices, invoices_metadata = read_csv_cached('invoice.csv', invoice_columns, use_cache, data_folder)
+    payments, payments_metadata = read_csv_cached('invoice_payments.csv', payment_columns, use_cache, data_folder)
+    if data_folder == DATA_FOLDER:
+        assert invoices_metadata['rows'] == 113085, \
+            "Rows in invoices test CSV have been modified. Future checks will not be valid"
+        assert invoices_metadata['null_counts']['cleared_date'] == 0, "Columns in invoices test CSV have been modified"
+        assert payments_metadata['rows'] == 111623, \
+            "Rows in payments test CSV have been modified. Future checks will not be valid"
+    if compact:
+        invoices, payments = compact_dtypes(invoices, payments)
     return invoices, payments
 
 
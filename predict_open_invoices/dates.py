@@ -0,0 +1,53 @@
+import time
+import numpy
+import pandas
+
+
+def month_index(dates: pandas.Series) -> pandas.Series:
+    """Convert dates to a compact nullable int32 count of months since 1970-01, missing where the date is NaT."""
+    months = dates.values.astype('datetime64[M]').astype(numpy.int64).astype(numpy.int32)
+    return pandas.Series(pandas.arrays.IntegerArray(months, dates.isnull().values), index=dates.index)
+
+
+def month_start(months: pandas.Series) -> pandas.Series:
+    """Convert month indexes back to timestamps at the start of each month."""
+    dates = months.to_numpy(dtype=numpy.int64, na_value=0).astype('datetime64[M]').astype('datetime64[ns]')
+    return pandas.Series(dates, index=months.index).where(months.notna())
+
+
+def months_between(start: pandas.Series, end: pandas.Series) -> pandas.Series:
+    """ Calculate number of months between two date or month index columns in a pandas Dataframe """
+    start = start if pandas.api.types.is_integer_dtype(start) else month_index(start)
+    end = end if pandas.api.types.is_integer_dtype(end) else month_index(end)
+    months = end - start
+    # integers if no dates are missing, otherwise floats with NaN where either date is missing
+    return months.astype('float64') if months.hasnans else months.astype('int64')
+
+
+def _months_between_periods(start: pandas.Series, end: pandas.Series) -> pandas.Series:
+    """Previous implementation of months_between, kept as the benchmark reference."""
+    months = (end.dt.to_period('M') - start.dt.to_period('M'))
+    return months.map(lambda m: m.n if not pandas.isnull(m) else None)
+
+
+def _benchmark_months_between(row_counts: list[int] = [1_000_000, 10_000_000], seed: int = 0) -> pandas.DataFrame:
+    """Time months_between against the per-element Period implementation on random dates with 1% missing."""
+    rng = numpy.random.default_rng(seed)
+    results = pandas.DataFrame(columns=['Rows', 'Periods (s)', 'Month index (s)', 'Speedup'])
+    for rows in row_counts:
+        start = pandas.Series(pandas.Timestamp('2011-01-01') + pandas.to_timedelta(rng.integers(0, 3650, rows), 'D'))
+        end = (start + pandas.to_timedelta(rng.integers(-30, 400, rows), 'D')).mask(rng.random(rows) < 0.01)
+        timer = time.perf_counter()
+        expected = _months_between_periods(start, end)
+        periods_secs = time.perf_counter() - timer
+        timer = time.perf_counter()
+        actual = months_between(start, end)
+        month_index_secs = time.perf_counter() - timer
+        assert expected.astype('float64').equals(actual), 'Month index results differ from periods'
+        results.loc[len(results)] = [rows, periods_secs, month_index_secs, periods_secs / month_index_secs]
+    return results.astype({'Rows': int})
+
+
+if __name__ == '__main__':
+    pandas.set_option('expand_frame_repr', False)
+    print(_benchmark_months_between())
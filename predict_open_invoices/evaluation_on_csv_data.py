@@ -1,110 +1,156 @@
 import os
 import tempfile
 import ast
+import functools
+from collections import OrderedDict
 import numpy
 import h2o
 import pandas
-import optuna
-import neptune
-from neptune.types import File
-from neptune.utils import stringify_unsupported
-from predict_open_invoices import DATA_FOLDER, NEPTUNE_PROJECT_NAME, NEPTUNE_MODEL_ID
+from predict_open_invoices import DATA_FOLDER, CACHE_FOLDER, STUDY_STORAGE, STUDY_NAME
 from predict_open_invoices.utils import get_h2o_frame
+from predict_open_invoices.h2o_frames import download_frame
 from predict_open_invoices.training import get_training_data_from_csvs, train_model
 from predict_open_invoices.prediction import predict
-NEPTUNE_PROJECT = neptune.init_project(project=NEPTUNE_PROJECT_NAME, api_token=os.getenv('NEPTUNE_API_TOKEN'))
-NEPTUNE_PROJECT_ID = NEPTUNE_PROJECT['sys/id'].fetch()
-try:
-    NEPTUNE_MODEL = neptune.init_model(key=NEPTUNE_MODEL_ID, project=NEPTUNE_PROJECT_NAME,
-                                       name="Trained on CSV data.", api_token=os.getenv('NEPTUNE_API_TOKEN'))
-except neptune.exceptions.NeptuneModelKeyAlreadyExistsError:
-    NEPTUNE_MODEL = neptune.init_model(with_id=f"{NEPTUNE_PROJECT_ID}-{NEPTUNE_MODEL_ID}", project=NEPTUNE_PROJECT_NAME)
+from predict_open_invoices.model_registry import register_model_version
+from predict_open_invoices.runtime import init_h2o, neptune_project, neptune_model
+from predict_open_invoices.tracking import start_model_version, log_values, log_table, log_file, close_model_version
+from predict_open_invoices.profiling import profiling_enabled, log_profile_report
+# neptune and optuna are imported where they are used: importing them takes seconds
 
+# H2O model metrics logged for train and test data
+ML_LOG_METRICS = ['r2', 'mae', 'rmsle']
 
-def _create_neptune_csv_model() -> neptune.Model:
+
+def _create_neptune_csv_model() -> 'neptune.Model':
     """Create base neptune model from CSV data. Only needs to be run once."""
+    from neptune.types import File
     url_to_project_brief = 'https://github.com/lauren7249/Data-Science-Take-Home-Project'
-    NEPTUNE_PROJECT["general/brief"] = url_to_project_brief
-    NEPTUNE_PROJECT["general/eda_html_for_download"].upload("../data_analysis/eda.html")
-    NEPTUNE_PROJECT["raw_dataset/invoices"].track_files(f'{DATA_FOLDER}/invoice.csv')
-    NEPTUNE_PROJECT["raw_dataset/payments"].track_files(f'{DATA_FOLDER}/invoice_payments.csv')
+    project, model = neptune_project(), neptune_model()
+    project["general/brief"] = url_to_project_brief
+    project["general/eda_html_for_download"].upload("../data_analysis/eda.html")
+    project["raw_dataset/invoices"].track_files(f'{DATA_FOLDER}/invoice.csv')
+    project["raw_dataset/payments"].track_files(f'{DATA_FOLDER}/invoice_payments.csv')
     h2o_frames, filter_stats_csv = get_training_data_from_csvs()
-    NEPTUNE_MODEL['data/filter_stats'].upload(File.as_html(filter_stats_csv))
+    model['data/filter_stats'].upload(File.as_html(filter_stats_csv))
+    if profiling_enabled():
+        log_profile_report(model, key='data/profiling')
     for split in h2o_frames.keys():
-        split_df = h2o_frames[split].as_data_frame()
+        split_df = download_frame(h2o_frames[split])
         summary_stats = split_df.drop(columns=['status']).describe(include='all', percentiles=[]) \
             .T.drop(columns=['50%', 'std', 'top', 'freq'])
-        NEPTUNE_MODEL[f'data/{split}_stats'].upload(File.as_html(summary_stats))
-        NEPTUNE_MODEL[f'data/{split}'].upload(File.as_pickle(split_df))
-    NEPTUNE_MODEL.sync()
+        model[f'data/{split}_stats'].upload(File.as_html(summary_stats))
+        model[f'data/{split}'].upload(File.from_content(split_df.to_parquet(index=False), extension='parquet'))
+    model.sync()
 
 
 def get_data_splits(keys: list[str] = ['train', 'test']) -> list[pandas.DataFrame]:
-    """Return specified split data frames from neptune model."""
+    """Return specified split data frames from neptune model. Splits are stored as Parquet, or as pickles by models
+    created before."""
     if len(keys) == 0:
         return keys
     frames = []
     for key in keys:
         temp_path = tempfile.NamedTemporaryFile().file.name
-        NEPTUNE_MODEL[f'data/{key}'].download(temp_path)
-        frames.append(pandas.read_pickle(temp_path))
+        split_file = neptune_model()[f'data/{key}']
+        split_file.download(temp_path)
+        read = pandas.read_parquet if split_file.fetch_extension() == 'parquet' else pandas.read_pickle
+        frames.append(read(temp_path))
     return frames
 
 
-_create_neptune_csv_model()
-TRAIN_DF, TEST_DF, VALID_DF = get_data_splits(['train', 'test', 'validation'])
-TRAIN_H2O_FRAME, TEST_H2O_FRAME = get_h2o_frame(TRAIN_DF), get_h2o_frame(TEST_DF)
+@functools.lru_cache(maxsize=None)
+def _evaluation_data() -> (pandas.DataFrame, pandas.DataFrame, pandas.DataFrame, h2o.H2OFrame, h2o.H2OFrame):
+    """Train, test and validation data frames, with train and test uploaded to H2O, loaded once per process on first
+    use. The neptune CSV model is created first if it has no data yet. H2O frames are keyed by content, so processes
+    sharing a cluster reuse the uploaded frames."""
+    if not neptune_model().exists('data/train'):
+        _create_neptune_csv_model()
+    train_df, test_df, valid_df = get_data_splits(['train', 'test', 'validation'])
+    return train_df, test_df, valid_df, get_h2o_frame(train_df), get_h2o_frame(test_df)
+
+
+def get_monthly_forecast_errors(splits: OrderedDict[str: pandas.DataFrame], h2o_model: h2o.estimators.H2OEstimator,
+                                splits_h2o: h2o.H2OFrame = None) -> pandas.Series:
+    """Given slices of historical data by split name and a trained model, calculate per split the mean absolute
+    percentage diff between monthly amount collected (normalized by company) and monthly amount forecasted for
+    collection. All splits are scored in one upload to H2O, or from splits_h2o if the concatenated splits are already
+    uploaded; predictions are converted to months per invoice, so the result of each split does not depend on the
+    others."""
+    results = pandas.concat([df[['month_collected', 'inv_pct_of_company_total']] for df in splits.values()],
+                            keys=list(splits.keys()), names=['split', None]).reset_index(level='split')
+    results['predicted_month_collected'] = predict(pandas.concat(splits.values()), h2o_model, splits_h2o).values
+    month_keys = ['split', 'month']
+    forecasted = results.astype({'predicted_month_collected': float})\
+        .groupby(['split', 'predicted_month_collected']).inv_pct_of_company_total.sum().rename_axis(month_keys)
+    collected = results.astype({'month_collected': float})\
+        .groupby(['split', 'month_collected']).inv_pct_of_company_total.sum().rename_axis(month_keys)
+    # months forecasted but not collected have no actual amount and are left out, as in a left merge
+    abs_diff = (collected.reindex(forecasted.index) - forecasted).abs()
+    mape = abs_diff.groupby(level='split').sum() / forecasted.groupby(level='split').sum()
+    return mape.reindex(list(splits.keys())).astype(float)
 
 
 def get_monthly_forecast_error(df: pandas.DataFrame, h2o_model: h2o.estimators.H2OEstimator) -> float:
     """Given a slice of historical data and trained model, calculate the mean absolute percentage diff between
      monthly amount collected (normalized by company) and monthly amount forecasted for collection."""
-    predictions = predict(df, h2o_model)
-    results = df[['collected_per_month', 'month_collected', 'inv_pct_of_company_total']].copy()
-    results['predicted_month_collected'] = predictions
-    results = results.groupby("predict_month_collected", as_index=False).inv_pct_of_company_total.sum().merge(
-        results.groupby("month_collected", as_index=False).inv_pct_of_company_total.sum()
-        .rename(columns={"month_collected": "predict_month_collected"}), on="predict_month_collected",
-        suffixes=('_predict', ''), how="left")
-    results['abs_diff'] = (results.inv_pct_of_company_total - results.inv_pct_of_company_total_predict).abs()
-    mape = float(results.abs_diff.sum() / results.inv_pct_of_company_total_predict.sum())
-    return mape
+    return float(get_monthly_forecast_errors(OrderedDict([('data', df)]), h2o_model)['data'])
+
+
+def _train_with_pruning(trial: 'optuna.Trial', train: h2o.H2OFrame, test: h2o.H2OFrame, params: dict,
+                        pruning_steps: int) -> h2o.estimators.H2OEstimator:
+    """Train AutoML in steps that share the trial's leaderboard, reporting the leader's score after each step so that
+    optuna can stop unpromising trials early."""
+    import optuna
+    project_name = f'{trial.study.study_name}_trial_{trial.number}'
+    step_params = dict(params, max_runtime_secs=max(params['max_runtime_secs'] // pruning_steps, 1))
+    for step in range(pruning_steps):
+        h2o_model = train_model(train, test, project_name=project_name, **step_params)
+        trial.report(float(h2o.automl.get_automl(project_name).leaderboard[0, params['metric']]), step)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+    return h2o_model
 
 
 def train_model_version(params: dict = dict(metric='mae', predictors=['due_per_month'], y='collected_per_month',
-                                            distribution='huber', max_runtime_secs=60)) -> float:
-    """Given a set of hyperparameters, train a model version and record performance statistics in neptune."""
-    neptune_model_version = neptune.init_model_version(model=f"{NEPTUNE_PROJECT_ID}-{NEPTUNE_MODEL_ID}",
-                                                       project=NEPTUNE_PROJECT_NAME)
-    neptune_model_version['predictors'] = stringify_unsupported(params['predictors'])
-    neptune_model_version['response_column'] = params['y']
-    neptune_model_version['response_distribution'] = params['distribution']
-    neptune_model_version['max_runtime_secs'] = params['max_runtime_secs']
-    neptune_model_version['ml_sort_metric'] = params['metric']
-    neptune_model_version['ml_log_metrics'] = stringify_unsupported(['r2', 'mae', 'rmsle'])
-    neptune_model_version['nfolds'] = params['nfolds']
-    #neptune_model_version['stopping_tolerance'] = params['stopping_tolerance']
-    h2o_model = train_model(TRAIN_H2O_FRAME, TEST_H2O_FRAME, **params)
-    neptune_model_version['monthly_mape_train'] = get_monthly_forecast_error(TRAIN_DF, h2o_model, y=params['y'])
-    mape_test = get_monthly_forecast_error(TEST_DF, h2o_model, y=params['y'])
-    neptune_model_version['monthly_mape_test'] = mape_test
-    neptune_model_version['monthly_mape_valid'] = get_monthly_forecast_error(VALID_DF, h2o_model, y=params['y'])
-    neptune_model_version['algo'] = h2o_model.algo
+                                            distribution='huber', max_runtime_secs=60, nfolds=0),
+                        trial: 'optuna.Trial' = None, pruning_steps: int = 3) -> float:
+    """Given a set of hyperparameters, train a model version and record performance statistics in neptune.
+    Within an optuna trial, training may be pruned before the model version is recorded. Tracking records are written
+    to neptune in the background, and the version is registered locally under its version key right away."""
+    TRAIN_DF, TEST_DF, VALID_DF, TRAIN_H2O_FRAME, TEST_H2O_FRAME = _evaluation_data()
+    if trial is None:
+        h2o_model = train_model(TRAIN_H2O_FRAME, TEST_H2O_FRAME, **params)
+    else:
+        h2o_model = _train_with_pruning(trial, TRAIN_H2O_FRAME, TEST_H2O_FRAME, params, pruning_steps)
+    version_key = start_model_version()
+    log_values(version_key, OrderedDict([('predictors', params['predictors']), ('response_column', params['y']),
+                                         ('response_distribution', params['distribution']),
+                                         ('max_runtime_secs', params['max_runtime_secs']),
+                                         ('ml_sort_metric', params['metric']), ('ml_log_metrics', ML_LOG_METRICS),
+                                         ('nfolds', params['nfolds'])]))
+    mape = get_monthly_forecast_errors(OrderedDict([('train', TRAIN_DF), ('test', TEST_DF), ('valid', VALID_DF)]),
+                                       h2o_model)
+    log_values(version_key, OrderedDict((f'monthly_mape_{split}', split_mape) for split, split_mape in mape.items()))
+    mape_test = float(mape['test'])
+    log_values(version_key, {'algo': h2o_model.algo})
     weights_column, varimp = h2o_model.actual_params['weights_column'], h2o_model.varimp(use_pandas=True)
     if weights_column:
-        neptune_model_version['weights_column'] = weights_column['column_name']
+        log_values(version_key, {'weights_column': weights_column['column_name']})
     if varimp is not None:
-        neptune_model_version['feature_importance'].upload(File.as_html(varimp))
+        log_table(version_key, 'feature_importance', varimp)
     temp_dir = tempfile.TemporaryDirectory().name
     model_path = h2o.save_model(model=h2o_model, path=temp_dir, force=True)
-    neptune_model_version['model_file'].upload(model_path)
-    for metric in ast.literal_eval(neptune_model_version['ml_log_metrics'].fetch()):
-        neptune_model_version[f'train_metric/{metric}'] = h2o_model.model_performance()[metric]
-        neptune_model_version[f'test_metric/{metric}'] = h2o_model.model_performance(TEST_H2O_FRAME)[metric]
+    log_file(version_key, 'model_file', model_path)
+    train_performance, test_performance = h2o_model.model_performance(), h2o_model.model_performance(TEST_H2O_FRAME)
+    log_values(version_key, OrderedDict([(f'{split}_metric/{metric}', performance[metric]) for metric in ML_LOG_METRICS
+                                         for split, performance in [('train', train_performance),
+                                                                    ('test', test_performance)]]))
+    close_model_version(version_key)
+    register_model_version(version_key, model_path, mape_test, test_performance['r2'])
     return mape_test
 
 
-def optuna_objective(trial):
+def optuna_objective(trial, pruning_steps: int = 3):
     """Use optuna to perform Bayesian optimization over a range of hyperparameters,
     saving all trained model versions in neptune."""
     #y = trial.suggest_categorical('y', ['collected_per_month', 'month_collected'])
@@ -123,11 +169,31 @@ def optuna_objective(trial):
          'max_runtime_secs': trial.suggest_int('max_runtime_secs', 60 * 3, 60 * 7),
           #'stopping_tolerance': trial.suggest_float('stopping_tolerance', 0.003, 0.03)
          }
-    metric_to_minimize = train_model_version(params)
+    metric_to_minimize = train_model_version(params, trial, pruning_steps)
     return metric_to_minimize
 
 
+def run_search(n_trials: int, n_jobs: int = 1, threads_per_trial: int = None, mem_gb_per_trial: int = None,
+               pruning_steps: int = 3, study_name: str = STUDY_NAME, storage: str = STUDY_STORAGE) -> 'optuna.Study':
+    """Run optuna trials, n_jobs at a time, in a study persisted in local storage, so that searches can be resumed
+    and joined by other workers. Trials share one H2O cluster and the uploaded training frames. When a per-trial
+    share is given, the cluster is started with that many threads and GB of memory per concurrent trial, which
+    only applies if it is not running yet."""
+    import optuna
+    if threads_per_trial or mem_gb_per_trial:
+        init_h2o(nthreads=threads_per_trial and threads_per_trial * n_jobs,
+                 max_mem_size=mem_gb_per_trial and f'{mem_gb_per_trial * n_jobs}G')
+    # load and upload the data once, before trials start in parallel
+    _evaluation_data()
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    study = optuna.create_study(study_name=study_name, storage=storage, direction='minimize', load_if_exists=True,
+                                pruner=optuna.pruners.MedianPruner(n_startup_trials=2, n_warmup_steps=1))
+    study.optimize(functools.partial(optuna_objective, pruning_steps=pruning_steps), n_trials=n_trials,
+                   n_jobs=n_jobs)
+    return study
+
+
 if __name__ == '__main__':
     pandas.set_option('expand_frame_repr', False)
-    study = optuna.create_study(direction='minimize')
-    study.optimize(optuna_objective, n_trials=1)
+    study = run_search(n_trials=1)
+    print(study.trials_dataframe())
@@ -1,21 +1,64 @@
+import numpy
 import pandas
-from predict_open_invoices.utils import months_between
+from predict_open_invoices.dates import month_index, months_between
 from predict_open_invoices.csv_test_data_io import get_csv_test_data
 from predict_open_invoices.pre_processing import preprocess_invoices_with_payments
+from predict_open_invoices.stage_cache import cached_stage
+from predict_open_invoices.profiling import profiled_stage
 
 
 def _add_date_quantities(invoice_point_in_time: pandas.DataFrame):
     """Sub-section of feature engineering"""
+    forecast_month_index = month_index(invoice_point_in_time.forecast_date)
     invoice_point_in_time['months_open'] = (
-            months_between(invoice_point_in_time.invoice_date, invoice_point_in_time.forecast_date
-                           )+1).clip(upper=13, lower=1)
+            months_between(invoice_point_in_time.invoice_date, forecast_month_index)+1).clip(upper=13, lower=1)
     invoice_point_in_time['month_due'] = (
-            months_between(invoice_point_in_time.forecast_date, invoice_point_in_time.due_date
-                           )+1).clip(upper=13, lower=1)
+            months_between(forecast_month_index, invoice_point_in_time.due_date)+1).clip(upper=13, lower=1)
     invoice_point_in_time['due_per_month'] = 1 / invoice_point_in_time.month_due.clip(lower=1)
     return invoice_point_in_time
 
 
+def _last_prior_payment_positions(invoices_with_payments: pandas.DataFrame, invoice_ids: pandas.Series,
+                                  forecast_dates: pandas.Series) -> numpy.ndarray:
+    """As-of lookup on payments sorted by invoice and transaction date: for each (invoice, forecast date) pair, return
+    the position of the last payment before the forecast date or the last row with nothing paid, else -1."""
+    invoice_codes, invoice_uniques = pandas.factorize(invoices_with_payments.invoice_id)
+    pair_codes = invoice_uniques.get_indexer(invoice_ids)
+    # rank payment and forecast dates together, so each (invoice, date) pair becomes one sortable integer key
+    date_ranks, date_uniques = pandas.factorize(
+        numpy.concatenate([invoices_with_payments.transaction_date.values, forecast_dates.values]), sort=True)
+    date_span = len(date_uniques) + 1
+    row_keys = invoice_codes.astype(numpy.int64) * date_span + date_ranks[:len(invoices_with_payments)]
+    pair_keys = pair_codes.astype(numpy.int64) * date_span + date_ranks[len(invoices_with_payments):]
+    positions = numpy.searchsorted(row_keys, pair_keys, side='left') - 1
+    segment_starts = numpy.searchsorted(invoice_codes, numpy.arange(len(invoice_uniques)), side='left')
+    positions = numpy.where(positions >= segment_starts[pair_codes], positions, -1)
+    nothing_paid = numpy.flatnonzero(invoices_with_payments.amount_pmt_pct_cum.values == 0)
+    last_nothing_paid = numpy.full(len(invoice_uniques), -1)
+    numpy.maximum.at(last_nothing_paid, invoice_codes[nothing_paid], nothing_paid)
+    return numpy.maximum(positions, last_nothing_paid[pair_codes])
+
+
+def _point_in_time(invoices_with_payments: pandas.DataFrame, invoice_begin_state: pandas.DataFrame,
+                   pmt_columns: list[str]) -> pandas.DataFrame:
+    """Join each invoice and forecast date in the begin state to the payment state as of that forecast date."""
+    positions = _last_prior_payment_positions(invoices_with_payments, invoice_begin_state.invoice_id,
+                                              invoice_begin_state.forecast_date)
+    last_prior_payment_state = invoices_with_payments[pmt_columns].reindex(positions).reset_index(drop=True)
+    invoice_point_in_time = pandas.concat([invoice_begin_state.reset_index(drop=True), last_prior_payment_state],
+                                          axis=1)
+    return _add_date_quantities(invoice_point_in_time)
+
+
+def _sort_payments(invoices_with_payments: pandas.DataFrame) -> (pandas.DataFrame, list[str]):
+    """Sort invoices with payments for as-of lookups and list the columns that describe payments."""
+    invoices_with_payments = invoices_with_payments.sort_values(by=['invoice_id', 'transaction_date'])\
+        .reset_index(drop=True)
+    pmt_columns = [col for col in invoices_with_payments.columns if '_pmt' in col or 'transaction_' in col]
+    return invoices_with_payments, pmt_columns
+
+
+@profiled_stage
 def feature_engineering(invoices_with_payments: pandas.DataFrame) -> pandas.DataFrame:
     """ Prepares preprocessed invoices with payments and forecast dates for model training and scoring.
     Summarizes invoice with payments to one row per invoice after filtering out payments that are in the future relative
@@ -23,26 +66,48 @@ def feature_engineering(invoices_with_payments: pandas.DataFrame) -> pandas.Data
     assert invoices_with_payments.forecast_date.count() == invoices_with_payments.__len__(), 'Missing forecast date'
     assert (invoices_with_payments.forecast_date < invoices_with_payments.invoice_month).sum() == 0, \
         'Forecast < invoice opened'
-    invoices_with_payments = invoices_with_payments.sort_values(by=['invoice_id', 'transaction_date']).copy()
-    pmt_columns = [col for col in invoices_with_payments.columns if '_pmt' in col or 'transaction_' in col]
-    # last payment before the forecast date for each invoice
-    last_prior_payment_state = invoices_with_payments.query("transaction_date<forecast_date or amount_pmt_pct_cum==0")\
-        .drop_duplicates(subset='invoice_id', keep='last')[['invoice_id'] + pmt_columns]
+    invoices_with_payments, pmt_columns = _sort_payments(invoices_with_payments)
     invoice_begin_state = invoices_with_payments.drop(columns=pmt_columns).drop_duplicates()
-    invoice_point_in_time = invoice_begin_state.merge(last_prior_payment_state, on="invoice_id", how="left",
-                                                      suffixes=('', '_prior'))
-    assert invoice_point_in_time.invoice_id.value_counts().max() == 1, 'Inputs not preprocessed as expected'
-    invoice_point_in_time = _add_date_quantities(invoice_point_in_time)
+    assert invoice_begin_state.invoice_id.value_counts().max() == 1, 'Inputs not preprocessed as expected'
+    invoice_point_in_time = _point_in_time(invoices_with_payments, invoice_begin_state, pmt_columns)
     assert invoice_point_in_time.invoice_id.nunique() == invoices_with_payments.invoice_id.nunique(), \
         'Invoices dropped in feature engineering'
     invoice_point_in_time['remaining_inv_pct'] = 1 - invoice_point_in_time.amount_pmt_pct_cum.fillna(0)
     return invoice_point_in_time
 
 
+def feature_engineering_for_forecast_dates(invoices_with_payments: pandas.DataFrame, forecast_dates: pandas.Series,
+                                           end_date_column: str = None) -> pandas.DataFrame:
+    """ Feature engineering for every pair of invoice and forecast date in a single pass, e.g. for backtests over many
+    forecast months. Pairs start at the month the invoice was opened and, if given, end at the date in end_date_column.
+    Output has one row per pair, ordered by invoice and forecast date."""
+    invoices_with_payments, pmt_columns = _sort_payments(
+        invoices_with_payments.drop(columns=['forecast_date'], errors='ignore'))
+    invoice_begin_state = invoices_with_payments.drop(columns=pmt_columns).drop_duplicates().reset_index(drop=True)
+    assert invoice_begin_state.invoice_id.value_counts().max() == 1, 'Inputs not preprocessed as expected'
+    forecast_grid = numpy.unique(pandas.to_datetime(forecast_dates).dropna().values)
+    first_forecast = numpy.searchsorted(forecast_grid, invoice_begin_state.invoice_month.values, side='left')
+    end_forecast = numpy.full(len(invoice_begin_state), len(forecast_grid))
+    if end_date_column:
+        end_dates = invoice_begin_state[end_date_column]
+        end_forecast = numpy.where(end_dates.notnull(),
+                                   numpy.searchsorted(forecast_grid, end_dates.values, side='right'), end_forecast)
+    pairs_per_invoice = numpy.clip(end_forecast - first_forecast, 0, None)
+    pair_invoices = numpy.repeat(numpy.arange(len(invoice_begin_state)), pairs_per_invoice)
+    pair_offsets = numpy.arange(len(pair_invoices)) - numpy.repeat(
+        numpy.cumsum(pairs_per_invoice) - pairs_per_invoice, pairs_per_invoice)
+    invoice_begin_state = invoice_begin_state.take(pair_invoices)
+    invoice_begin_state['forecast_date'] = forecast_grid[first_forecast[pair_invoices] + pair_offsets]
+    invoice_point_in_time = _point_in_time(invoices_with_payments, invoice_begin_state, pmt_columns)
+    invoice_point_in_time['remaining_inv_pct'] = 1 - invoice_point_in_time.amount_pmt_pct_cum.fillna(0)
+    return invoice_point_in_time
+
+
 def test_feature_engineering():
     """Test feature engineering on CSV test data, using the date the invoice was opened as the date forecasted."""
     invoices, payments = get_csv_test_data()
-    invoices_with_payments, preprocess_filter_stats = preprocess_invoices_with_payments(invoices, payments)
+    invoices_with_payments, preprocess_filter_stats = cached_stage(preprocess_invoices_with_payments)(invoices,
+                                                                                                      payments)
     # test using the invoice date as an arbitrary point in time to generate the data.
     invoices_with_payments['forecast_date'] = invoices_with_payments.invoice_date
     feature_data = feature_engineering(invoices_with_payments)
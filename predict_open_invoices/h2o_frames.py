@@ -0,0 +1,69 @@
+import uuid
+import hashlib
+import tempfile
+from urllib.parse import urlparse
+import h2o
+import pandas
+import pyarrow.csv
+import pyarrow.parquet
+from predict_open_invoices.runtime import init_h2o
+LOCAL_HOSTS = ['localhost', '127.0.0.1', '::1']
+
+
+def frame_key(df: pandas.DataFrame) -> str:
+    """Key of an H2O frame uploaded from a data frame, derived from its content, column names and dtypes."""
+    content_hash = hashlib.sha256(pandas.util.hash_pandas_object(df, index=False).values.tobytes())
+    content_hash.update(repr(list(zip(df.columns, df.dtypes.astype(str)))).encode())
+    return f'pandas_{content_hash.hexdigest()[:24]}'
+
+
+def _cluster_is_local() -> bool:
+    """Whether the H2O cluster can read and write files on this machine's file system."""
+    return urlparse(h2o.connection().base_url).hostname in LOCAL_HOSTS
+
+
+def _frame_exists(key: str) -> bool:
+    return key in h2o.ls()['key'].values
+
+
+def upload_frame(df: pandas.DataFrame, destination_frame: str = None, column_types: dict = None,
+                 reuse: bool = True) -> h2o.H2OFrame:
+    """Upload a data frame to H2O as a Parquet file, which keeps column types and avoids the text serialization of
+    H2OFrame. A local cluster imports the file from disk, a remote one receives it by upload. A frame already in the
+    cluster under the destination key, by default a hash of the content, is reused, and stays in the cluster for other
+    processes until removed with remove_frames. With reuse=False, the frame gets a unique key instead, for frames the
+    caller removes when done, such as scoring batches."""
+    init_h2o()
+    destination_frame = destination_frame or (frame_key(df) if reuse else f'pandas_{uuid.uuid4().hex}')
+    if reuse and _frame_exists(destination_frame):
+        return h2o.get_frame(destination_frame)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        parquet_path = f'{temp_dir}/{destination_frame}.parquet'
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(df, preserve_index=False), parquet_path)
+        transfer = h2o.import_file if _cluster_is_local() else h2o.upload_file
+        try:
+            return transfer(parquet_path, destination_frame=destination_frame, col_types=column_types)
+        except h2o.exceptions.H2OResponseError:
+            # another process sharing the cluster is importing the same content under the same key
+            if not (reuse and _frame_exists(destination_frame)):
+                raise
+            return h2o.get_frame(destination_frame)
+
+
+def download_frame(frame: h2o.H2OFrame) -> pandas.DataFrame:
+    """Download an H2O frame. A local cluster exports it to a single CSV file, in row order, which is parsed by the
+    multithreaded Arrow reader. A remote one sends it through H2OFrame, which parses in parallel when polars and
+    pyarrow are installed."""
+    if not _cluster_is_local():
+        return frame.as_data_frame(use_multi_thread=True)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        export_path = f'{temp_dir}/frame.csv'
+        h2o.export_file(frame, export_path, force=True, parts=1)
+        return pyarrow.csv.read_csv(export_path).to_pandas()
+
+
+def remove_frames(*frames: h2o.H2OFrame):
+    """Remove frames from the cluster, skipping frames that are already removed."""
+    for frame in frames:
+        if _frame_exists(frame.frame_id):
+            h2o.remove(frame, cascade=False)
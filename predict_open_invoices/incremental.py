@@ -0,0 +1,229 @@
+import os
+import json
+import sqlite3
+import tempfile
+import contextlib
+import numpy
+import pandas
+try:
+    import numba
+except ImportError:
+    numba = None
+from predict_open_invoices import REFRESH_STORE
+from predict_open_invoices.pre_processing import _prepare_payments, _prepare_invoices, \
+    preprocess_invoices_with_payments
+from predict_open_invoices.feature_engineering import feature_engineering, _add_date_quantities
+from predict_open_invoices.csv_test_data_io import get_csv_test_data
+# payment state per invoice: the compensated running sum of percent paid, the last payment row after deduping by date
+# (last_*), and the last two payment rows kept after deduping by cumulative amount paid (kept_*, prior_*)
+PAYMENT_STATE_COLUMNS = ['paid_sum', 'paid_compensation', 'last_transaction_date', 'last_pmt_pct_cum',
+                         'kept_transaction_date', 'kept_pmt_pct_cum', 'prior_transaction_date', 'prior_pmt_pct_cum']
+NOT_A_DATE = numpy.datetime64('NaT', 'ns').astype(numpy.int64)
+# sqlite limits the number of query parameters
+QUERY_CHUNK_SIZE = 900
+
+
+def _connect(store_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    connection = sqlite3.connect(store_path)
+    connection.execute('CREATE TABLE IF NOT EXISTS refresh_metadata (key TEXT PRIMARY KEY, value TEXT)')
+    connection.execute('CREATE TABLE IF NOT EXISTS excluded_invoices (invoice_id TEXT PRIMARY KEY)')
+    return connection
+
+
+def _read_metadata(connection: sqlite3.Connection) -> dict:
+    row = connection.execute("SELECT value FROM refresh_metadata WHERE key = 'state'").fetchone()
+    return dict(forecast_date=None, date_columns=[]) if row is None else json.loads(row[0])
+
+
+def _has_state(connection: sqlite3.Connection) -> bool:
+    return connection.execute("SELECT name FROM sqlite_master WHERE name = 'invoice_state'").fetchone() is not None
+
+
+def _read_state(connection: sqlite3.Connection, metadata: dict, invoice_ids: numpy.ndarray = None,
+                where: str = None) -> pandas.DataFrame:
+    """Read the state of the given invoices, or of the invoices matching a where clause."""
+    if not _has_state(connection):
+        return pandas.DataFrame(columns=['invoice_id'] + PAYMENT_STATE_COLUMNS)
+    if invoice_ids is None:
+        return pandas.read_sql(f"SELECT * FROM invoice_state WHERE {where or '1'}", connection,
+                               parse_dates=metadata['date_columns'])
+    chunks = [invoice_ids[start:start + QUERY_CHUNK_SIZE] for start in range(0, len(invoice_ids), QUERY_CHUNK_SIZE)]
+    state = [pandas.read_sql(f"SELECT * FROM invoice_state WHERE invoice_id IN ({','.join('?' * len(chunk))})",
+                             connection, params=[str(invoice_id) for invoice_id in chunk],
+                             parse_dates=metadata['date_columns']) for chunk in chunks]
+    return pandas.concat(state, ignore_index=True) if len(state) else _read_state(connection, metadata, where='0')
+
+
+def _write_state(connection: sqlite3.Connection, state: pandas.DataFrame, removed_ids: numpy.ndarray):
+    """Replace the stored state of the touched invoices."""
+    if _has_state(connection):
+        connection.executemany('DELETE FROM invoice_state WHERE invoice_id = ?',
+                               [(str(invoice_id),) for invoice_id in numpy.concatenate([state.invoice_id.values,
+                                                                                         removed_ids])])
+    state.astype({col: object for col in state.select_dtypes('category').columns})\
+        .to_sql('invoice_state', connection, if_exists='append', index=False)
+    connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS invoice_state_ids ON invoice_state (invoice_id)')
+    connection.execute('CREATE INDEX IF NOT EXISTS invoice_state_status ON invoice_state (status)')
+
+
+def _running_paid_pct(amount_pmt_pct: numpy.ndarray, positions: numpy.ndarray, paid_sum: numpy.ndarray,
+                      paid_compensation: numpy.ndarray) -> numpy.ndarray:
+    """Continue the compensated cumulative sum of percent paid of each invoice from its stored state, over new payments
+    sorted by invoice and transaction date. Updates the stored sums in place."""
+    out = numpy.empty_like(amount_pmt_pct)
+    for i in range(len(amount_pmt_pct)):
+        position = positions[i]
+        y = amount_pmt_pct[i] - paid_compensation[position]
+        t = paid_sum[position] + y
+        paid_compensation[position] = t - paid_sum[position] - y
+        paid_sum[position] = t
+        out[i] = t
+    return out
+
+
+def _dedupe_payments(transaction_dates: numpy.ndarray, amount_pmt_pct_cum: numpy.ndarray, positions: numpy.ndarray,
+                     last_date: numpy.ndarray, last_cum: numpy.ndarray, kept_date: numpy.ndarray,
+                     kept_cum: numpy.ndarray, prior_date: numpy.ndarray, prior_cum: numpy.ndarray):
+    """Apply new payment rows to the stored payment state, with the dedupe rules of preprocessing: the last row per
+    transaction date, then the first row per cumulative amount paid. Overpayments must already be removed."""
+    for i in range(len(transaction_dates)):
+        position, date, cum = positions[i], transaction_dates[i], amount_pmt_pct_cum[i]
+        if last_date[position] == date:
+            # replaces the last row of the same date, which was kept if it started a new cumulative amount
+            if kept_date[position] == date:
+                kept_cum[position] = cum
+            elif cum != kept_cum[position]:
+                prior_date[position], prior_cum[position] = kept_date[position], kept_cum[position]
+                kept_date[position], kept_cum[position] = date, cum
+        elif last_date[position] == NOT_A_DATE or cum != last_cum[position]:
+            prior_date[position], prior_cum[position] = kept_date[position], kept_cum[position]
+            kept_date[position], kept_cum[position] = date, cum
+        last_date[position], last_cum[position] = date, cum
+
+
+if numba is not None:
+    _running_paid_pct = numba.njit(cache=True)(_running_paid_pct)
+    _dedupe_payments = numba.njit(cache=True)(_dedupe_payments)
+
+
+def _initial_payment_state(n_invoices: int) -> pandas.DataFrame:
+    no_dates = numpy.full(n_invoices, numpy.datetime64('NaT'), dtype='datetime64[ns]')
+    return pandas.DataFrame({'paid_sum': 0.0, 'paid_compensation': 0.0, 'last_transaction_date': no_dates,
+                             'last_pmt_pct_cum': numpy.nan, 'kept_transaction_date': no_dates,
+                             'kept_pmt_pct_cum': numpy.nan, 'prior_transaction_date': no_dates,
+                             'prior_pmt_pct_cum': numpy.nan}, index=pandas.RangeIndex(n_invoices))
+
+
+def _apply_payments(state: pandas.DataFrame, payments_prepared: pandas.DataFrame) -> pandas.DataFrame:
+    """Update the payment state of invoices with their new payments, in order of transaction date and arrival."""
+    positions = pandas.Index(state.invoice_id).get_indexer(payments_prepared.invoice_id)
+    invoice_amounts = state.amount.values[positions]
+    assert (payments_prepared.amount.values > invoice_amounts).sum() == 0, 'Payment amount > invoice amount'
+    assert (state.company_id.values[positions] != payments_prepared.company_id.values).sum() == 0, \
+        'Company does not match between payments and invoices'
+    transaction_dates = payments_prepared.transaction_date.values.astype('datetime64[ns]').astype(numpy.int64)
+    assert (transaction_dates < state.last_transaction_date.values.astype('datetime64[ns]')
+            .astype(numpy.int64)[positions]).sum() == 0, \
+        'Payments dated before the last applied payment of their invoice need a full rebuild'
+    order = numpy.lexsort((transaction_dates, positions))
+    positions, transaction_dates = positions[order], transaction_dates[order]
+    amount_pmt_pct = (payments_prepared.amount.values[order] / invoice_amounts[order]).astype(numpy.float64)
+    state_arrays = {col: state[col].values.astype(numpy.int64 if 'date' in col else numpy.float64)
+                    for col in PAYMENT_STATE_COLUMNS}
+    # round to eliminate the impact of negligible payments, as in preprocessing
+    amount_pmt_pct_cum = _running_paid_pct(amount_pmt_pct, positions, state_arrays['paid_sum'],
+                                           state_arrays['paid_compensation']).round(4)
+    # overpayments are filtered out
+    not_overpaid = amount_pmt_pct_cum <= 1
+    _dedupe_payments(transaction_dates[not_overpaid], amount_pmt_pct_cum[not_overpaid], positions[not_overpaid],
+                     *[state_arrays[col] for col in PAYMENT_STATE_COLUMNS[2:]])
+    return state.assign(**{col: values.astype('datetime64[ns]') if 'date' in col else values
+                           for col, values in state_arrays.items()})
+
+
+def _upsert_invoices(state: pandas.DataFrame, invoices_delta: pandas.DataFrame) -> (pandas.DataFrame, numpy.ndarray):
+    """Validate and filter new or updated invoices into the state. New invoices start with no payments and updated
+    invoices keep their payment state. Returns the ids of invoices that are filtered out."""
+    if invoices_delta.__len__() == 0:
+        return state, invoices_delta.id.values
+    invoices_prepared, _ = _prepare_invoices(invoices_delta)
+    invoices_prepared['converted_amount'] = invoices_prepared.amount * invoices_prepared.root_exchange_rate_value
+    payment_state = state.set_index('invoice_id')[PAYMENT_STATE_COLUMNS].reindex(invoices_prepared.invoice_id.values)
+    new_payment_state = _initial_payment_state(invoices_prepared.__len__())
+    payment_state = payment_state.reset_index(drop=True).fillna(new_payment_state)\
+        .astype(new_payment_state.dtypes.to_dict())
+    updated = pandas.concat([invoices_prepared.reset_index(drop=True), payment_state], axis=1)
+    unchanged = state[~state.invoice_id.isin(invoices_delta.id)]
+    state = updated if unchanged.empty else pandas.concat([unchanged, updated], ignore_index=True)
+    return state, invoices_delta.id[~invoices_delta.id.isin(invoices_prepared.invoice_id)].values
+
+
+def _open_invoice_features(open_invoices: pandas.DataFrame, forecast_date: pandas.Timestamp) -> pandas.DataFrame:
+    """Point-in-time features of OPEN invoices at the forecast date, from the last kept payment before it."""
+    open_invoices = open_invoices[open_invoices.invoice_date <= forecast_date].copy()
+    use_kept = open_invoices.kept_transaction_date < forecast_date
+    open_invoices['forecast_date'] = forecast_date
+    open_invoices['transaction_date'] = open_invoices.kept_transaction_date.where(
+        use_kept, open_invoices.prior_transaction_date)
+    open_invoices['amount_pmt_pct_cum'] = open_invoices.kept_pmt_pct_cum.where(use_kept,
+                                                                                open_invoices.prior_pmt_pct_cum)
+    open_invoices['collected_date'] = open_invoices.transaction_date.where(open_invoices.amount_pmt_pct_cum == 1)
+    invoice_point_in_time = _add_date_quantities(open_invoices.drop(columns=PAYMENT_STATE_COLUMNS)
+                                                 .reset_index(drop=True))
+    invoice_point_in_time['remaining_inv_pct'] = 1 - invoice_point_in_time.amount_pmt_pct_cum.fillna(0)
+    return invoice_point_in_time.sort_values(by='invoice_id').reset_index(drop=True)
+
+
+def refresh_open_invoices(invoices_delta: pandas.DataFrame, payments_delta: pandas.DataFrame,
+                          store_path: str = REFRESH_STORE) -> pandas.DataFrame:
+    """ Apply new or updated raw invoices and new raw payments to the per-invoice state persisted in store_path, and
+    return point-in-time features of OPEN invoices at the last transaction date, as for scoring. Only the state of
+    invoices in the delta is read and rewritten. An empty store is built from the full history by passing all
+    invoices and payments as the first delta. Invoice amounts are assumed not to change after payments are applied."""
+    with contextlib.closing(_connect(store_path)) as connection, connection:
+        metadata = _read_metadata(connection)
+        touched_ids = pandas.unique(numpy.concatenate([invoices_delta.id.values, payments_delta.invoice_id.values]))
+        state = _read_state(connection, metadata, touched_ids)
+        excluded_ids = pandas.read_sql('SELECT invoice_id FROM excluded_invoices', connection).invoice_id
+        known_ids = numpy.concatenate([state.invoice_id.values, invoices_delta.id.values, excluded_ids.values])
+        assert payments_delta.invoice_id.isin(known_ids).all(), "Not all payments have invoice data"
+        state, removed_ids = _upsert_invoices(state, invoices_delta)
+        if payments_delta.__len__():
+            payments_prepared, _ = _prepare_payments(payments_delta)
+            state = _apply_payments(state, payments_prepared[payments_prepared.invoice_id.isin(state.invoice_id)])
+        _write_state(connection, state, removed_ids)
+        connection.executemany('INSERT OR IGNORE INTO excluded_invoices VALUES (?)',
+                               [(str(invoice_id),) for invoice_id in removed_ids])
+        last_dates = [date for date in [metadata['forecast_date'], payments_delta.transaction_date.max()]
+                      if not pandas.isnull(date)]
+        metadata = dict(forecast_date=str(max(pandas.Timestamp(date) for date in last_dates)),
+                        date_columns=list(state.select_dtypes('datetime').columns))
+        connection.execute("INSERT OR REPLACE INTO refresh_metadata VALUES ('state', ?)", (json.dumps(metadata),))
+        open_invoices = _read_state(connection, metadata, where="status = 'OPEN'")
+    return _open_invoice_features(open_invoices, pandas.Timestamp(metadata['forecast_date']))
+
+
+def _test_incremental_refresh(n_days: int = 5, store_path: str = None) -> pandas.DataFrame:
+    """Build the refresh state from local CSV data up to the last n_days of payments, apply the remaining days one at
+    a time, and compare the OPEN invoice features with a full rebuild. Returns the largest difference per feature.
+    The state is written to a new store, by default in a temporary folder, never to the configured refresh store."""
+    store_path = store_path or f'{tempfile.mkdtemp()}/refresh.sqlite'
+    assert not os.path.exists(store_path), f'Refresh store {store_path} already exists'
+    invoices, payments = get_csv_test_data()
+    days = numpy.sort(payments.transaction_date.dropna().unique())[-n_days:]
+    refresh_open_invoices(invoices, payments[~payments.transaction_date.isin(days)], store_path)
+    for day in days:
+        features = refresh_open_invoices(invoices.iloc[:0], payments[payments.transaction_date == day], store_path)
+    invoices_with_payments, _ = preprocess_invoices_with_payments(invoices, payments)
+    open_invoices = invoices_with_payments.query("status=='OPEN'").copy()
+    open_invoices['forecast_date'] = payments.transaction_date.max()
+    expected = feature_engineering(open_invoices.query("forecast_date>=invoice_date"))
+    assert expected.invoice_id.tolist() == features.invoice_id.tolist(), 'Refreshed invoices differ'
+    feature_columns = ['months_open', 'month_due', 'due_per_month', 'remaining_inv_pct']
+    return (features[feature_columns] - expected[feature_columns]).abs().max()
+
+
+if __name__ == "__main__":
+    pandas.set_option('expand_frame_repr', False)
+    print(_test_incremental_refresh())
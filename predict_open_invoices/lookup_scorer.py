@@ -0,0 +1,105 @@
+import itertools
+from collections import OrderedDict
+import numpy
+import h2o
+import pandas
+from predict_open_invoices.h2o_frames import upload_frame, download_frame, remove_frames
+from predict_open_invoices.model_registry import response_column
+# values taken by the discrete predictors after pre-processing and feature engineering
+DISCRETE_GRIDS = OrderedDict([('months_allowed', numpy.arange(0, 4)), ('months_open', numpy.arange(1, 14)),
+                              ('month_due', numpy.arange(1, 14))])
+# predictors derived from a discrete predictor, which index the table by the predictor they are derived from
+DERIVED_PREDICTORS = {'due_per_month': ('month_due', lambda month_due: 1 / month_due)}
+CONTINUOUS_PREDICTOR = 'remaining_inv_pct'
+
+
+def _table_axes(predictors: list[str], continuous_bins: int) -> OrderedDict:
+    """Grid of each table axis, in predictor order. Derived predictors use the axis of their source predictor."""
+    axes = OrderedDict()
+    for predictor in predictors:
+        source = DERIVED_PREDICTORS[predictor][0] if predictor in DERIVED_PREDICTORS else predictor
+        assert source in DISCRETE_GRIDS or source == CONTINUOUS_PREDICTOR, f'No lookup grid for {predictor}'
+        axes[source] = DISCRETE_GRIDS[source] if source in DISCRETE_GRIDS else numpy.linspace(0, 1, continuous_bins)
+    return axes
+
+
+def _predictor_frame(predictors: list[str], axes_values: OrderedDict) -> pandas.DataFrame:
+    """Table axis and predictor columns for points given by their values on each table axis."""
+    grid = pandas.DataFrame(axes_values)
+    for predictor in predictors:
+        if predictor in DERIVED_PREDICTORS:
+            source, derive = DERIVED_PREDICTORS[predictor]
+            grid[predictor] = derive(grid[source])
+    return grid
+
+
+def _model_predictions(model: h2o.estimators.H2OEstimator, grid: pandas.DataFrame) -> numpy.ndarray:
+    grid_h2o = upload_frame(grid, reuse=False)
+    predictions_h2o = model.predict(grid_h2o)
+    predictions = download_frame(predictions_h2o)['predict'].values.astype(numpy.float64)
+    remove_frames(grid_h2o, predictions_h2o)
+    return predictions
+
+
+def compile_lookup_table(model: h2o.estimators.H2OEstimator, predictors: list[str], continuous_bins: int = 201,
+                         check_features: pandas.DataFrame = None) -> dict:
+    """Evaluate a model over every combination of its discrete predictors and a fine grid of remaining_inv_pct, so
+    that it can be scored with numpy alone. The maximum error of the table against the model is measured at the
+    midpoints of the remaining_inv_pct grid and, if given, on check_features."""
+    axes = _table_axes(predictors, continuous_bins)
+    points = numpy.array(list(itertools.product(*axes.values()))).T
+    table = _model_predictions(model, _predictor_frame(predictors, OrderedDict(zip(axes.keys(), points)))[predictors])
+    lookup_table = dict(predictors=predictors, axes=axes, table=table.reshape([grid.size for grid in axes.values()]),
+                        response_column=response_column(model))
+    errors = []
+    if CONTINUOUS_PREDICTOR in axes:
+        midpoints = OrderedDict(axes)
+        midpoints[CONTINUOUS_PREDICTOR] = (axes[CONTINUOUS_PREDICTOR][1:] + axes[CONTINUOUS_PREDICTOR][:-1]) / 2
+        points = numpy.array(list(itertools.product(*midpoints.values()))).T
+        midpoint_grid = _predictor_frame(predictors, OrderedDict(zip(axes.keys(), points)))
+        errors.append(numpy.abs(lookup_predict(lookup_table, midpoint_grid) -
+                                _model_predictions(model, midpoint_grid[predictors])).max())
+    if check_features is not None:
+        errors.append(numpy.abs(lookup_predict(lookup_table, check_features) -
+                                _model_predictions(model, check_features[predictors])).max())
+    lookup_table['max_error'] = max(errors, default=0.0)
+    return lookup_table
+
+
+def lookup_predict(lookup_table: dict, invoice_features: pandas.DataFrame) -> numpy.ndarray:
+    """Raw model predictions from a compiled lookup table: discrete predictors index the table and remaining_inv_pct is
+    linearly interpolated between grid points. Values outside the grid are clipped to it."""
+    table, axes = lookup_table['table'], lookup_table['axes']
+    index, weights = [], None
+    for source, grid in axes.items():
+        values = invoice_features[source].values.astype(numpy.float64)
+        assert not numpy.isnan(values).any(), f'Missing values of {source} cannot be looked up'
+        if source == CONTINUOUS_PREDICTOR:
+            position = (numpy.clip(values, grid[0], grid[-1]) - grid[0]) / (grid[1] - grid[0])
+            lower = numpy.minimum(position.astype(numpy.int64), grid.size - 2)
+            index.append(lower)
+            weights = position - lower
+        else:
+            index.append(numpy.clip(numpy.rint(values).astype(numpy.int64), grid[0], grid[-1]) - grid[0])
+    if weights is None:
+        return table[tuple(index)]
+    continuous_axis = list(axes.keys()).index(CONTINUOUS_PREDICTOR)
+    lower_values = table[tuple(index)]
+    index[continuous_axis] = index[continuous_axis] + 1
+    return lower_values * (1 - weights) + table[tuple(index)] * weights
+
+
+def save_lookup_table(lookup_table: dict, path: str):
+    numpy.savez(path, table=lookup_table['table'], predictors=numpy.array(lookup_table['predictors']),
+                response_column=numpy.array(lookup_table['response_column']),
+                axis_names=numpy.array(list(lookup_table['axes'].keys())), max_error=lookup_table['max_error'],
+                **{f'axis_{num}': grid for num, grid in enumerate(lookup_table['axes'].values())})
+
+
+def load_lookup_table(path: str) -> dict:
+    with numpy.load(path) as saved:
+        axes = OrderedDict((str(name), saved[f'axis_{num}']) for num, name in enumerate(saved['axis_names']))
+        # tables saved before the response column was stored have none
+        return dict(predictors=[str(predictor) for predictor in saved['predictors']], axes=axes, table=saved['table'],
+                    max_error=float(saved['max_error']),
+                    response_column=str(saved['response_column']) if 'response_column' in saved else None)
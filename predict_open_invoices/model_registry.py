@@ -0,0 +1,152 @@
+import os
+import shutil
+import sqlite3
+import contextlib
+from collections import OrderedDict
+import h2o
+import pandas
+from predict_open_invoices import NEPTUNE_PROJECT_NAME, MODEL_REGISTRY_FOLDER, MODEL_CACHE_SIZE
+from predict_open_invoices.runtime import init_h2o, neptune_model_id
+# registry columns of the neptune model version fields that best model selection sorts by
+SORT_COLUMNS = OrderedDict([('monthly_mape_test', 'monthly_mape_test'), ('test_metric/r2', 'test_r2')])
+# sort column of best model selection by scores on the latest forecast date fold recorded with record_fold_score
+LATEST_FOLD_SORT = 'monthly_mape_latest_fold'
+# model files of versions synced from neptune are downloaded on first load, and are missing if neptune has none
+NEPTUNE_FILE_PREFIX, MISSING_MODEL_FILE = 'neptune:', ''
+# H2O models loaded in this process, keyed by version id, least recently used first
+LOADED_MODELS = OrderedDict()
+
+
+def _connect(registry_folder: str) -> sqlite3.Connection:
+    """Open the SQLite index of model versions, creating it on first use."""
+    os.makedirs(registry_folder, exist_ok=True)
+    connection = sqlite3.connect(f'{registry_folder}/registry.sqlite')
+    connection.execute('CREATE TABLE IF NOT EXISTS model_versions (version_id TEXT PRIMARY KEY, '
+                       'monthly_mape_test REAL, test_r2 REAL, model_file TEXT NOT NULL)')
+    connection.execute('CREATE INDEX IF NOT EXISTS best_model_versions ON model_versions (monthly_mape_test, test_r2)')
+    connection.execute('CREATE TABLE IF NOT EXISTS fold_scores (version_id TEXT NOT NULL, fold_date TEXT NOT NULL, '
+                       'monthly_mape REAL, r2 REAL, PRIMARY KEY (version_id, fold_date))')
+    return connection
+
+
+def register_model_version(version_id: str, model_file: str, monthly_mape_test: float, test_r2: float,
+                           registry_folder: str = MODEL_REGISTRY_FOLDER):
+    """Copy a saved H2O model file into the local registry and index it by its test metrics."""
+    registered_file = f'{registry_folder}/{version_id}.model'
+    os.makedirs(registry_folder, exist_ok=True)
+    shutil.copyfile(model_file, registered_file)
+    _index_model_version(version_id, registered_file, monthly_mape_test, test_r2, registry_folder)
+
+
+def _index_model_version(version_id: str, model_file: str, monthly_mape_test: float, test_r2: float,
+                         registry_folder: str):
+    with contextlib.closing(_connect(registry_folder)) as connection, connection:
+        connection.execute('INSERT OR REPLACE INTO model_versions VALUES (?, ?, ?, ?)',
+                           (version_id, _metric_value(monthly_mape_test), _metric_value(test_r2), model_file))
+
+
+def record_fold_score(version_id: str, fold_date: pandas.Timestamp, monthly_mape: float, r2: float,
+                      registry_folder: str = MODEL_REGISTRY_FOLDER):
+    """Record the scores of a registered model version on the forecast date fold ending at fold_date, next to its
+    test metrics, which are kept."""
+    with contextlib.closing(_connect(registry_folder)) as connection, connection:
+        registered = connection.execute('SELECT 1 FROM model_versions WHERE version_id = ?', (version_id,)).fetchone()
+        assert registered is not None, f'Model version {version_id} is not registered'
+        connection.execute('INSERT OR REPLACE INTO fold_scores VALUES (?, ?, ?, ?)',
+                           (version_id, pandas.Timestamp(fold_date).strftime('%Y-%m-%d'), _metric_value(monthly_mape),
+                            _metric_value(r2)))
+
+
+def response_column(model: h2o.estimators.H2OEstimator) -> str:
+    """Name of the column a model was trained to predict."""
+    response = model.actual_params['response_column']
+    return response['column_name'] if isinstance(response, dict) else response
+
+
+def _metric_value(value) -> float:
+    return None if pandas.isnull(value) else float(value)
+
+
+def registered_versions(registry_folder: str = MODEL_REGISTRY_FOLDER) -> pandas.DataFrame:
+    with contextlib.closing(_connect(registry_folder)) as connection, connection:
+        return pandas.read_sql('SELECT * FROM model_versions', connection, index_col='version_id')
+
+
+def best_version(sort_column: str = 'monthly_mape_test', registry_folder: str = MODEL_REGISTRY_FOLDER) -> str:
+    """Version id that minimizes sort_column, breaking ties by the highest test R2, or None if the registry has no
+    version with a model file. Versions missing a metric sort last. With LATEST_FOLD_SORT, only versions scored on the
+    latest recorded fold are compared by their monthly MAPE and R2 on it, so that all are compared on the same data,
+    and the others follow in monthly_mape_test order."""
+    if sort_column == LATEST_FOLD_SORT:
+        query = ('SELECT model_versions.version_id FROM model_versions LEFT JOIN fold_scores AS latest '
+                 'ON latest.version_id = model_versions.version_id '
+                 'AND latest.fold_date = (SELECT MAX(fold_date) FROM fold_scores) WHERE model_file != ? '
+                 'ORDER BY latest.monthly_mape IS NULL, latest.monthly_mape, latest.r2 IS NULL, latest.r2 DESC, '
+                 'monthly_mape_test IS NULL, monthly_mape_test, test_r2 IS NULL, test_r2 DESC LIMIT 1')
+    else:
+        column = SORT_COLUMNS[sort_column]
+        query = f'SELECT version_id FROM model_versions WHERE model_file != ? ORDER BY {column} IS NULL, {column}, ' \
+                'test_r2 IS NULL, test_r2 DESC LIMIT 1'
+    with contextlib.closing(_connect(registry_folder)) as connection, connection:
+        best = connection.execute(query, (MISSING_MODEL_FILE,)).fetchone()
+    return None if best is None else best[0]
+
+
+def sync_from_neptune(registry_folder: str = MODEL_REGISTRY_FOLDER) -> int:
+    """Register model versions from neptune that are not in the local registry yet, skipping versions without a test
+    MAPE, such as crashed or pruned runs. Returns the number added. Versions logged through the tracking journal are
+    registered under their version key, stored in neptune as local_version_id, and others under their neptune id.
+    Model files are not downloaded here, but by fetch_model_file once a version is picked."""
+    import neptune
+    neptune_model = neptune.init_model(with_id=neptune_model_id(), project=NEPTUNE_PROJECT_NAME)
+    neptune_model.sync()
+    model_versions_table = neptune_model.fetch_model_versions_table().to_pandas()
+    missing = pandas.Series(index=model_versions_table.index, dtype=object)
+    version_ids = model_versions_table.get('local_version_id', missing).fillna(model_versions_table['sys/id'])
+    new_versions = model_versions_table[~version_ids.isin(registered_versions(registry_folder).index)
+                                        & model_versions_table.get('monthly_mape_test', missing).notnull()]
+    for row_num, version_info in new_versions.iterrows():
+        _index_model_version(version_ids[row_num], f"{NEPTUNE_FILE_PREFIX}{version_info['sys/id']}",
+                             version_info.get('monthly_mape_test'), version_info.get('test_metric/r2'),
+                             registry_folder)
+    return new_versions.__len__()
+
+
+def fetch_model_file(version_id: str, registry_folder: str = MODEL_REGISTRY_FOLDER) -> str:
+    """Local model file of a registered version, downloaded from neptune if it was synced without it, or None if
+    neptune has no model file for it, in which case the version is no longer picked as the best."""
+    with contextlib.closing(_connect(registry_folder)) as connection, connection:
+        model_file = connection.execute('SELECT model_file FROM model_versions WHERE version_id = ?',
+                                        (version_id,)).fetchone()
+    assert model_file is not None, f'Model version {version_id} is not registered'
+    model_file = model_file[0]
+    if model_file.startswith(NEPTUNE_FILE_PREFIX):
+        import neptune
+        model_version = neptune.init_model_version(with_id=model_file[NEPTUNE_FILE_PREFIX.__len__():],
+                                                   project=NEPTUNE_PROJECT_NAME, mode='read-only')
+        model_file = MISSING_MODEL_FILE
+        if model_version.exists('model_file'):
+            model_file = f'{registry_folder}/{version_id}.model'
+            model_version['model_file'].download(model_file)
+        model_version.stop()
+        with contextlib.closing(_connect(registry_folder)) as connection, connection:
+            connection.execute('UPDATE model_versions SET model_file = ? WHERE version_id = ?',
+                               (model_file, version_id))
+    return model_file or None
+
+
+def load_model(version_id: str, registry_folder: str = MODEL_REGISTRY_FOLDER,
+               cache_size: int = MODEL_CACHE_SIZE) -> h2o.estimators.H2OEstimator:
+    """Load a registered model version into H2O, reusing it if it is already loaded in this process. Beyond
+    cache_size models, the least recently used is removed from the cluster."""
+    init_h2o()
+    if version_id in LOADED_MODELS:
+        LOADED_MODELS.move_to_end(version_id)
+        return LOADED_MODELS[version_id]
+    model_file = fetch_model_file(version_id, registry_folder)
+    assert model_file is not None, f'Model version {version_id} has no model file'
+    LOADED_MODELS[version_id] = h2o.load_model(model_file)
+    while LOADED_MODELS.__len__() > cache_size:
+        _, evicted_model = LOADED_MODELS.popitem(last=False)
+        h2o.remove(evicted_model)
+    return LOADED_MODELS[version_id]
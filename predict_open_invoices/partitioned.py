@@ -0,0 +1,146 @@
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import pandas
+import pyarrow.feather
+from predict_open_invoices.pre_processing import _prepare_payments, _prepare_invoices, _combine_invoices_payments
+from predict_open_invoices.training import _add_invoice_outcomes, _filter_invoice_outcomes, _forecast_date_ranges, \
+    _check_forecast_date_ranges
+from predict_open_invoices.feature_engineering import feature_engineering
+from predict_open_invoices.csv_test_data_io import get_csv_test_data
+
+
+def _write_frame(df: pandas.DataFrame, path: str):
+    """Pass a data frame between processes as an uncompressed Arrow IPC file instead of a pickle."""
+    pyarrow.feather.write_feather(df.reset_index(drop=True), path, compression='uncompressed')
+
+
+def _read_frame(path: str) -> pandas.DataFrame:
+    return pyarrow.feather.read_table(path, memory_map=True).to_pandas()
+
+
+def _shard_by_company(invoices: pandas.DataFrame, payments: pandas.DataFrame, n_shards: int) -> list[numpy.ndarray]:
+    """Assign companies to shards, largest first, to balance the rows per shard. Returns the company ids per shard.
+    Every shard gets at least one company with payments."""
+    rows_by_company = invoices.company_id.value_counts().add(payments.company_id.value_counts(), fill_value=0)\
+        .sort_values(ascending=False)
+    companies_with_payments = rows_by_company.index.isin(payments.company_id.unique())
+    rows_by_company = pandas.concat([rows_by_company[companies_with_payments],
+                                     rows_by_company[~companies_with_payments]])
+    shard_rows = numpy.zeros(n_shards)
+    shard_companies = [[] for _ in range(n_shards)]
+    for shard_num, (company_id, rows) in enumerate(rows_by_company.items()):
+        # the first companies, which all have payments, seed every shard
+        shard = shard_num if shard_num < n_shards else int(shard_rows.argmin())
+        shard_rows[shard] += rows
+        shard_companies[shard].append(company_id)
+    return [numpy.array(companies) for companies in shard_companies]
+
+
+def _prepare_shard(shard_dir: str) -> (pandas.DataFrame, pandas.DataFrame, numpy.datetime64):
+    """Worker: validate and filter one shard of raw invoices and payments. Returns the filter stats and the last
+    transaction date of payments with prepared invoices."""
+    payments_prepared, payment_filter_stats = _prepare_payments(_read_frame(f'{shard_dir}/payments.arrow'))
+    invoices_prepared, invoice_filter_stats = _prepare_invoices(_read_frame(f'{shard_dir}/invoices.arrow'))
+    _write_frame(payments_prepared, f'{shard_dir}/payments_prepared.arrow')
+    _write_frame(invoices_prepared, f'{shard_dir}/invoices_prepared.arrow')
+    last_transaction_date = payments_prepared.transaction_date[
+        payments_prepared.invoice_id.isin(invoices_prepared.invoice_id)].max()
+    return payment_filter_stats, invoice_filter_stats, last_transaction_date
+
+
+def _combine_shard(shard_dir: str, last_transaction_date: pandas.Timestamp) -> (pandas.Timestamp, pandas.Timestamp):
+    """Worker: combine one shard of prepared invoices and payments. Returns the range of its collected dates."""
+    invoices_with_payments = _combine_invoices_payments(_read_frame(f'{shard_dir}/invoices_prepared.arrow'),
+                                                        _read_frame(f'{shard_dir}/payments_prepared.arrow'),
+                                                        last_transaction_date)
+    _write_frame(invoices_with_payments, f'{shard_dir}/invoices_with_payments.arrow')
+    collected_dates = invoices_with_payments.transaction_date[invoices_with_payments.amount_pmt_pct_cum == 1]
+    return collected_dates.min(), collected_dates.max()
+
+
+def _featurize_shard(shard_dir: str, collected_date_range: tuple) -> (pandas.DataFrame, pandas.DataFrame):
+    """Worker: post-process outcomes and engineer features for one shard. Returns the filter stats and the ranges of
+    sampled forecast dates."""
+    invoices_with_outcomes = _add_invoice_outcomes(_read_frame(f'{shard_dir}/invoices_with_payments.arrow'),
+                                                   check_date_ranges=False)
+    invoices_to_model, filter_stats = _filter_invoice_outcomes(invoices_with_outcomes, collected_date_range)
+    _write_frame(feature_engineering(invoices_to_model), f'{shard_dir}/feature_data.arrow')
+    return filter_stats, _forecast_date_ranges(invoices_with_outcomes)
+
+
+def merge_filter_stats(shard_filter_stats: list[pandas.DataFrame], shard_rows: list[int]) -> pandas.DataFrame:
+    """Combine filter stats of shards with the given numbers of unfiltered rows into the stats of the whole data."""
+    filter_stats = shard_filter_stats[0][['Bad Data']].copy()
+    rows_applied_to = sum(stats['Rows Filter Applied To'].astype(int) for stats in shard_filter_stats)
+    rows_excluded = sum((stats['% of Unfiltered Data'] * rows).round().astype(int)
+                        for stats, rows in zip(shard_filter_stats, shard_rows))
+    rows_filtered = sum((stats['% Filtered at Step'] * stats['Rows Filter Applied To']).round().astype(int)
+                        for stats in shard_filter_stats)
+    filter_stats['% of Unfiltered Data'] = rows_excluded / sum(shard_rows)
+    filter_stats['Rows Filter Applied To'] = rows_applied_to
+    filter_stats['% Filtered at Step'] = [1 - (applied - filtered) / applied if applied else 0.0
+                                          for applied, filtered in zip(rows_applied_to, rows_filtered)]
+    return filter_stats
+
+
+def featurize_by_company(invoices: pandas.DataFrame, payments: pandas.DataFrame, n_workers: int = None) -> \
+        (pandas.DataFrame, pandas.DataFrame, pandas.DataFrame):
+    """ Preprocess, post-process outcomes and engineer features for raw invoices and payments, partitioned by company
+    and run in a process pool. Shards are passed between processes as Arrow IPC files. Values that depend on all
+    companies (payments end date, collected date range) are computed between stages. Returns the feature data, sorted
+    by invoice, with the combined preprocessing and post-processing filter stats."""
+    assert len(set(payments.invoice_id) - set(invoices.id)) == 0, "Not all payments have invoice data"
+    n_workers = n_workers or os.cpu_count()
+    # shard payments by the company of their invoice, so company mismatches are still caught when combining
+    payment_companies = payments.invoice_id.map(invoices.set_index('id').company_id)
+    n_shards = min(n_workers, payment_companies.nunique())
+    shard_companies = _shard_by_company(invoices, payments.assign(company_id=payment_companies), n_shards)
+    with tempfile.TemporaryDirectory() as temp_dir, ProcessPoolExecutor(max_workers=n_workers) as executor:
+        shard_dirs, shard_rows = [], OrderedDict([('payments', []), ('invoices', [])])
+        for shard_num, companies in enumerate(shard_companies):
+            shard_dirs.append(f'{temp_dir}/{shard_num}')
+            os.makedirs(shard_dirs[-1])
+            invoices_shard = invoices[invoices.company_id.isin(companies)]
+            payments_shard = payments[payment_companies.isin(companies)]
+            _write_frame(invoices_shard, f'{shard_dirs[-1]}/invoices.arrow')
+            _write_frame(payments_shard, f'{shard_dirs[-1]}/payments.arrow')
+            shard_rows['invoices'].append(invoices_shard.__len__())
+            shard_rows['payments'].append(payments_shard.__len__())
+        prepared = list(executor.map(_prepare_shard, shard_dirs))
+        last_transaction_date = max((last_date for _, _, last_date in prepared if not pandas.isnull(last_date)),
+                                    default=pandas.NaT)
+        collected_dates = list(executor.map(_combine_shard, shard_dirs, [last_transaction_date] * n_shards))
+        collected_date_range = (min((first for first, _ in collected_dates if not pandas.isnull(first)),
+                                    default=pandas.NaT),
+                                max((last for _, last in collected_dates if not pandas.isnull(last)),
+                                    default=pandas.NaT))
+        featurized = list(executor.map(_featurize_shard, shard_dirs, [collected_date_range] * n_shards))
+        date_ranges = pandas.concat([ranges for _, ranges in featurized])
+        _check_forecast_date_ranges(pandas.DataFrame({'min': date_ranges.loc['min'].min(),
+                                                      'max': date_ranges.loc['max'].max()}).T)
+        feature_data = pandas.concat([_read_frame(f'{shard_dir}/feature_data.arrow') for shard_dir in shard_dirs])
+    feature_data = feature_data.sort_values(by='invoice_id', kind='stable').reset_index(drop=True)
+    preprocess_filter_stats = pandas.concat(OrderedDict([
+        ('payments', merge_filter_stats([stats for stats, _, _ in prepared], shard_rows['payments'])),
+        ('invoices', merge_filter_stats([stats for _, stats, _ in prepared], shard_rows['invoices']))]),
+        names=['Dataset', 'Step Num'])
+    post_process_filter_stats = merge_filter_stats(
+        [stats for stats, _ in featurized], [stats['Rows Filter Applied To'].iloc[0] for stats, _ in featurized])
+    return feature_data, preprocess_filter_stats, post_process_filter_stats
+
+
+def _test_featurize_by_company() -> (pandas.DataFrame, pandas.DataFrame, pandas.DataFrame):
+    """Test partitioned featurization on local CSV data."""
+    invoices, payments = get_csv_test_data()
+    return featurize_by_company(invoices, payments)
+
+
+if __name__ == "__main__":
+    pandas.set_option('expand_frame_repr', False)
+    data, preprocess_stats, post_process_stats = _test_featurize_by_company()
+    print(preprocess_stats)
+    print(post_process_stats)
+    print(data.shape)
@@ -1,89 +1,181 @@
+import numpy
 import pandas
 from collections import OrderedDict
-from predict_open_invoices.utils import apply_filters, months_between
+try:
+    import numba
+except ImportError:
+    numba = None
+from predict_open_invoices.utils import apply_filters, validate_columns
+from predict_open_invoices.profiling import profiled_stage
+from predict_open_invoices.dates import month_index, month_start, months_between
 from predict_open_invoices.csv_test_data_io import get_csv_test_data
 
 
+@profiled_stage
 def _prepare_payments(payments: pandas.DataFrame) -> (pandas.DataFrame, pandas.DataFrame):
     """ Validate raw payments data and filter out rows that will not be scored or used in model training."""
-    assert payments.invoice_id.count() == payments.__len__(), 'Missing invoice ids'
-    assert payments.transaction_date.count() == payments.__len__(), 'Missing transaction dates'
-    assert payments.root_exchange_rate_value.count() == payments.__len__(), 'Missing exchange rates'
-    assert payments.root_exchange_rate_value.min() > 0, 'Exchange rates <= 0'
-    assert payments.amount.min() > 0, 'Amounts <= 0'
+    validate_columns(payments,
+                     not_null=OrderedDict([('invoice_id', 'Missing invoice ids'),
+                                           ('transaction_date', 'Missing transaction dates'),
+                                           ('root_exchange_rate_value', 'Missing exchange rates')]),
+                     positive=OrderedDict([('root_exchange_rate_value', 'Exchange rates <= 0'),
+                                           ('amount', 'Amounts <= 0')]))
     assert (payments.amount.isnull() == payments.converted_amount.isnull()).min() == 1, \
         'Converted amounts populated inconsistently from amounts'
-    exclude_payments = OrderedDict({'Missing Amount': payments[payments.amount.isnull()]})
+    exclude_payments = OrderedDict({'Missing Amount': lambda payments: payments.amount.isnull()})
     return apply_filters(exclude_payments, payments)
 
 
 def _validate_invoices(invoices: pandas.DataFrame):
-    assert invoices.id.count() == invoices.__len__(), 'Missing IDs'
-    assert invoices.invoice_date.count() == invoices.__len__(), 'Missing invoice dates'
-    assert invoices.status.count() == invoices.__len__(), 'Missing statuses'
-    assert invoices.amount_inv.count() == invoices.__len__(), 'Missing amounts'
-    assert invoices.root_exchange_rate_value.count() == invoices.__len__(), 'Missing exchange rates'
-    assert invoices.currency.count() == invoices.__len__(), 'Missing currencies'
-    assert invoices.company_id.count() == invoices.__len__(), 'Missing company IDs'
-    assert invoices.customer_id.count() == invoices.__len__(), 'Missing customer IDs'
-    assert invoices.root_exchange_rate_value.min() > 0, 'Exchange rates <= 0'
-    assert invoices.amount_inv.min() > 0, 'Amounts <= 0'
+    validate_columns(invoices,
+                     not_null=OrderedDict([('id', 'Missing IDs'),
+                                           ('invoice_date', 'Missing invoice dates'),
+                                           ('status', 'Missing statuses'),
+                                           ('amount_inv', 'Missing amounts'),
+                                           ('root_exchange_rate_value', 'Missing exchange rates'),
+                                           ('currency', 'Missing currencies'),
+                                           ('company_id', 'Missing company IDs'),
+                                           ('customer_id', 'Missing customer IDs')]),
+                     positive=OrderedDict([('root_exchange_rate_value', 'Exchange rates <= 0'),
+                                           ('amount_inv', 'Amounts <= 0')]))
 
 
+@profiled_stage
 def _prepare_invoices(invoices: pandas.DataFrame) -> (pandas.DataFrame, pandas.DataFrame):
     """ Validate raw invoices data and filter out rows that will not be scored or used in model training."""
     _validate_invoices(invoices)
     invoices = invoices.rename(columns={"id": "invoice_id", "amount_inv": "amount"})\
         .drop(columns=['account_id'], errors='ignore')
     invoices.loc[invoices.status == 'OPEN', 'cleared_date'] = None
-    invoices['invoice_month'] = invoices.invoice_date.dt.to_period('M').dt.to_timestamp()
-    invoices['months_allowed'] = months_between(invoices.invoice_date, invoices.due_date)
+    invoice_month_index = month_index(invoices.invoice_date)
+    invoices['invoice_month'] = month_start(invoice_month_index)
+    invoices['months_allowed'] = months_between(invoice_month_index, invoices.due_date)
     exclude_invoices = OrderedDict()
-    exclude_invoices['Missing due date'] = invoices[invoices.due_date.isnull()]
-    exclude_invoices['Due before opened'] = invoices[invoices.due_date < invoices.invoice_date]
-    exclude_invoices['Due over 3 months after opened'] = invoices[invoices.months_allowed > 3]
+    exclude_invoices['Missing due date'] = lambda invoices: invoices.due_date.isnull()
+    exclude_invoices['Due before opened'] = lambda invoices: invoices.due_date < invoices.invoice_date
+    exclude_invoices['Due over 3 months after opened'] = lambda invoices: invoices.months_allowed > 3
     # filter out dates with high variation - TODO: Filter stats
-    exclude_invoices['Due before 2011-10'] = invoices.query("due_date<'2011-10-01'")
-    exclude_invoices['USD exchange rate out of range [0.7,1.3]'] = invoices[
-        (invoices.currency == 'USD') & (~invoices.root_exchange_rate_value.between(0.7, 1.3))]
-    exclude_invoices['Cleared < opened'] = invoices.query("cleared_date<invoice_date")
-    months_to_clear = months_between(invoices.invoice_date, invoices.cleared_date)
-    exclude_invoices['Cleared 13+ months after opened'] = invoices[months_to_clear > 12]
+    exclude_invoices['Due before 2011-10'] = lambda invoices: invoices.due_date < '2011-10-01'
+    exclude_invoices['USD exchange rate out of range [0.7,1.3]'] = \
+        lambda invoices: (invoices.currency == 'USD') & (~invoices.root_exchange_rate_value.between(0.7, 1.3))
+    exclude_invoices['Cleared < opened'] = lambda invoices: invoices.cleared_date < invoices.invoice_date
+    exclude_invoices['Cleared 13+ months after opened'] = \
+        lambda invoices: months_between(invoice_month_index, invoices.cleared_date) > 12
     invoices_filtered, filter_stats = apply_filters(exclude_invoices, invoices)
     return invoices_filtered, filter_stats
 
 
-def _combine_invoices_payments(invoices_prepared: pandas.DataFrame, payments_prepared: pandas.DataFrame) -> (
-        pandas.DataFrame, pandas.DataFrame):
+def _segmented_cumsum(values: numpy.ndarray, segments: numpy.ndarray) -> numpy.ndarray:
+    """Cumulative sum within contiguous segments, skipping NaN, with the compensated summation used by pandas
+    groupby cumsum so that results are identical."""
+    out = numpy.empty_like(values)
+    accum = compensation = 0.0
+    for i in range(len(values)):
+        if i == 0 or segments[i] != segments[i - 1]:
+            accum = compensation = 0.0
+        if numpy.isnan(values[i]):
+            out[i] = numpy.nan
+        else:
+            y = values[i] - compensation
+            t = accum + y
+            compensation = t - accum - y
+            accum = t
+            out[i] = t
+    return out
+
+
+if numba is not None:
+    _segmented_cumsum = numba.njit(cache=True)(_segmented_cumsum)
+
+
+def _cumulative_paid_pct(amount_pmt_pct: numpy.ndarray, invoice_codes: numpy.ndarray) -> numpy.ndarray:
+    """Cumulative percent paid per invoice on rows sorted by invoice, JIT-compiled if numba is installed."""
+    if numba is None:
+        return pandas.Series(amount_pmt_pct).groupby(invoice_codes, sort=False).cumsum().values
+    return _segmented_cumsum(amount_pmt_pct, invoice_codes)
+
+
+def _payment_values(values: numpy.ndarray, pmt_pos: numpy.ndarray, has_payment: numpy.ndarray) -> numpy.ndarray:
+    """Values of payment rows at merge positions, missing (NaN or NaT) for invoices without payments, which also
+    works when there are no payments at all."""
+    merged_values = numpy.full(pmt_pos.size, numpy.nan).astype(values.dtype)
+    merged_values[has_payment] = values[pmt_pos[has_payment]]
+    return merged_values
+
+
+@profiled_stage
+def _combine_invoices_payments(invoices_prepared: pandas.DataFrame, payments_prepared: pandas.DataFrame,
+                               last_transaction_date: pandas.Timestamp = None) -> (pandas.DataFrame, pandas.DataFrame):
     """ Merge, validate, and create combined variables from prepared invoice and payments data.
-    Output data has one row per invoice and cumulative amount paid, rounded to 4 decimal places."""
-    # consolidate invoices with payments
+    Output data has one row per invoice and cumulative amount paid, rounded to 4 decimal places.
+    Payment state is computed on narrow arrays sorted once by invoice and transaction date, and the wide output is
+    assembled once from the rows that are kept. The payments data end date defaults to the last matched transaction
+    and must be given when only part of the data is combined."""
     invoices_prepared['converted_amount'] = invoices_prepared.amount * invoices_prepared.root_exchange_rate_value
-    invoice_payments = invoices_prepared.merge(payments_prepared, on="invoice_id", suffixes=('_inv', '_pmt'),
-                                               how='left')
-    assert (invoice_payments.amount_pmt > invoice_payments.amount_inv).sum() == 0, 'Payment amount > invoice amount'
-    assert invoice_payments.dropna(subset=['company_id_pmt']).query("company_id_pmt!=company_id_inv").__len__() == 0, \
+    payments_prepared = payments_prepared.reset_index(drop=True)
+    # row positions of a left merge of invoices with payments, in merge order
+    merged_positions = pandas.DataFrame({'invoice_id': invoices_prepared.invoice_id.values,
+                                         'inv_pos': numpy.arange(invoices_prepared.__len__())})\
+        .merge(pandas.DataFrame({'invoice_id': payments_prepared.invoice_id.values,
+                                 'pmt_pos': numpy.arange(payments_prepared.__len__())}), on="invoice_id", how='left')
+    inv_pos = merged_positions.inv_pos.values
+    pmt_pos = merged_positions.pmt_pos.fillna(-1).astype(numpy.int64).values
+    has_payment = pmt_pos >= 0
+    amount_inv = invoices_prepared.amount.values[inv_pos]
+    amount_pmt = _payment_values(payments_prepared.amount.values.astype(numpy.float64), pmt_pos, has_payment)
+    assert (amount_pmt > amount_inv).sum() == 0, 'Payment amount > invoice amount'
+    assert (invoices_prepared.company_id.values[inv_pos[has_payment]] !=
+            payments_prepared.company_id.values[pmt_pos[has_payment]]).sum() == 0, \
         'Company does not match between payments and invoices'
-    last_transaction_date = invoice_payments.transaction_date.max()
+    transaction_date = _payment_values(payments_prepared.transaction_date.values.astype('datetime64[ns]'), pmt_pos,
+                                       has_payment)
     # invoices with no transactions: use payments data end date as date of 0 amount
-    invoice_payments.transaction_date = invoice_payments.transaction_date.fillna(last_transaction_date)
-    invoice_payments['final_date_open'] = invoice_payments.cleared_date.map(
-        lambda cleared_date: min(cleared_date, last_transaction_date)).fillna(last_transaction_date)
-    invoice_payments = invoice_payments.rename(columns={"company_id_inv": "company_id"})\
-        .drop(columns=['company_id_pmt']).sort_values(by=['invoice_id', 'transaction_date'])
-    invoice_payments['amount_pmt_pct'] = (invoice_payments.amount_pmt / invoice_payments.amount_inv)
+    if last_transaction_date is None and has_payment.any():
+        last_transaction_date = transaction_date[has_payment].max()
+    last_transaction_date = numpy.datetime64('NaT' if pandas.isnull(last_transaction_date) else last_transaction_date,
+                                             'ns')
+    transaction_date = numpy.where(has_payment, transaction_date, last_transaction_date)
+    # sort once by invoice id and transaction date, keeping merge order for ties
+    invoice_ranks = pandas.factorize(invoices_prepared.invoice_id.values[inv_pos], sort=True)[0]
+    order = numpy.lexsort((transaction_date, invoice_ranks))
+    invoice_ranks, transaction_date = invoice_ranks[order], transaction_date[order]
+    amount_pmt_pct = amount_pmt[order] / amount_inv[order]
     # round to eliminate the impact of negligible payments. hence, an invoice is "collected" when paid > 99.99%.
-    invoice_payments['amount_pmt_pct_cum'] = invoice_payments.groupby("invoice_id").amount_pmt_pct.cumsum()\
-        .fillna(0).round(4)
+    amount_pmt_pct_cum = numpy.nan_to_num(_cumulative_paid_pct(amount_pmt_pct, invoice_ranks)).round(4)
     # small percent of payments represent overpayments - filter out
-    invoice_payments = invoice_payments[invoice_payments.amount_pmt_pct_cum <= 1].copy()
+    keep = amount_pmt_pct_cum <= 1
+    order, invoice_ranks, transaction_date = order[keep], invoice_ranks[keep], transaction_date[keep]
+    amount_pmt_pct, amount_pmt_pct_cum = amount_pmt_pct[keep], amount_pmt_pct_cum[keep]
     # dedupe by invoice id and payment date, using the last transaction for each
-    invoice_payments.drop_duplicates(subset=['invoice_id', 'transaction_date'], keep='last', inplace=True)
-    # dedupe by invoice id and cumulative amount paid, using the first transaction for each (dupes are very rare)
-    invoice_payments.drop_duplicates(subset=['invoice_id', 'amount_pmt_pct_cum'], keep='first', inplace=True)
+    same_as_next = numpy.append((invoice_ranks[1:] == invoice_ranks[:-1]) &
+                                (transaction_date[1:] == transaction_date[:-1]), False)
+    # dedupe by invoice id and cumulative amount paid, using the first transaction for each (dupes are very rare).
+    # cumulative amounts are non-decreasing per invoice, so duplicates are adjacent.
+    keep = ~same_as_next
+    invoice_ranks, amount_pmt_pct_cum = invoice_ranks[keep], amount_pmt_pct_cum[keep]
+    same_as_previous = numpy.insert((invoice_ranks[1:] == invoice_ranks[:-1]) &
+                                    (amount_pmt_pct_cum[1:] == amount_pmt_pct_cum[:-1]), 0, False)
+    keep[keep] = ~same_as_previous
+    order, transaction_date, amount_pmt_pct = order[keep], transaction_date[keep], amount_pmt_pct[keep]
+    amount_pmt_pct_cum = amount_pmt_pct_cum[~same_as_previous]
+    # assemble the merged output once, for the rows that were kept
+    overlapping = [col for col in invoices_prepared.columns if col in payments_prepared.columns and col != 'invoice_id']
+    invoice_part = invoices_prepared.take(inv_pos[order])\
+        .rename(columns={col: col + '_inv' for col in overlapping}).reset_index(drop=True)
+    payment_part = payments_prepared.drop(columns=['invoice_id']).reindex(pmt_pos[order])\
+        .rename(columns={col: col + '_pmt' for col in overlapping}).reset_index(drop=True)
+    payment_part['transaction_date'] = transaction_date
+    invoice_payments = pandas.concat([invoice_part, payment_part], axis=1).set_index(order)
+    invoice_payments['final_date_open'] = invoice_payments.cleared_date.clip(upper=last_transaction_date)\
+        .fillna(last_transaction_date)
+    invoice_payments = invoice_payments.rename(columns={"company_id_inv": "company_id"})\
+        .drop(columns=['company_id_pmt'])
+    invoice_payments['amount_pmt_pct'] = amount_pmt_pct
+    invoice_payments['amount_pmt_pct_cum'] = amount_pmt_pct_cum
     return invoice_payments
 
 
+@profiled_stage
 def preprocess_invoices_with_payments(invoices: pandas.DataFrame, payments: pandas.DataFrame) -> \
         (pandas.DataFrame, OrderedDict):
     """ Takes raw invoices and payments separately and prepares them for feature engineering.
@@ -1,54 +1,101 @@
 import os
-import tempfile
-import numpy
+import logging
 import h2o
 import pandas
-import neptune
-from predict_open_invoices import NEPTUNE_PROJECT_NAME, NEPTUNE_MODEL_ID
+from predict_open_invoices import MODEL_REGISTRY_FOLDER
+from predict_open_invoices.utils import get_h2o_frame
+from predict_open_invoices.h2o_frames import download_frame, remove_frames
 from predict_open_invoices.csv_test_data_io import get_csv_test_data
 from predict_open_invoices.pre_processing import preprocess_invoices_with_payments
 from predict_open_invoices.feature_engineering import feature_engineering
-h2o.init(nthreads=-1, max_mem_size=12)
-NEPTUNE_PROJECT = neptune.init_project(project=NEPTUNE_PROJECT_NAME, api_token=os.getenv('NEPTUNE_API_TOKEN'))
-NEPTUNE_PROJECT_ID = NEPTUNE_PROJECT['sys/id'].fetch()
-
-
-def _get_best_model(sort_column: str = 'monthly_mape_test') -> h2o.estimators.H2OEstimator:
-    """Pick the model version from neptune that minimizes the mean absolute percentage diff between
-     monthly amount collected (normalized by company) and monthly amount forecasted on test data."""
-    neptune_model = neptune.init_model(with_id=f"{NEPTUNE_PROJECT_ID}-{NEPTUNE_MODEL_ID}", project=NEPTUNE_PROJECT_NAME)
-    neptune_model.sync()
-    model_versions_table = neptune_model.fetch_model_versions_table().to_pandas()
-    best_column_value = model_versions_table.sort_values(by=sort_column).iloc[0][sort_column]
-    best_model_info = model_versions_table[model_versions_table[sort_column] == best_column_value]\
-        .sort_values(by='test_metric/r2', ascending=False).iloc[0]
-    print(best_model_info)
-    best_model_version = neptune.init_model_version(with_id=best_model_info['sys/id'], project=NEPTUNE_PROJECT_NAME)
-    temp_path = tempfile.NamedTemporaryFile().file.name
-    best_model_version['model_file'].download(temp_path)
-    best_model = h2o.load_model(temp_path)
-    return best_model
-
-
-def predict(invoice_features: pandas.DataFrame, model: h2o.estimators.H2OEstimator) -> pandas.Series:
+from predict_open_invoices.stage_cache import cached_stage
+from predict_open_invoices.profiling import profiled_stage
+from predict_open_invoices.model_registry import best_version, sync_from_neptune, fetch_model_file, load_model, \
+    response_column, LATEST_FOLD_SORT
+from predict_open_invoices.lookup_scorer import compile_lookup_table, lookup_predict, save_lookup_table, \
+    load_lookup_table
+# response column of models that predict the share of the invoice collected per month, rather than the month collected
+RATE_RESPONSE = 'collected_per_month'
+LOGGER = logging.getLogger(__name__)
+
+
+@profiled_stage
+def _get_best_model(sort_column: str = LATEST_FOLD_SORT, sync: bool = False) -> h2o.estimators.H2OEstimator:
+    """Pick the model version that minimizes the mean absolute percentage diff between monthly amount collected
+    (normalized by company) and monthly amount forecasted on test data, or by default on the latest forecast date
+    fold for versions scored on it by retraining. Versions are looked up in the local model registry, which is synced
+    from neptune when empty or when sync is set, and loaded models are reused."""
+    version_id = best_version_id(sort_column, sync)
+    LOGGER.info(f'Best model version: {version_id}')
+    return load_model(version_id)
+
+
+def best_version_id(sort_column: str = LATEST_FOLD_SORT, sync: bool = False) -> str:
+    """Id of the best registered model version by sort_column, syncing the registry from neptune when it is empty or
+    when sync is set. The model file of the best version is fetched, and versions without one are passed over."""
+    if sync or best_version(sort_column) is None:
+        sync_from_neptune()
+    version_id = best_version(sort_column)
+    while version_id is not None and fetch_model_file(version_id) is None:
+        version_id = best_version(sort_column)
+    assert version_id is not None, 'No model versions registered'
+    return version_id
+
+
+def _get_best_lookup_table(predictors: list[str], sort_column: str = LATEST_FOLD_SORT) -> dict:
+    """Lookup table of the best model version, compiled from the model and saved in the model registry on first use,
+    or again if it was saved without the model's response column. Once saved, no H2O cluster is needed to score with
+    it."""
+    version_id = best_version_id(sort_column)
+    lookup_table_path = f'{MODEL_REGISTRY_FOLDER}/{version_id}.lookup.npz'
+    if not os.path.exists(lookup_table_path) or load_lookup_table(lookup_table_path)['response_column'] is None:
+        lookup_table = compile_lookup_table(load_model(version_id), predictors)
+        LOGGER.info(f"Lookup table max error: {lookup_table['max_error']}")
+        save_lookup_table(lookup_table, lookup_table_path)
+    return load_lookup_table(lookup_table_path)
+
+
+@profiled_stage
+def predict(invoice_features: pandas.DataFrame, model: h2o.estimators.H2OEstimator,
+            invoices_h2o: h2o.H2OFrame = None) -> pandas.Series:
     """Predict month collected relative to forecast date on set of invoices and payments summarized up to the point
-    in time being forecasted"""
-    invoice_features_h2o = h2o.H2OFrame(invoice_features)
-    predictions = model.predict(invoice_features_h2o).as_data_frame()['predict']
-    # predictions represent collection rates
-    if predictions.min() == 0:
-        return (1 / predictions).replace(numpy.inf, None).round(0)
-    # predictions represent future month collected
+    in time being forecasted. The invoices are uploaded unless invoices_h2o, the same invoices already in H2O, is
+    given. Predictions, and invoices uploaded here, are removed from the cluster afterwards."""
+    uploaded_h2o = [get_h2o_frame(invoice_features, reuse=False)] if invoices_h2o is None else []
+    invoices_h2o = uploaded_h2o[0] if uploaded_h2o else invoices_h2o
+    assert invoices_h2o.nrow == invoice_features.__len__(), 'H2O frame does not match invoice features'
+    predictions_h2o = model.predict(invoices_h2o)
+    predictions = download_frame(predictions_h2o)['predict']
+    remove_frames(predictions_h2o, *uploaded_h2o)
+    return _predictions_to_months(predictions, response_column(model))
+
+
+def predict_with_lookup_table(invoice_features: pandas.DataFrame, lookup_table: dict) -> pandas.Series:
+    """Predict like predict, from a lookup table compiled from the model, without H2O."""
+    return _predictions_to_months(pandas.Series(lookup_predict(lookup_table, invoice_features), name='predict'),
+                                  lookup_table['response_column'])
+
+
+def _predictions_to_months(predictions: pandas.Series, response: str) -> pandas.Series:
+    """Month collected relative to the forecast date from model predictions, converted per invoice so that it does not
+    depend on the other invoices scored with it. Collection rates give the reciprocal of the rate, missing where the
+    rate is not positive (never collected), and predicted months are rounded."""
+    if response == RATE_RESPONSE:
+        rates = predictions.astype(float)
+        return (1 / rates.where(rates > 0)).round(0)
     return predictions.round(0).astype(int)
 
 
+@profiled_stage
 def _test_prediction_on_open_invoices(invoices_raw: pandas.DataFrame, payments_raw: pandas.DataFrame) \
         -> pandas.DataFrame:
     """Given raw input datasets, return OPEN invoices with feature data and predictions"""
-    invoices_with_payments, preprocess_filter_stats = preprocess_invoices_with_payments(invoices_raw, payments_raw)
+    invoices_with_payments, preprocess_filter_stats = cached_stage(preprocess_invoices_with_payments)(invoices_raw,
+                                                                                                      payments_raw)
     open_invoices_with_payments = invoices_with_payments.query("status=='OPEN'").copy()
     open_invoices_with_payments['forecast_date'] = payments_raw.transaction_date.max()
-    open_invoices_feature_data = feature_engineering(open_invoices_with_payments.query("forecast_date>=invoice_date"))
+    open_invoices_feature_data = cached_stage(feature_engineering)(
+        open_invoices_with_payments.query("forecast_date>=invoice_date"))
     assert open_invoices_feature_data.invoice_id.value_counts().max() == 1, 'Duplicates per open invoice'
     model = _get_best_model()
     return predict(open_invoices_feature_data, model)
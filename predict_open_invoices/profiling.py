@@ -0,0 +1,105 @@
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+from collections import OrderedDict
+import pandas
+from predict_open_invoices import PROFILING
+PROFILE_COLUMNS = ['Stage', 'Bad Data', 'Rows In', 'Rows Out', 'Wall (s)', 'CPU (s)', 'Peak RSS Delta (MB)']
+# one record per profiled stage run or filter rule, in the order they started
+PROFILE_RECORDS = []
+PROFILING_ENABLED = PROFILING
+# names of the stages running in each thread, outermost first
+_STAGE_PATHS = threading.local()
+
+
+def enable_profiling(enabled: bool = True):
+    global PROFILING_ENABLED
+    PROFILING_ENABLED = enabled
+
+
+def profiling_enabled() -> bool:
+    return PROFILING_ENABLED
+
+
+def reset_profile():
+    PROFILE_RECORDS.clear()
+
+
+def _peak_rss_mb() -> float:
+    """High-water mark of the process resident set size, which getrusage reports in bytes on macOS and KB elsewhere."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def _rows(value) -> int:
+    """Rows of a data frame or series, or of the first one in a tuple of outputs."""
+    if isinstance(value, tuple):
+        return _rows(value[0]) if value else None
+    return value.__len__() if isinstance(value, (pandas.DataFrame, pandas.Series)) else None
+
+
+@contextlib.contextmanager
+def profile(stage_name: str, rows_in: int = None, bad_data: str = None):
+    """Record wall time, CPU time of the process, growth of its peak RSS and rows in of a block of pipeline code under
+    the path of the stages it runs in. Rows out are set on the yielded record. Filter rules are recorded with the
+    name of their step in filter_stats as bad_data. Does nothing unless profiling is enabled."""
+    if not PROFILING_ENABLED:
+        yield OrderedDict()
+        return
+    stage_path = getattr(_STAGE_PATHS, 'path', [])
+    _STAGE_PATHS.path = stage_path + [stage_name]
+    record = OrderedDict([('Stage', '/'.join(_STAGE_PATHS.path)), ('Bad Data', bad_data), ('Rows In', rows_in),
+                          ('Rows Out', None)])
+    PROFILE_RECORDS.append(record)
+    start_rss_mb, start_wall, start_cpu = _peak_rss_mb(), time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['Wall (s)'] = time.perf_counter() - start_wall
+        record['CPU (s)'] = time.process_time() - start_cpu
+        record['Peak RSS Delta (MB)'] = _peak_rss_mb() - start_rss_mb
+        _STAGE_PATHS.path = stage_path
+
+
+def profiled_stage(stage):
+    """Wrap a pipeline stage so that its runs are profiled when profiling is enabled, with the rows of its data frame
+    inputs and of its (first) output. When disabled, the only overhead is a flag check per call."""
+    @functools.wraps(stage)
+    def profiled(*args, **kwargs):
+        if not PROFILING_ENABLED:
+            return stage(*args, **kwargs)
+        rows_in = [_rows(value) for value in list(args) + list(kwargs.values()) if _rows(value) is not None]
+        with profile(stage.__name__, sum(rows_in) if rows_in else None) as record:
+            output = stage(*args, **kwargs)
+            record['Rows Out'] = _rows(output)
+        return output
+    return profiled
+
+
+def profile_report() -> pandas.DataFrame:
+    return pandas.DataFrame(PROFILE_RECORDS, columns=PROFILE_COLUMNS)
+
+
+def join_filter_stats(filter_stats: pandas.DataFrame, report: pandas.DataFrame) -> pandas.DataFrame:
+    """Add the cost of each filter rule to a filter_stats report, summed over the runs of the rule."""
+    rule_costs = report.dropna(subset=['Bad Data']).groupby('Bad Data', sort=False)[
+        ['Wall (s)', 'CPU (s)', 'Peak RSS Delta (MB)']].sum()
+    return filter_stats.join(rule_costs, on='Bad Data')
+
+
+def save_profile_report(path: str, report: pandas.DataFrame = None):
+    report = profile_report() if report is None else report
+    with open(path, 'w') as report_file:
+        json.dump(json.loads(report.to_json(orient='records')), report_file, indent=2)
+
+
+def log_profile_report(neptune_object, report: pandas.DataFrame = None, key: str = 'profiling'):
+    """Log a profile report to a neptune run, model or model version, as a table and as total wall time per stage."""
+    from neptune.types import File
+    report = profile_report() if report is None else report
+    neptune_object[f'{key}/report'].upload(File.as_html(report))
+    for stage, wall_secs in report[report['Bad Data'].isnull()].groupby('Stage', sort=False)['Wall (s)'].sum().items():
+        neptune_object[f'{key}/wall_secs/{stage}'] = wall_secs
@@ -0,0 +1,161 @@
+import time
+import keyword
+import inspect
+import tempfile
+from collections import OrderedDict
+import numpy
+import h2o
+import pandas
+from predict_open_invoices.dates import month_index
+from predict_open_invoices.utils import get_h2o_frame
+from predict_open_invoices.h2o_frames import remove_frames
+from predict_open_invoices.training import get_training_frame_from_csvs, train_model
+from predict_open_invoices.evaluation_on_csv_data import get_monthly_forecast_errors
+from predict_open_invoices.prediction import best_version_id
+from predict_open_invoices.model_registry import load_model, register_model_version, record_fold_score, \
+    response_column, LATEST_FOLD_SORT
+from predict_open_invoices.tracking import start_model_version, log_values, log_file, close_model_version
+# H2O algorithms that can continue training from a checkpoint, with the parameter that counts their iterations
+CHECKPOINT_ITERATIONS = OrderedDict([('gbm', 'ntrees'), ('drf', 'ntrees'), ('xgboost', 'ntrees'),
+                                     ('deeplearning', 'epochs')])
+ESTIMATOR_CLASSES = OrderedDict([('gbm', 'H2OGradientBoostingEstimator'), ('drf', 'H2ORandomForestEstimator'),
+                                 ('xgboost', 'H2OXGBoostEstimator'), ('deeplearning', 'H2ODeepLearningEstimator'),
+                                 ('glm', 'H2OGeneralizedLinearEstimator')])
+# parameters of the incumbent that are set per training run rather than carried over
+RUN_PARAMS = ['model_id', 'training_frame', 'validation_frame', 'response_column', 'ignored_columns', 'checkpoint',
+              'weights_column', 'fold_column', 'nfolds', 'fold_assignment', 'keep_cross_validation_models',
+              'keep_cross_validation_predictions', 'keep_cross_validation_fold_assignment', 'max_runtime_secs',
+              'export_checkpoints_dir']
+
+
+def _model_columns(model: h2o.estimators.H2OEstimator) -> (list[str], str, str):
+    """Predictors, response and weights column a model was trained with."""
+    y = response_column(model)
+    weights_column = model.actual_params.get('weights_column')
+    weights_column = weights_column['column_name'] if isinstance(weights_column, dict) else weights_column
+    predictors = [name for name in model._model_json['output']['names'] if name not in [y, weights_column]]
+    return predictors, y, weights_column
+
+
+def _iterations_done(model: h2o.estimators.H2OEstimator) -> float:
+    """Trees built by a tree model, which may be fewer than ntrees after early stopping, or epochs trained by a deep
+    learning model."""
+    if model.algo == 'deeplearning':
+        return float(model.scoring_history()['epochs'].max())
+    return int(model._model_json['output']['model_summary']['number_of_trees'][0])
+
+
+def _warm_start_estimator(model: h2o.estimators.H2OEstimator, extra_iterations: int,
+                          max_runtime_secs: int) -> (h2o.estimators.H2OEstimator, str):
+    """Estimator with the incumbent's algorithm and hyperparameters that continues from the incumbent's checkpoint
+    for extra_iterations trees or epochs, or that refits the incumbent's hyperparameters when its algorithm has no
+    checkpoints. Returns None for algorithms that cannot be rebuilt from parameters, such as stacked ensembles."""
+    if model.algo not in ESTIMATOR_CLASSES:
+        return None, 'automl'
+    estimator_class = getattr(h2o.estimators, ESTIMATOR_CLASSES[model.algo])
+    accepted = inspect.signature(estimator_class.__init__).parameters
+    params = OrderedDict()
+    for name, value in model.actual_params.items():
+        # python keywords are suffixed in estimator arguments, e.g. lambda_
+        argument = f'{name}_' if keyword.iskeyword(name) else name
+        if name not in RUN_PARAMS and argument in accepted and not isinstance(value, dict):
+            params[argument] = value
+    params['max_runtime_secs'] = max_runtime_secs
+    if model.algo not in CHECKPOINT_ITERATIONS:
+        return estimator_class(**params), 'refit'
+    params['checkpoint'] = model.model_id
+    params[CHECKPOINT_ITERATIONS[model.algo]] = _iterations_done(model) + extra_iterations
+    return estimator_class(**params), 'checkpoint'
+
+
+def _compare_on_fold(models: OrderedDict, fold_df: pandas.DataFrame, metric: str) -> pandas.DataFrame:
+    """Company-weighted monthly MAPE, the ML metric and R2 of each model on one forecast date fold, uploaded once."""
+    fold_h2o = get_h2o_frame(fold_df, reuse=False)
+    comparison = OrderedDict()
+    for name, model in models.items():
+        performance = model.model_performance(fold_h2o)
+        comparison[name] = OrderedDict([
+            ('monthly_mape', float(get_monthly_forecast_errors(OrderedDict([('fold', fold_df)]), model,
+                                                               fold_h2o)['fold'])),
+            (metric, performance[metric]), ('r2', performance['r2'])])
+    remove_frames(fold_h2o)
+    return pandas.DataFrame(comparison).T
+
+
+def retrain_incremental(training_data: pandas.DataFrame = None, new_months: int = 1, extra_iterations: int = 50,
+                        max_runtime_secs: int = 60, metric: str = 'mae', sort_column: str = LATEST_FOLD_SORT,
+                        register: bool = True) -> (h2o.estimators.H2OEstimator, OrderedDict):
+    """Update the best registered model with the newest forecast months instead of rerunning AutoML over the whole
+    history. The latest forecast date fold is held out, and the new_months forecast months before it are the new
+    training rows. Tree and deep learning models continue training from their checkpoint on the new rows, models
+    without checkpoints are refit with the same hyperparameters on the new rows, and stacked ensembles are replaced by
+    a short AutoML run on all rows before the held out fold. The challenger is promoted if its monthly MAPE on the held
+    out fold beats the incumbent's: it is logged and registered without test metrics, since its training rows may
+    overlap the test fold, and the scores of both on the held out fold are recorded in the registry next to the test
+    metrics. Best model selection by LATEST_FOLD_SORT then compares versions on that fold only."""
+    if training_data is None:
+        training_data, _ = get_training_frame_from_csvs()
+    incumbent_id = best_version_id(sort_column)
+    incumbent = load_model(incumbent_id)
+    predictors, y, weights_column = _model_columns(incumbent)
+    forecast_months = month_index(training_data.forecast_date).to_numpy(dtype=numpy.int64)
+    is_holdout = (training_data.forecast_date_fold == training_data.forecast_date_fold.max()).values
+    first_holdout_month = forecast_months[is_holdout].min()
+    fold_date = training_data.forecast_date[is_holdout].max()
+    is_new = ~is_holdout & (forecast_months >= first_holdout_month - new_months) \
+        & (forecast_months < first_holdout_month)
+    assert is_new.any(), 'No new forecast months before the latest fold'
+    timer = time.perf_counter()
+    estimator, mode = _warm_start_estimator(incumbent, extra_iterations, max_runtime_secs)
+    if estimator is None:
+        challenger = train_model(get_h2o_frame(training_data[~is_holdout & (forecast_months < first_holdout_month)]),
+                                 get_h2o_frame(training_data[is_new]), predictors, metric, y,
+                                 incumbent.actual_params.get('distribution', 'huber'), max_runtime_secs)
+    else:
+        estimator.train(x=predictors, y=y, training_frame=get_h2o_frame(training_data[is_new]),
+                        weights_column=weights_column)
+        challenger = estimator
+    train_secs = time.perf_counter() - timer
+    comparison = _compare_on_fold(OrderedDict([('incumbent', incumbent), ('challenger', challenger)]),
+                                  training_data[is_holdout], metric)
+    promoted = comparison.monthly_mape['challenger'] < comparison.monthly_mape['incumbent']
+    report = OrderedDict([('incumbent_version', incumbent_id), ('algo', incumbent.algo), ('mode', mode),
+                          ('fold_date', str(fold_date.date())), ('new_rows', int(is_new.sum())),
+                          ('holdout_rows', int(is_holdout.sum())), ('train_secs', train_secs),
+                          ('promoted', bool(promoted)), ('version_id', None)])
+    for name, scores in comparison.iterrows():
+        report.update((f'{name}_{score}', float(value)) for score, value in scores.items())
+    if promoted and register:
+        report['version_id'] = _register_challenger(challenger, report, metric)
+        for name, version_id in [('incumbent', incumbent_id), ('challenger', report['version_id'])]:
+            record_fold_score(version_id, fold_date, report[f'{name}_monthly_mape'], report[f'{name}_r2'])
+    return challenger, report
+
+
+def _register_challenger(challenger: h2o.estimators.H2OEstimator, report: OrderedDict, metric: str) -> str:
+    """Log a promoted challenger as a model version with its warm start and comparison, and register it."""
+    version_key = start_model_version()
+    log_values(version_key, OrderedDict([('parent_version', report['incumbent_version']),
+                                         ('warm_start', report['mode']), ('algo', challenger.algo),
+                                         ('new_rows', report['new_rows']), ('fold_date', report['fold_date']),
+                                         ('train_secs', report['train_secs']),
+                                         ('monthly_mape_latest_fold', report['challenger_monthly_mape']),
+                                         ('incumbent_monthly_mape_latest_fold', report['incumbent_monthly_mape']),
+                                         (f'latest_fold_metric/{metric}', report[f'challenger_{metric}']),
+                                         ('latest_fold_metric/r2', report['challenger_r2'])]))
+    model_path = h2o.save_model(model=challenger, path=tempfile.TemporaryDirectory().name, force=True)
+    log_file(version_key, 'model_file', model_path)
+    close_model_version(version_key)
+    register_model_version(version_key, model_path, None, None)
+    return version_key
+
+
+def _test_incremental_retraining() -> OrderedDict:
+    """Warm-start the best registered model on the newest month of the local CSV training data, without registering
+    the challenger."""
+    _, report = retrain_incremental(register=False)
+    return report
+
+
+if __name__ == "__main__":
+    print(_test_incremental_retraining())
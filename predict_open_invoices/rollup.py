@@ -0,0 +1,182 @@
+import time
+from collections import OrderedDict
+import numpy
+import pandas
+from predict_open_invoices.dates import month_index, month_start
+# totals kept per company, currency and collection month
+TOTAL_COLUMNS = ['converted_amount', 'amount', 'invoices']
+
+
+def _empty_rollup() -> dict:
+    """Rollup of no invoices. Totals have one row per company and currency, one column per collection month from
+    first_month, and a last column for invoices with no predicted collection month."""
+    return dict(groups=pandas.MultiIndex.from_arrays([[], []], names=['company_id', 'currency']),
+                invoice_index=pandas.Index([], dtype=object, name='invoice_id'),
+                invoice_groups=numpy.zeros(0, dtype=numpy.int64), invoice_months=numpy.zeros(0),
+                invoice_converted=numpy.zeros(0), invoice_amounts=numpy.zeros(0), first_month=None,
+                totals=numpy.zeros((TOTAL_COLUMNS.__len__(), 0, 1)))
+
+
+def _collection_months(features: pandas.DataFrame, predicted_months: pandas.Series) -> numpy.ndarray:
+    """Month index of the predicted collection month of each invoice, NaN where no collection is predicted. Predicted
+    months count from the forecast month, which is month 1."""
+    predicted = pandas.to_numeric(pandas.Series(numpy.asarray(predicted_months))).to_numpy(float)
+    return month_index(features.forecast_date).to_numpy(dtype=float, na_value=numpy.nan) + predicted - 1
+
+
+def _resize_totals(rollup: dict, n_groups: int, months: numpy.ndarray):
+    """Grow the totals to n_groups rows and to the month columns needed for the given collection months."""
+    totals, first_month = rollup['totals'], rollup['first_month']
+    months = months[~numpy.isnan(months)]
+    n_months = totals.shape[2] - 1
+    if months.size:
+        new_first = int(months.min()) if first_month is None else min(first_month, int(months.min()))
+        new_last = int(months.max()) if first_month is None else max(first_month + n_months - 1, int(months.max()))
+    else:
+        new_first, new_last = first_month, (first_month or 0) + n_months - 1
+    new_months = new_last - new_first + 1 if new_first is not None else 0
+    if n_groups == totals.shape[1] and new_months == n_months:
+        return
+    resized = numpy.zeros((totals.shape[0], n_groups, new_months + 1))
+    if n_months:
+        offset = first_month - new_first
+        resized[:, :totals.shape[1], offset:offset + n_months] = totals[:, :, :n_months]
+    resized[:, :totals.shape[1], -1] = totals[:, :, -1]
+    rollup['totals'], rollup['first_month'] = resized, new_first
+
+
+def _accumulate(rollup: dict, groups: numpy.ndarray, months: numpy.ndarray, converted: numpy.ndarray,
+                amounts: numpy.ndarray, sign: int):
+    """Add (sign 1) or remove (sign -1) the contributions of invoices to the totals, aggregating by cell with bincount
+    over the cells they fall in only."""
+    if groups.size == 0:
+        return
+    totals = rollup['totals']
+    n_columns = totals.shape[2]
+    columns = numpy.where(numpy.isnan(months), n_columns - 1, numpy.nan_to_num(months) - (rollup['first_month'] or 0))
+    cells, cell_invoices = numpy.unique(groups * n_columns + columns.astype(numpy.int64), return_inverse=True)
+    flat_totals = totals.reshape(totals.shape[0], -1)
+    for total, weights in enumerate([converted, amounts, numpy.ones(groups.size)]):
+        flat_totals[total, cells] += sign * numpy.bincount(cell_invoices, weights, minlength=cells.size)
+
+
+def update_rollup(rollup: dict, features: pandas.DataFrame, predicted_months: pandas.Series) -> dict:
+    """Apply predictions of rescored or new OPEN invoices to a rollup in place: the previous contributions of rescored
+    invoices are removed and the remaining amounts of all given invoices are added at their predicted collection
+    months. Predictions are aligned by position with the features, as returned by predict."""
+    assert features.invoice_id.is_unique, 'Duplicate invoices in rescored features'
+    assert features.__len__() == predicted_months.__len__(), 'Predictions do not match features'
+    positions = rollup['invoice_index'].get_indexer(features.invoice_id.values)
+    known = positions >= 0
+    _accumulate(rollup, rollup['invoice_groups'][positions[known]], rollup['invoice_months'][positions[known]],
+                rollup['invoice_converted'][positions[known]], rollup['invoice_amounts'][positions[known]], -1)
+    keys = pandas.MultiIndex.from_arrays([features.company_id.astype(str).values,
+                                          features.currency.astype(str).values], names=rollup['groups'].names)
+    new_keys = keys[rollup['groups'].get_indexer(keys) < 0].unique()
+    if new_keys.__len__():
+        rollup['groups'] = rollup['groups'].append(new_keys)
+    groups = rollup['groups'].get_indexer(keys).astype(numpy.int64)
+    months = _collection_months(features, predicted_months)
+    amounts = (features.amount * features.remaining_inv_pct).to_numpy(float)
+    converted = amounts * features.root_exchange_rate_value.to_numpy(float)
+    for column, values in [('invoice_groups', groups), ('invoice_months', months), ('invoice_converted', converted),
+                           ('invoice_amounts', amounts)]:
+        rollup[column][positions[known]] = values[known]
+        rollup[column] = numpy.concatenate([rollup[column], values[~known]])
+    if not known.all():
+        rollup['invoice_index'] = rollup['invoice_index'].append(pandas.Index(features.invoice_id.values[~known]))
+    _resize_totals(rollup, rollup['groups'].__len__(), months)
+    _accumulate(rollup, groups, months, converted, amounts, 1)
+    return rollup
+
+
+def build_rollup(features: pandas.DataFrame, predicted_months: pandas.Series) -> dict:
+    """Expected collections of OPEN invoices per company, currency and month, from their point-in-time features and
+    the months predicted by predict. Each invoice contributes its remaining amount, in its own currency and converted
+    at its root exchange rate, to its predicted collection month."""
+    return update_rollup(_empty_rollup(), features, predicted_months)
+
+
+def remove_invoices(rollup: dict, invoice_ids: list[str]) -> dict:
+    """Remove invoices that are no longer OPEN from a rollup in place."""
+    positions = rollup['invoice_index'].get_indexer(pandas.Index(invoice_ids).unique())
+    positions = positions[positions >= 0]
+    _accumulate(rollup, rollup['invoice_groups'][positions], rollup['invoice_months'][positions],
+                rollup['invoice_converted'][positions], rollup['invoice_amounts'][positions], -1)
+    keep = numpy.ones(rollup['invoice_index'].__len__(), dtype=bool)
+    keep[positions] = False
+    for column in ['invoice_groups', 'invoice_months', 'invoice_converted', 'invoice_amounts']:
+        rollup[column] = rollup[column][keep]
+    rollup['invoice_index'] = rollup['invoice_index'][keep]
+    return rollup
+
+
+def rollup_frame(rollup: dict, by_currency: bool = True) -> pandas.DataFrame:
+    """Expected collections per company, currency if by_currency, and collection month, with a missing collection
+    month for invoices with no predicted collection. Amounts in invoice currency are only summed per currency."""
+    totals, groups = rollup['totals'], rollup['groups']
+    if not by_currency:
+        company_codes, companies = pandas.factorize(groups.get_level_values('company_id'))
+        n_columns = totals.shape[2]
+        cells = (company_codes[:, None] * n_columns + numpy.arange(n_columns)).ravel()
+        totals = numpy.stack([numpy.bincount(cells, total.ravel(), minlength=companies.size * n_columns)
+                              .reshape(companies.size, n_columns) for total in totals])
+        groups = pandas.Index(companies, name='company_id')
+    group_codes, columns = numpy.nonzero(totals[TOTAL_COLUMNS.index('invoices')] > 0.5)
+    is_collected = columns < totals.shape[2] - 1
+    frame = groups[group_codes].to_frame(index=False)
+    frame['collection_month'] = month_start(pandas.Series(pandas.arrays.IntegerArray(
+        (columns + (rollup['first_month'] or 0)).astype(numpy.int32), ~is_collected)))
+    for total, column in enumerate(TOTAL_COLUMNS):
+        if by_currency or column != 'amount':
+            frame[column] = totals[total, group_codes, columns]
+    return frame.astype({'invoices': int})
+
+
+def _frames_close(left: pandas.DataFrame, right: pandas.DataFrame, keys: list[str]) -> bool:
+    """Whether two rollup frames have the same cells and close totals, in any row order."""
+    left, right = [df.sort_values(keys).reset_index(drop=True) for df in [left, right]]
+    totals = [column for column in right.columns if column not in keys]
+    return left[keys].equals(right[keys]) and numpy.allclose(left[totals], right[totals])
+
+
+def _test_rollup(features: pandas.DataFrame, predicted_months: pandas.Series, rescored_share: float = 0.05,
+                 seed: int = 0) -> OrderedDict:
+    """Check a rollup against a groupby of the invoices, then rescore a random share of invoices with shifted months,
+    add new invoices and remove others, and check the incrementally updated rollup against a rebuild. Returns the
+    build and update times."""
+    rng = numpy.random.default_rng(seed)
+    timer = time.perf_counter()
+    rollup = build_rollup(features, predicted_months)
+    build_secs = time.perf_counter() - timer
+    keys = ['company_id', 'currency', 'collection_month']
+    months = month_start(pandas.Series(_collection_months(features, predicted_months)).astype('Int32'))
+    expected = features.assign(collection_month=months, amount=features.amount * features.remaining_inv_pct)\
+        .assign(converted_amount=lambda df: df.amount * df.root_exchange_rate_value)\
+        .groupby(keys, dropna=False)[['converted_amount', 'amount']].sum()
+    assert _frames_close(rollup_frame(rollup), expected.reset_index(), keys), 'Rollup differs from groupby'
+    rescored = rng.random(features.__len__()) < rescored_share
+    # copies, since the months are updated below and must not change the caller's predictions
+    all_months = pandas.Series(pandas.to_numeric(predicted_months).to_numpy(dtype=float, na_value=numpy.nan, copy=True))
+    rescored_months = pandas.Series(all_months.values[rescored] + 1)
+    added = features.iloc[-10:].assign(invoice_id=lambda df: df.invoice_id + '-new')
+    added_months, removed = pandas.Series(all_months.values[-10:].copy()), features.invoice_id.iloc[:10]
+    timer = time.perf_counter()
+    update_rollup(rollup, features[rescored], rescored_months)
+    update_secs = time.perf_counter() - timer
+    remove_invoices(update_rollup(rollup, added, added_months), removed)
+    all_months[rescored] = rescored_months.values
+    rebuilt = remove_invoices(build_rollup(pandas.concat([features, added], ignore_index=True),
+                                           pandas.concat([all_months, added_months], ignore_index=True)), removed)
+    for by_currency, cell_keys in [(True, keys), (False, ['company_id', 'collection_month'])]:
+        assert _frames_close(rollup_frame(rollup, by_currency), rollup_frame(rebuilt, by_currency), cell_keys), \
+            'Updated rollup differs from a rebuild'
+    return OrderedDict([('invoices', features.__len__()), ('companies', rollup['groups'].levels[0].size),
+                        ('build_secs', build_secs), ('rescored', int(rescored.sum())), ('update_secs', update_secs)])
+
+
+if __name__ == "__main__":
+    from predict_open_invoices.scoring_service import _load_feature_state, _model_scorer
+    pandas.set_option('expand_frame_repr', False)
+    open_invoice_features = _load_feature_state()
+    print(_test_rollup(open_invoice_features, _model_scorer()(open_invoice_features)))
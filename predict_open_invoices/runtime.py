@@ -0,0 +1,39 @@
+import os
+import functools
+import h2o
+from predict_open_invoices import NEPTUNE_PROJECT_NAME, NEPTUNE_MODEL_ID, H2O_NTHREADS, H2O_MAX_MEM_SIZE
+# neptune is imported on first use: importing it takes seconds
+
+
+def init_h2o(nthreads: int = None, max_mem_size: str = None) -> h2o.cluster:
+    """Start or connect to the H2O cluster on first use and reuse it afterwards. Threads and memory default to the
+    H2O_NTHREADS and H2O_MAX_MEM_SIZE settings."""
+    cluster = h2o.cluster()
+    if cluster is None or not cluster.is_running():
+        h2o.init(nthreads=nthreads or H2O_NTHREADS, max_mem_size=max_mem_size or H2O_MAX_MEM_SIZE)
+        cluster = h2o.cluster()
+    return cluster
+
+
+@functools.lru_cache(maxsize=None)
+def neptune_project():
+    """Neptune project, connected on first use."""
+    import neptune
+    return neptune.init_project(project=NEPTUNE_PROJECT_NAME, api_token=os.getenv('NEPTUNE_API_TOKEN'))
+
+
+@functools.lru_cache(maxsize=None)
+def neptune_model_id() -> str:
+    """ID of the neptune model trained on CSV data."""
+    return f"{neptune_project()['sys/id'].fetch()}-{NEPTUNE_MODEL_ID}"
+
+
+@functools.lru_cache(maxsize=None)
+def neptune_model():
+    """Neptune model trained on CSV data, created on first use if it does not exist yet."""
+    import neptune
+    try:
+        return neptune.init_model(key=NEPTUNE_MODEL_ID, project=NEPTUNE_PROJECT_NAME,
+                                  name="Trained on CSV data.", api_token=os.getenv('NEPTUNE_API_TOKEN'))
+    except neptune.exceptions.NeptuneModelKeyAlreadyExistsError:
+        return neptune.init_model(with_id=neptune_model_id(), project=NEPTUNE_PROJECT_NAME)
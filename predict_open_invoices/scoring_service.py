@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import numpy
+import pandas
+from predict_open_invoices import DATA_FOLDER, REFRESH_STORE, SCORING_HOST, SCORING_PORT
+from predict_open_invoices.csv_test_data_io import get_csv_test_data, ID_COLUMN_TYPES, CSV_DATE_COLUMNS, DATE_FORMAT
+from predict_open_invoices.incremental import refresh_open_invoices
+# requests waiting when a batch starts are scored with it, up to this many invoices, waiting at most this long for
+# more requests to arrive
+MAX_BATCH_INVOICES = 10000
+MAX_BATCH_WAIT_SECS = 0.002
+# requests that latency percentiles and throughput are computed over
+LATENCY_WINDOW = 10000
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def _model_scorer(lookup_predictors: list[str] = None):
+    """Score features with the best registered model, loaded once, or with its lookup table when the predictors of
+    the model are given, which needs no H2O cluster."""
+    from predict_open_invoices.prediction import _get_best_model, _get_best_lookup_table, predict, \
+        predict_with_lookup_table
+    if lookup_predictors:
+        return functools.partial(predict_with_lookup_table, lookup_table=_get_best_lookup_table(lookup_predictors))
+    return functools.partial(predict, model=_get_best_model())
+
+
+def _load_feature_state(store_path: str = REFRESH_STORE, data_folder: str = DATA_FOLDER) -> pandas.DataFrame:
+    """Point-in-time features of OPEN invoices from the incremental refresh store, which is built from the CSV data
+    of the data folder if it does not exist yet."""
+    if os.path.exists(store_path):
+        return refresh_open_invoices(_records_frame([], 'invoice.csv'), _records_frame([], 'invoice_payments.csv'),
+                                     store_path)
+    invoices, payments = get_csv_test_data(data_folder=data_folder)
+    return refresh_open_invoices(invoices, payments, store_path)
+
+
+def _records_frame(records: list[dict], file_name: str) -> pandas.DataFrame:
+    """Raw invoices or payments from JSON records, typed like the CSV data."""
+    id_column = 'id' if file_name == 'invoice.csv' else 'invoice_id'
+    df = pandas.DataFrame(records, columns=None if records else [id_column] + CSV_DATE_COLUMNS[file_name])
+    df = df.astype({column: dtype for column, dtype in ID_COLUMN_TYPES.items() if column in df.columns})
+    for column in CSV_DATE_COLUMNS[file_name]:
+        df[column] = pandas.to_datetime(df[column], format=DATE_FORMAT)
+    return df
+
+
+def _set_features(service: dict, features: pandas.DataFrame):
+    """Swap in a new feature state, indexed by invoice id for batch lookups."""
+    service['features'] = features.reset_index(drop=True)
+    service['invoice_index'] = pandas.Index(features.invoice_id.values)
+    service['forecast_date'] = str(features.forecast_date.max()) if features.__len__() else None
+
+
+def create_service(scorer, features: pandas.DataFrame, store_path: str = REFRESH_STORE,
+                   max_batch_invoices: int = MAX_BATCH_INVOICES, max_batch_wait_secs: float = MAX_BATCH_WAIT_SECS) \
+        -> dict:
+    """State of a scoring service: the scorer of a feature frame, OPEN invoice features, the queue of score requests
+    and counters. Scoring and refreshes run one at a time in a worker thread, off the event loop."""
+    service = dict(scorer=scorer, store_path=store_path, max_batch_invoices=max_batch_invoices,
+                   max_batch_wait_secs=max_batch_wait_secs, executor=ThreadPoolExecutor(max_workers=1),
+                   queue=None, started=time.perf_counter(),
+                   counters=OrderedDict([('requests', 0), ('invoices', 0), ('batches', 0), ('errors', 0)]),
+                   # completion time, latency and invoices of recent requests
+                   recent=collections.deque(maxlen=LATENCY_WINDOW))
+    _set_features(service, features)
+    return service
+
+
+async def _next_batch(service: dict) -> list[tuple]:
+    """Wait for a score request, then take the requests that arrive within the batch wait time, up to the batch
+    size."""
+    queue, loop = service['queue'], asyncio.get_running_loop()
+    batch = [await queue.get()]
+    n_invoices, deadline = batch[0][0].__len__(), loop.time() + service['max_batch_wait_secs']
+    while n_invoices < service['max_batch_invoices']:
+        try:
+            request = queue.get_nowait() if queue.qsize() else \
+                await asyncio.wait_for(queue.get(), deadline - loop.time())
+        except asyncio.TimeoutError:
+            break
+        batch.append(request)
+        n_invoices += request[0].__len__()
+    return batch
+
+
+async def _score_batches(service: dict):
+    """Score micro-batches of queued requests with one scorer call per batch, for the invoices of the batch that
+    are OPEN. Requests get the predicted month of each of their invoices, None for invoices that are not OPEN."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await _next_batch(service)
+        features, invoice_index = service['features'], service['invoice_index']
+        positions = invoice_index.get_indexer(numpy.concatenate([invoice_ids for invoice_ids, _ in batch]))
+        batch_positions = numpy.unique(positions[positions >= 0])
+        try:
+            months = numpy.full(positions.size, numpy.nan)
+            if batch_positions.size:
+                predictions = await loop.run_in_executor(service['executor'], service['scorer'],
+                                                         features.iloc[batch_positions])
+                months[positions >= 0] = pandas.to_numeric(pandas.Series(predictions.values)).to_numpy(float)[
+                    numpy.searchsorted(batch_positions, positions[positions >= 0])]
+        except Exception as error:
+            service['counters']['errors'] += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            continue
+        service['counters']['batches'] += 1
+        offsets = numpy.cumsum([invoice_ids.__len__() for invoice_ids, _ in batch])[:-1]
+        for (_, future), request_months, request_positions in zip(batch, numpy.split(months, offsets),
+                                                                  numpy.split(positions, offsets)):
+            if not future.done():
+                future.set_result((request_months, request_positions >= 0))
+
+
+async def score_invoices(service: dict, invoice_ids: list[str]) -> OrderedDict:
+    """Predicted month collected of OPEN invoices at the forecast date of the feature state, scored in the next
+    micro-batch."""
+    started = time.perf_counter()
+    future = asyncio.get_running_loop().create_future()
+    await service['queue'].put((numpy.asarray(invoice_ids, dtype=object), future))
+    months, is_open = await future
+    completed = time.perf_counter()
+    service['counters']['requests'] += 1
+    service['counters']['invoices'] += invoice_ids.__len__()
+    service['recent'].append((completed, completed - started, invoice_ids.__len__()))
+    return OrderedDict([('forecast_date', service['forecast_date']),
+                        ('predictions', OrderedDict((invoice_id, None if numpy.isnan(month) else int(month))
+                                                    for invoice_id, month in zip(invoice_ids, months))),
+                        ('not_open', [invoice_id for invoice_id, known in zip(invoice_ids, is_open) if not known])])
+
+
+async def refresh_features(service: dict, invoices: list[dict], payments: list[dict]) -> OrderedDict:
+    """Apply new or updated raw invoices and new raw payments to the refresh store and swap in the resulting OPEN
+    invoice features. Batches already started are scored with the previous features."""
+    features = await asyncio.get_running_loop().run_in_executor(
+        service['executor'], refresh_open_invoices, _records_frame(invoices, 'invoice.csv'),
+        _records_frame(payments, 'invoice_payments.csv'), service['store_path'])
+    _set_features(service, features)
+    return OrderedDict([('forecast_date', service['forecast_date']), ('open_invoices', features.__len__())])
+
+
+def service_stats(service: dict) -> OrderedDict:
+    """Counters since start, and latency percentiles and throughput over the most recent requests."""
+    counters = service['counters']
+    stats = OrderedDict([('uptime_secs', time.perf_counter() - service['started'])], **counters)
+    stats['invoices_per_batch'] = counters['invoices'] / counters['batches'] if counters['batches'] else None
+    recent = numpy.array(service['recent']).reshape(-1, 3)
+    window_secs = recent[-1, 0] - recent[0, 0] if recent.__len__() > 1 else None
+    stats['latency_p50_ms'] = float(numpy.percentile(recent[:, 1], 50) * 1000) if recent.size else None
+    stats['latency_p99_ms'] = float(numpy.percentile(recent[:, 1], 99) * 1000) if recent.size else None
+    stats['requests_per_sec'] = (recent.__len__() - 1) / window_secs if window_secs else None
+    stats['invoices_per_sec'] = recent[1:, 2].sum() / window_secs if window_secs else None
+    stats['open_invoices'] = service['features'].__len__()
+    stats['forecast_date'] = service['forecast_date']
+    return stats
+
+
+async def _read_http_message(reader: asyncio.StreamReader) -> (str, dict, bytes):
+    """Start line, lower-cased headers and body of an HTTP/1.1 request or response, or None at end of stream."""
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode().split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return start_line.decode().strip(), headers, body
+
+
+def _write_http_message(writer: asyncio.StreamWriter, start_line: str, body: dict):
+    payload = json.dumps(body).encode()
+    writer.write(f'{start_line}\r\nContent-Type: application/json\r\nContent-Length: {payload.__len__()}\r\n\r\n'
+                 .encode() + payload)
+
+
+async def _route(service: dict, method: str, path: str, body: bytes) -> (int, dict):
+    """POST /score with {"invoice_ids": [...]}, POST /refresh with {"invoices": [...], "payments": [...]} of raw
+    records, GET /stats and GET /invoices for the ids of OPEN invoices."""
+    request = json.loads(body) if body else {}
+    if (method, path) == ('POST', '/score'):
+        if not isinstance(request.get('invoice_ids'), list):
+            return 400, {'error': 'Expected a list of invoice_ids'}
+        return 200, await score_invoices(service, [str(invoice_id) for invoice_id in request['invoice_ids']])
+    if (method, path) == ('POST', '/refresh'):
+        return 200, await refresh_features(service, request.get('invoices', []), request.get('payments', []))
+    if (method, path) == ('GET', '/stats'):
+        return 200, service_stats(service)
+    if (method, path) == ('GET', '/invoices'):
+        return 200, {'forecast_date': service['forecast_date'], 'invoice_ids': service['invoice_index'].tolist()}
+    return 404, {'error': f'No route for {method} {path}'}
+
+
+async def _handle_connection(service: dict, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Serve JSON requests on a connection until the client closes it. Connections are kept alive."""
+    service['connections'].add(asyncio.current_task())
+    try:
+        while True:
+            message = await _read_http_message(reader)
+            if message is None:
+                break
+            start_line, headers, body = message
+            method, path = start_line.split(' ')[:2]
+            try:
+                status, response = await _route(service, method, path, body)
+            except (ValueError, KeyError) as error:
+                status, response = 400, {'error': repr(error)}
+            except Exception as error:
+                status, response = 500, {'error': repr(error)}
+            _write_http_message(writer, f'HTTP/1.1 {status} {HTTP_REASONS[status]}', response)
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+        service['connections'].discard(asyncio.current_task())
+
+
+async def start_service(service: dict, host: str = SCORING_HOST, port: int = SCORING_PORT) -> asyncio.Server:
+    """Start serving HTTP requests and scoring micro-batches on the running event loop."""
+    service['queue'], service['connections'] = asyncio.Queue(), set()
+    service['batch_task'] = asyncio.create_task(_score_batches(service))
+    return await asyncio.start_server(functools.partial(_handle_connection, service), host, port)
+
+
+async def stop_service(service: dict, server: asyncio.Server, timeout: float = 5):
+    """Stop accepting connections, wait for open connections to be closed by their clients, then stop scoring."""
+    server.close()
+    if service['connections']:
+        await asyncio.wait(list(service['connections']), timeout=timeout)
+    service['batch_task'].cancel()
+
+
+def serve(host: str = SCORING_HOST, port: int = SCORING_PORT, lookup_predictors: list[str] = None,
+          store_path: str = REFRESH_STORE):
+    """Run a scoring service until interrupted, with the best model and the OPEN invoice features of the refresh
+    store kept in memory."""
+    service = create_service(_model_scorer(lookup_predictors), _load_feature_state(store_path), store_path)
+
+    async def run():
+        server = await start_service(service, host, port)
+        print(f"Scoring {service['features'].__len__()} OPEN invoices on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+    asyncio.run(run())
+
+
+async def _http_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str,
+                        body: dict = None) -> dict:
+    _write_http_message(writer, f'{method} {path} HTTP/1.1', body or {})
+    await writer.drain()
+    start_line, _, response_body = await _read_http_message(reader)
+    assert start_line.split(' ')[1] == '200', f'{method} {path} failed: {response_body.decode()}'
+    return json.loads(response_body)
+
+
+async def _load_test_client(host: str, port: int, invoice_ids: numpy.ndarray, n_requests: int,
+                            invoices_per_request: int, seed: int, latencies: list[float]):
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = numpy.random.default_rng(seed)
+    for _ in range(n_requests):
+        request_ids = rng.choice(invoice_ids, invoices_per_request).tolist()
+        started = time.perf_counter()
+        await _http_request(reader, writer, 'POST', '/score', {'invoice_ids': request_ids})
+        latencies.append(time.perf_counter() - started)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def load_test(host: str = SCORING_HOST, port: int = SCORING_PORT, n_clients: int = 50,
+                    requests_per_client: int = 200, invoices_per_request: int = 1, seed: int = 0) -> OrderedDict:
+    """Score random OPEN invoices from concurrent clients, each sending requests one after another on its own
+    connection. Returns client-side latency percentiles and throughput, and the stats of the service."""
+    reader, writer = await asyncio.open_connection(host, port)
+    invoice_ids = numpy.array((await _http_request(reader, writer, 'GET', '/invoices'))['invoice_ids'], dtype=object)
+    assert invoice_ids.size, 'No OPEN invoices to score'
+    latencies, started = [], time.perf_counter()
+    await asyncio.gather(*[_load_test_client(host, port, invoice_ids, requests_per_client, invoices_per_request,
+                                             seed + client, latencies) for client in range(n_clients)])
+    seconds = time.perf_counter() - started
+    server_stats = await _http_request(reader, writer, 'GET', '/stats')
+    writer.close()
+    await writer.wait_closed()
+    return OrderedDict([('clients', n_clients), ('requests', latencies.__len__()), ('seconds', seconds),
+                        ('requests_per_sec', latencies.__len__() / seconds),
+                        ('latency_p50_ms', float(numpy.percentile(latencies, 50) * 1000)),
+                        ('latency_p99_ms', float(numpy.percentile(latencies, 99) * 1000)),
+                        ('server', server_stats)])
+
+
+def _test_scoring_service(scorer=None, features: pandas.DataFrame = None, n_clients: int = 50,
+                          requests_per_client: int = 100, port: int = 0) -> OrderedDict:
+    """Load-test an in-process service on the OPEN invoice features of the refresh store, and check that micro-batched
+    predictions, and predictions of invoices requested one at a time, match scoring all OPEN invoices in one call."""
+    scorer = _model_scorer() if scorer is None else scorer
+    features = _load_feature_state() if features is None else features
+    service = create_service(scorer, features)
+    single_ids = features.invoice_id.sample(min(20, features.__len__()), random_state=0).tolist()
+
+    async def run():
+        server = await start_service(service, SCORING_HOST, port)
+        bound_port = server.sockets[0].getsockname()[1]
+        results = await load_test(SCORING_HOST, bound_port, n_clients, requests_per_client)
+        reader, writer = await asyncio.open_connection(SCORING_HOST, bound_port)
+        sample_ids = features.invoice_id.iloc[:1000].tolist() + ['not-an-invoice']
+        scored = await _http_request(reader, writer, 'POST', '/score', {'invoice_ids': sample_ids})
+        singles = [(await _http_request(reader, writer, 'POST', '/score', {'invoice_ids': [invoice_id]}))['predictions']
+                   for invoice_id in single_ids]
+        writer.close()
+        await writer.wait_closed()
+        await stop_service(service, server)
+        return results, sample_ids, scored, singles
+    results, sample_ids, scored, singles = asyncio.run(run())
+    expected_months = pandas.to_numeric(pandas.Series(scorer(features).values))
+    expected = dict(zip(features.invoice_id.values,
+                        [None if numpy.isnan(month) else int(month) for month in expected_months]))
+    assert scored['not_open'] == ['not-an-invoice'], 'Unknown invoices were scored'
+    assert [scored['predictions'][invoice_id] for invoice_id in sample_ids[:-1]] == \
+        [expected[invoice_id] for invoice_id in sample_ids[:-1]], 'Micro-batched predictions differ'
+    assert [single[invoice_id] for single, invoice_id in zip(singles, single_ids)] == \
+        [expected[invoice_id] for invoice_id in single_ids], 'Single invoice predictions differ from the full batch'
+    assert results['server']['batches'] < results['server']['requests'], 'Requests were not batched'
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['load-test']:
+        load_test_args = dict(zip(['n_clients', 'requests_per_client', 'invoices_per_request'], map(int, sys.argv[2:])))
+        print(json.dumps(asyncio.run(load_test(**load_test_args)), indent=2))
+    else:
+        serve(lookup_predictors=sys.argv[1:] or None)
@@ -0,0 +1,92 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import functools
+from collections import Counter
+import pandas
+import pyarrow.feather
+from predict_open_invoices import STAGE_CACHE_FOLDER, STAGE_CACHE_MAX_BYTES
+STAGE_CACHE_STATS = Counter()
+
+
+@functools.lru_cache(maxsize=None)
+def _code_version() -> str:
+    """Hash of the package source, so that cached outputs are invalidated by any change to pipeline code."""
+    source_hash = hashlib.sha256()
+    for source_path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '*.py'))):
+        with open(source_path, 'rb') as source_file:
+            source_hash.update(source_file.read())
+    return source_hash.hexdigest()
+
+
+def _hash_input(value, input_hash):
+    """Add a stage input to a hash: data frames by content, column names and dtypes, other values by repr."""
+    if isinstance(value, pandas.DataFrame):
+        input_hash.update(pandas.util.hash_pandas_object(value, index=True).values.tobytes())
+        input_hash.update(repr(list(zip(value.columns, value.dtypes.astype(str)))).encode())
+    else:
+        input_hash.update(repr(value).encode())
+
+
+def _stage_key(stage, args: tuple, kwargs: dict) -> str:
+    input_hash = hashlib.sha256(f'{stage.__module__}.{stage.__qualname__}:{_code_version()}'.encode())
+    for value in args:
+        _hash_input(value, input_hash)
+    for name, value in sorted(kwargs.items()):
+        _hash_input(name, input_hash)
+        _hash_input(value, input_hash)
+    return input_hash.hexdigest()[:24]
+
+
+def _evict(max_bytes: int):
+    """Remove least recently used stage outputs until the cache fits in max_bytes."""
+    entries = []
+    for entry in glob.glob(f'{STAGE_CACHE_FOLDER}/*/'):
+        size = sum(os.path.getsize(path) for path in glob.glob(f'{entry}*'))
+        entries.append((os.path.getmtime(entry), size, entry))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total_bytes -= size
+
+
+def cached_stage(stage, max_bytes: int = STAGE_CACHE_MAX_BYTES):
+    """Wrap a pipeline stage that returns a data frame or a tuple of data frames, so that its outputs are stored on
+    local disk as Feather files keyed by a hash of its inputs, parameters and code version, and reused on later calls
+    with the same key. Least recently used outputs are evicted beyond max_bytes."""
+    @functools.wraps(stage)
+    def cached(*args, **kwargs):
+        entry = f'{STAGE_CACHE_FOLDER}/{stage.__name__}-{_stage_key(stage, args, kwargs)}'
+        if os.path.exists(f'{entry}/outputs.json'):
+            STAGE_CACHE_STATS[(stage.__name__, 'Hits')] += 1
+            os.utime(entry)
+            with open(f'{entry}/outputs.json') as outputs_file:
+                outputs = json.load(outputs_file)
+            frames = tuple(pyarrow.feather.read_table(f'{entry}/{output_num}.feather', memory_map=True).to_pandas()
+                           for output_num in range(outputs['count']))
+            return frames if outputs['is_tuple'] else frames[0]
+        STAGE_CACHE_STATS[(stage.__name__, 'Misses')] += 1
+        result = stage(*args, **kwargs)
+        frames = result if isinstance(result, tuple) else (result,)
+        assert all(isinstance(frame, pandas.DataFrame) for frame in frames), 'Only data frame outputs can be cached'
+        os.makedirs(entry, exist_ok=True)
+        for output_num, frame in enumerate(frames):
+            pyarrow.feather.write_feather(frame, f'{entry}/{output_num}.feather', compression='uncompressed')
+        # written last, so that partially written entries are never read
+        with open(f'{entry}/outputs.json', 'w') as outputs_file:
+            json.dump({'count': len(frames), 'is_tuple': isinstance(result, tuple)}, outputs_file)
+        _evict(max_bytes)
+        return result
+    return cached
+
+
+def stage_cache_stats() -> pandas.DataFrame:
+    """Hits and misses per cached stage since the process started."""
+    stats = pandas.Series(STAGE_CACHE_STATS, dtype=int)
+    if stats.empty:
+        return pandas.DataFrame(columns=['Hits', 'Misses'])
+    return stats.unstack(fill_value=0).reindex(columns=['Hits', 'Misses'], fill_value=0)
@@ -0,0 +1,155 @@
+import os
+import tempfile
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+import numpy
+import pandas
+import pyarrow
+import pyarrow.ipc
+from predict_open_invoices.pre_processing import _prepare_payments, _prepare_invoices, _combine_invoices_payments, \
+    preprocess_invoices_with_payments
+from predict_open_invoices.training import _add_invoice_outcomes, _filter_invoice_outcomes, _forecast_date_ranges, \
+    _check_forecast_date_ranges, _post_process_invoice_outcomes
+from predict_open_invoices.feature_engineering import feature_engineering
+from predict_open_invoices.partitioned import merge_filter_stats, _write_frame, _read_frame
+from predict_open_invoices.csv_test_data_io import get_csv_test_data, read_csv_chunks
+# columns of raw payments, for the bucket files when no payment chunks are read
+PAYMENT_COLUMN_TYPES = OrderedDict([('amount', 'float64'), ('root_exchange_rate_value', 'float64'),
+                                    ('transaction_date', 'datetime64[ns]'), ('invoice_id', 'object'),
+                                    ('company_id', 'object'), ('converted_amount', 'float64')])
+
+
+def _invoice_buckets(invoice_ids: pandas.Series, n_buckets: int) -> numpy.ndarray:
+    """Stable bucket number of each invoice id, from a hash of the id."""
+    return (pandas.util.hash_array(numpy.asarray(invoice_ids, dtype=object)) % n_buckets).astype(numpy.int64)
+
+
+def bucket_payments(payment_chunks: Iterable[pandas.DataFrame], invoice_ids: pandas.Index,
+                    prepared_invoice_ids: pandas.Index, n_buckets: int, bucket_folder: str) -> \
+        (list[str], pandas.Timestamp, pandas.Timestamp):
+    """Write chunks of raw payments to one Arrow IPC file per bucket of invoice ids, in their original order, so that
+    each bucket holds all payments of its invoices. The files take the schema of the first chunk, or of raw payments
+    if there are no chunks, in which case they are empty. Returns the bucket files, the
+    payments data end date (last transaction with an amount and a prepared invoice) and the last transaction date."""
+    writers, schema = [], None
+    last_transaction_date = last_raw_transaction_date = pandas.NaT
+    try:
+        for payments in payment_chunks:
+            assert payments.invoice_id.isin(invoice_ids).all(), "Not all payments have invoice data"
+            matched = payments.amount.notnull() & payments.invoice_id.isin(prepared_invoice_ids)
+            last_transaction_date = max([date for date in [last_transaction_date,
+                                                           payments.transaction_date[matched].max()]
+                                         if not pandas.isnull(date)], default=pandas.NaT)
+            last_raw_transaction_date = max([date for date in [last_raw_transaction_date,
+                                                               payments.transaction_date.max()]
+                                             if not pandas.isnull(date)], default=pandas.NaT)
+            table = pyarrow.Table.from_pandas(payments, schema=schema, preserve_index=False)
+            if schema is None:
+                schema = table.schema
+                writers = [pyarrow.ipc.new_file(f'{bucket_folder}/payments_{bucket}.arrow', schema)
+                           for bucket in range(n_buckets)]
+            buckets = _invoice_buckets(payments.invoice_id, n_buckets)
+            for bucket in numpy.unique(buckets):
+                writers[bucket].write_table(table.filter(pyarrow.array(buckets == bucket)))
+        if schema is None:
+            empty_payments = pandas.DataFrame({column: pandas.Series(dtype=dtype)
+                                               for column, dtype in PAYMENT_COLUMN_TYPES.items()})
+            schema = pyarrow.Table.from_pandas(empty_payments, preserve_index=False).schema
+            writers = [pyarrow.ipc.new_file(f'{bucket_folder}/payments_{bucket}.arrow', schema)
+                       for bucket in range(n_buckets)]
+    finally:
+        for writer in writers:
+            writer.close()
+    return [f'{bucket_folder}/payments_{bucket}.arrow' for bucket in range(n_buckets)], last_transaction_date, \
+        last_raw_transaction_date
+
+
+def stream_invoices_with_payments(invoices: pandas.DataFrame, payment_chunks: Iterable[pandas.DataFrame],
+                                  n_buckets: int = 64) -> Iterator[(pandas.DataFrame, pandas.DataFrame)]:
+    """ Preprocess invoices with a payment history read in chunks, one bucket of invoice ids at a time, so that
+    memory is bounded by the invoices and the payments of one bucket. Yields the preprocessed invoices with payments
+    and the filter stats of each bucket, which together equal the output of preprocess_invoices_with_payments."""
+    prepared_invoice_ids = pandas.Index(_prepare_invoices(invoices)[0].invoice_id)
+    invoice_buckets = _invoice_buckets(invoices.id, n_buckets)
+    with tempfile.TemporaryDirectory() as bucket_folder:
+        bucket_files, last_transaction_date, _ = bucket_payments(payment_chunks, pandas.Index(invoices.id),
+                                                                 prepared_invoice_ids, n_buckets, bucket_folder)
+        for bucket, bucket_file in enumerate(bucket_files):
+            if not (invoice_buckets == bucket).any():
+                continue
+            invoices_prepared, invoice_filter_stats = _prepare_invoices(invoices[invoice_buckets == bucket])
+            with pyarrow.ipc.open_file(bucket_file) as reader:
+                payments_prepared = reader.read_all().to_pandas()
+            os.remove(bucket_file)
+            filter_stats_dict = OrderedDict()
+            # buckets without payments have no payment filter stats
+            if payments_prepared.__len__():
+                payments_prepared, filter_stats_dict['payments'] = _prepare_payments(payments_prepared)
+            filter_stats_dict['invoices'] = invoice_filter_stats
+            invoices_with_payments = _combine_invoices_payments(invoices_prepared, payments_prepared,
+                                                                last_transaction_date)
+            yield invoices_with_payments, pandas.concat(filter_stats_dict, names=['Dataset', 'Step Num'])
+
+
+def merge_preprocess_filter_stats(bucket_filter_stats: list[pandas.DataFrame]) -> pandas.DataFrame:
+    """Combine the preprocessing filter stats of buckets into the stats of the whole data."""
+    merged = OrderedDict()
+    for dataset in ['payments', 'invoices']:
+        stats = [filter_stats.loc[dataset] for filter_stats in bucket_filter_stats
+                 if dataset in filter_stats.index.get_level_values('Dataset')]
+        merged[dataset] = merge_filter_stats(stats, [step_stats['Rows Filter Applied To'].iloc[0]
+                                                     for step_stats in stats])
+    return pandas.concat(merged, names=['Dataset', 'Step Num'])
+
+
+def stream_training_features(invoices: pandas.DataFrame, payment_chunks: Iterable[pandas.DataFrame],
+                             n_buckets: int = 64) -> Iterator[(pandas.DataFrame, pandas.DataFrame, pandas.DataFrame)]:
+    """ Preprocess, post-process outcomes and engineer features one bucket of invoices at a time. Buckets with outcomes
+    are spooled to local disk, since filtering outcomes needs the collected date range of all buckets. Yields the
+    feature data of each bucket with its preprocessing and post-processing filter stats."""
+    with tempfile.TemporaryDirectory() as spool_folder:
+        spool_files, preprocess_filter_stats, date_ranges, collected_dates = [], [], [], []
+        for invoices_with_payments, filter_stats in stream_invoices_with_payments(invoices, payment_chunks,
+                                                                                  n_buckets):
+            preprocess_filter_stats.append(filter_stats)
+            collected = invoices_with_payments.transaction_date[invoices_with_payments.amount_pmt_pct_cum == 1]
+            collected_dates.extend([collected.min(), collected.max()])
+            invoices_with_outcomes = _add_invoice_outcomes(invoices_with_payments, check_date_ranges=False)
+            date_ranges.append(_forecast_date_ranges(invoices_with_outcomes))
+            spool_files.append(f'{spool_folder}/{len(spool_files)}.arrow')
+            _write_frame(invoices_with_outcomes, spool_files[-1])
+        date_ranges = pandas.concat(date_ranges)
+        _check_forecast_date_ranges(pandas.DataFrame({'min': date_ranges.loc['min'].min(),
+                                                      'max': date_ranges.loc['max'].max()}).T)
+        collected_dates = pandas.Series(collected_dates, dtype='datetime64[ns]')
+        for spool_file, filter_stats in zip(spool_files, preprocess_filter_stats):
+            invoices_to_model, post_process_filter_stats = _filter_invoice_outcomes(
+                _read_frame(spool_file), (collected_dates.min(), collected_dates.max()))
+            os.remove(spool_file)
+            yield feature_engineering(invoices_to_model), filter_stats, post_process_filter_stats
+
+
+def _test_streaming(chunk_rows: int = 10000, n_buckets: int = 16) -> OrderedDict:
+    """Stream local CSV payments in chunks and compare the features and filter stats with the in-memory path."""
+    invoices, payments = get_csv_test_data()
+    feature_data, preprocess_filter_stats, post_process_filter_stats = zip(*stream_training_features(
+        invoices, read_csv_chunks('invoice_payments.csv', chunk_rows), n_buckets))
+    feature_data = pandas.concat(feature_data).sort_values(by=['invoice_id', 'forecast_date']).reset_index(drop=True)
+    invoices_with_payments, expected_preprocess_filter_stats = preprocess_invoices_with_payments(invoices, payments)
+    invoices_to_model, expected_post_process_filter_stats = _post_process_invoice_outcomes(invoices_with_payments)
+    expected = feature_engineering(invoices_to_model).sort_values(by=['invoice_id', 'forecast_date'])\
+        .reset_index(drop=True)
+    pandas.testing.assert_frame_equal(feature_data, expected)
+    return OrderedDict([('preprocessing', merge_preprocess_filter_stats(preprocess_filter_stats)),
+                        ('post-processing', merge_filter_stats(post_process_filter_stats,
+                                                               [stats['Rows Filter Applied To'].iloc[0]
+                                                                for stats in post_process_filter_stats])),
+                        ('expected preprocessing', expected_preprocess_filter_stats),
+                        ('expected post-processing', expected_post_process_filter_stats)])
+
+
+if __name__ == "__main__":
+    pandas.set_option('expand_frame_repr', False)
+    for name, stats in _test_streaming().items():
+        print(name)
+        print(stats)
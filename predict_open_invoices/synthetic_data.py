@@ -0,0 +1,174 @@
+import os
+from collections import OrderedDict
+import numpy
+import pandas
+from predict_open_invoices.csv_test_data_io import DATE_FORMAT
+# invoices in the CSV test data, which synthetic data scales are multiples of
+BASE_INVOICES = 113085
+# population sizes relative to invoices, as in the CSV test data
+INVOICES_PER_COMPANY = 56_000
+INVOICES_PER_CUSTOMER = 22
+# invoice currencies with their share of invoices and typical exchange rate to USD
+CURRENCIES = OrderedDict([('USD', (0.756, 1.0)), ('EUR', (0.08, 1.15)), ('GBP', (0.06, 1.3)), ('CAD', (0.03, 0.77)),
+                          ('AUD', (0.02, 0.73)), ('MXN', (0.01, 0.05)), ('JPY', (0.008, 0.0091)),
+                          ('CHF', (0.006, 1.05)), ('SEK', (0.005, 0.11)), ('NOK', (0.004, 0.11)),
+                          ('DKK', (0.004, 0.155)), ('SGD', (0.004, 0.74)), ('HKD', (0.003, 0.128)),
+                          ('BRL', (0.003, 0.22)), ('INR', (0.003, 0.014)), ('ZAR', (0.002, 0.068)),
+                          ('NZD', (0.002, 0.69))])
+# payment terms in days and their share of invoices: mostly net 30, giving 1 month allowed
+PAYMENT_TERMS = OrderedDict([(0, 0.05), (30, 0.72), (60, 0.19), (90, 0.035), (180, 0.005)])
+# share of invoices by number of payments, given that they have payments
+PAYMENTS_PER_INVOICE = OrderedDict([(1, 0.942), (2, 0.0548), (3, 0.0026), (4, 0.0006)])
+# invoice outcomes and their share of invoices: cleared without payments, partially paid, overpaid or collected
+OUTCOMES = OrderedDict([('unpaid', 0.05), ('partial', 0.05), ('overpaid', 0.0005), ('collected', 0.8995)])
+FIRST_INVOICE_DATE = pandas.Timestamp('2011-04-02')
+# when the data was pulled: later payments are unknown and invoices cleared later are still open
+DATA_PULL_DATE = pandas.Timestamp('2021-05-18')
+# all open invoices share one cleared date after the data was pulled
+OPEN_CLEARED_DATE = pandas.Timestamp('2022-01-01')
+MISSING_AMOUNT_RATE = 1e-5
+
+
+def _population(n_invoices: int, rng: numpy.random.Generator) -> OrderedDict:
+    """Customers with their company, usual and occasional currency, and a log-normally skewed share of invoices."""
+    n_companies = max(2, round(n_invoices / INVOICES_PER_COMPANY))
+    n_customers = max(n_companies, round(n_invoices / INVOICES_PER_CUSTOMER))
+    # a few large companies hold most customers
+    company_weights = rng.lognormal(0, 1.5, n_companies)
+    customer_company = rng.choice(n_companies, n_customers, p=company_weights / company_weights.sum())
+    currency_share = numpy.array([share for share, _ in CURRENCIES.values()])
+    customer_currency = rng.choice(len(CURRENCIES), n_customers, p=currency_share / currency_share.sum())
+    # some customers also pay in a second currency
+    other_currency = numpy.where(rng.random(n_customers) < 0.12, rng.choice(len(CURRENCIES), n_customers),
+                                 customer_currency)
+    customer_weights = rng.lognormal(0, 1, n_customers)
+    return OrderedDict([('customer_company', customer_company), ('customer_currency', customer_currency),
+                        ('customer_other_currency', other_currency),
+                        ('customer_p', customer_weights / customer_weights.sum()),
+                        ('company_ids', rng.permutation(10 * n_companies)[:n_companies] + 1)])
+
+
+def _choice(options: OrderedDict, size: int, rng: numpy.random.Generator) -> numpy.ndarray:
+    shares = numpy.array(list(options.values()))
+    return numpy.array(list(options.keys()))[rng.choice(shares.size, size, p=shares / shares.sum())]
+
+
+def _invoices(n_invoices: int, first_id: int, population: OrderedDict, rng: numpy.random.Generator) -> \
+        pandas.DataFrame:
+    customer = rng.choice(population['customer_p'].size, n_invoices, p=population['customer_p'])
+    currency = numpy.where(rng.random(n_invoices) < 0.3, population['customer_other_currency'][customer],
+                           population['customer_currency'][customer])
+    base_rates = numpy.array([rate for _, rate in CURRENCIES.values()])
+    rate = base_rates[currency] * numpy.where(currency == 0, rng.normal(1, 0.003, n_invoices),
+                                              rng.lognormal(0, 0.05, n_invoices))
+    # invoice volume grows over time: density increases linearly from the first invoice date to the data pull
+    span_days = (DATA_PULL_DATE - FIRST_INVOICE_DATE).days
+    invoice_days = (numpy.sqrt(rng.random(n_invoices)) * span_days).astype('timedelta64[D]')
+    invoice_date = (FIRST_INVOICE_DATE.to_datetime64() + invoice_days).astype('datetime64[ns]')
+    terms = _choice(PAYMENT_TERMS, n_invoices, rng)
+    company = population['customer_company'][customer]
+    return pandas.DataFrame(OrderedDict([
+        ('id', (first_id + numpy.arange(n_invoices)).astype(str)),
+        ('due_date', invoice_date + terms.astype('timedelta64[D]')),
+        ('invoice_date', invoice_date),
+        ('status', 'CLEARED'),
+        ('amount_inv', rng.uniform(1, 20_000, n_invoices).round(2)),
+        ('currency', numpy.array(list(CURRENCIES.keys()))[currency]),
+        ('company_id', population['company_ids'][company].astype(str)),
+        ('customer_id', (customer + 1).astype(str)),
+        # accounts and companies are synonymous
+        ('account_id', company.astype(str)),
+        ('cleared_date', pandas.NaT),
+        ('root_exchange_rate_value', rate)]))
+
+
+def _payments(invoices: pandas.DataFrame, outcome: numpy.ndarray, rng: numpy.random.Generator) -> pandas.DataFrame:
+    """Payments per invoice for its outcome, on dates spaced from around the due date, split into parts that sum to the
+    paid amount. No single payment exceeds the invoice amount, so overpaid invoices have at least two payments.
+    Returns them with the position of their invoice in the invoices."""
+    paid = numpy.flatnonzero(outcome != 'unpaid')
+    n_payments = _choice(PAYMENTS_PER_INVOICE, paid.size, rng)
+    n_payments[outcome[paid] == 'overpaid'] = numpy.maximum(n_payments[outcome[paid] == 'overpaid'], 2)
+    invoice_position = numpy.repeat(paid, n_payments)
+    first_payment = numpy.repeat(numpy.cumsum(n_payments) - n_payments, n_payments)
+    is_first = numpy.arange(invoice_position.size) == first_payment
+    is_last = numpy.append(invoice_position[1:] != invoice_position[:-1], True)
+    paid_pct = numpy.select([outcome[paid] == 'partial', outcome[paid] == 'overpaid'],
+                            [rng.uniform(0.05, 0.95, paid.size), rng.uniform(1.001, 1.05, paid.size)], 1.0)
+    amount_inv = invoices.amount_inv.values
+    amount_paid = (amount_inv[paid] * paid_pct).round(2)
+    # parts of at least 5% of the paid amount, the last part being the remainder so that they sum exactly
+    weights = rng.uniform(0.05, 1, invoice_position.size)
+    weights = weights / numpy.bincount(invoice_position, weights, amount_inv.size)[invoice_position]
+    amount = numpy.minimum((numpy.repeat(amount_paid, n_payments) * weights).round(2), amount_inv[invoice_position])
+    amount_before_last = numpy.bincount(invoice_position, numpy.where(is_last, 0, amount), amount_inv.size)
+    amount[is_last] = amount_paid - amount_before_last[paid]
+    # first payment around the due date, mostly late, and later payments spaced weeks apart
+    gaps = numpy.where(is_first, rng.gamma(1.5, 12, invoice_position.size) - 10,
+                       rng.gamma(2, 20, invoice_position.size))
+    days_after_due = numpy.cumsum(gaps)
+    days_after_due = days_after_due - days_after_due[first_payment] + gaps[first_payment]
+    transaction_date = numpy.maximum(invoices.due_date.values[invoice_position]
+                                     + days_after_due.round().astype('timedelta64[D]'),
+                                     invoices.invoice_date.values[invoice_position])
+    # payments are converted at the exchange rate of their transaction date
+    rate = invoices.root_exchange_rate_value.values[invoice_position] \
+        * numpy.where(invoices.currency.values[invoice_position] == 'USD', 1,
+                      rng.lognormal(0, 0.02, invoice_position.size))
+    amount[rng.random(amount.size) < MISSING_AMOUNT_RATE] = numpy.nan
+    return pandas.DataFrame(OrderedDict([
+        ('amount', amount), ('root_exchange_rate_value', rate), ('transaction_date', transaction_date),
+        ('invoice_id', invoices.id.values[invoice_position]),
+        ('company_id', invoices.company_id.values[invoice_position]), ('converted_amount', amount * rate),
+        ('invoice_position', invoice_position)]))
+
+
+def make_synthetic_data(n_invoices: int, seed: int | list[int] = 0, first_id: int = 0,
+                        population: OrderedDict = None) -> (pandas.DataFrame, pandas.DataFrame):
+    """Invoices and payments with the schema and distributions of the CSV test data: companies and customers skewed
+    in size, mostly USD among 17 currencies, mostly net 30 terms, a few partial and overpayments, and invoices cleared
+    without payments. Invoices cleared after the data pull date are OPEN, with the shared future cleared date, and
+    payments after it are left out. Chunks of a larger data set are generated with consecutive first ids, distinct seeds
+    and the population of the whole data set."""
+    rng = numpy.random.default_rng(seed)
+    population = population or _population(n_invoices, rng)
+    invoices = _invoices(n_invoices, first_id, population, rng)
+    outcome = _choice(OUTCOMES, n_invoices, rng)
+    payments = _payments(invoices, outcome, rng)
+    last_payment_date = pandas.Series(payments.transaction_date.values).groupby(payments.invoice_position.values).max()
+    # collected invoices clear soon after their last payment, uncollected ones take about twice as long
+    cleared_date = invoices.due_date.values + rng.gamma(2, 45, n_invoices).astype('timedelta64[D]')
+    collected = numpy.isin(outcome, ['collected', 'overpaid'])
+    cleared_date[collected] = last_payment_date.reindex(numpy.flatnonzero(collected)).values \
+        + rng.integers(0, 5, collected.sum()).astype('timedelta64[D]')
+    has_payments = numpy.isin(numpy.arange(n_invoices), last_payment_date.index)
+    cleared_date[has_payments] = numpy.maximum(cleared_date[has_payments],
+                                               last_payment_date.reindex(numpy.flatnonzero(has_payments)).values)
+    is_open = cleared_date > DATA_PULL_DATE.to_datetime64()
+    invoices['cleared_date'] = numpy.where(is_open, OPEN_CLEARED_DATE.to_datetime64(), cleared_date)
+    invoices['status'] = numpy.where(is_open, 'OPEN', 'CLEARED')
+    payments = payments[payments.transaction_date <= DATA_PULL_DATE].drop(columns='invoice_position')
+    return invoices, payments.reset_index(drop=True)
+
+
+def write_synthetic_csvs(data_folder: str, scale: float, seed: int = 0, chunk_invoices: int = 1_000_000) -> str:
+    """Write invoice.csv and invoice_payments.csv of scale times the invoices in the CSV test data to a data folder,
+    in chunks of invoices so that scales beyond memory can be written. Files already written are kept, so the same
+    scale and seed is only generated once. Returns the data folder."""
+    invoices_path, payments_path = f'{data_folder}/invoice.csv', f'{data_folder}/invoice_payments.csv'
+    if os.path.exists(invoices_path) and os.path.exists(payments_path):
+        return data_folder
+    os.makedirs(data_folder, exist_ok=True)
+    n_invoices = round(BASE_INVOICES * scale)
+    population = _population(n_invoices, numpy.random.default_rng([seed, 0]))
+    for chunk_number, first_id in enumerate(range(0, n_invoices, chunk_invoices)):
+        invoices, payments = make_synthetic_data(min(chunk_invoices, n_invoices - first_id),
+                                                 [seed, chunk_number + 1], first_id, population)
+        # write to temp paths so that partial files are never read
+        invoices.to_csv(invoices_path + '.tmp', mode='a' if chunk_number else 'w', header=not chunk_number,
+                        index=False, date_format=DATE_FORMAT)
+        payments.to_csv(payments_path + '.tmp', mode='a' if chunk_number else 'w', header=not chunk_number,
+                        index=False, date_format=DATE_FORMAT)
+    os.replace(invoices_path + '.tmp', invoices_path)
+    os.replace(payments_path + '.tmp', payments_path)
+    return data_folder
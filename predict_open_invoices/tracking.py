@@ -0,0 +1,292 @@
+import os
+import glob
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import shutil
+import sqlite3
+import contextlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy
+import pandas
+from predict_open_invoices import TRACKING_FOLDER, TRACKING_BACKEND, NEPTUNE_PROJECT_NAME, NEPTUNE_MODEL_ID
+from predict_open_invoices.runtime import neptune_model_id
+LOGGER = logging.getLogger(__name__)
+# records applied to the backend per batch, and how often the writer checks for new records
+TRACKING_BATCH_SIZE = 200
+TRACKING_FLUSH_SECS = 0.5
+# writer retry delays while the backend is unavailable, doubling from the first to the last
+TRACKING_RETRY_SECS = (1, 60)
+# how long records are flushed for at exit before they are left in the journal for a later replay
+TRACKING_EXIT_TIMEOUT_SECS = 30
+# journal of this process: open file, lock for appends, bytes written, bytes applied and the writer thread
+_JOURNAL = OrderedDict()
+# neptune model versions opened by the writer, keyed by version key
+_NEPTUNE_VERSIONS = OrderedDict()
+
+
+def _journal() -> OrderedDict:
+    """Open the journal of this process on first use, locked for as long as the process runs, and start the writer
+    thread that applies it to the tracking backend."""
+    if 'file' in _JOURNAL:
+        return _JOURNAL
+    os.makedirs(f'{TRACKING_FOLDER}/artifacts', exist_ok=True)
+    path = f'{TRACKING_FOLDER}/journal-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl'
+    journal_file = open(path, 'ab')
+    fcntl.flock(journal_file, fcntl.LOCK_EX)
+    _JOURNAL.update([('path', path), ('file', journal_file), ('lock', threading.Lock()), ('written', 0),
+                     ('applied', 0), ('new_records', threading.Event())])
+    _JOURNAL['writer'] = threading.Thread(target=_write_journal, name='tracking-writer', daemon=True)
+    _JOURNAL['writer'].start()
+    atexit.register(_close_journal)
+    return _JOURNAL
+
+
+def _close_journal():
+    """At exit, flush for a while and remove the journal if all of it was applied, or else leave it for a replay."""
+    if flush_tracking(TRACKING_EXIT_TIMEOUT_SECS):
+        _JOURNAL['file'].close()
+        for path in [_JOURNAL['path'], _JOURNAL['path'] + '.offset']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _append(record: OrderedDict):
+    """Append a record to the journal and wake the writer. This is all the logging thread waits for."""
+    journal = _journal()
+    line = (json.dumps(record) + '\n').encode()
+    with journal['lock']:
+        journal['file'].write(line)
+        journal['file'].flush()
+        journal['written'] += line.__len__()
+    journal['new_records'].set()
+
+
+def _json_value(value):
+    """Numpy scalars as Python numbers and other values as they are, for the JSON journal."""
+    return value.item() if isinstance(value, numpy.generic) else value
+
+
+def _artifact_path(file_name: str) -> str:
+    return f'{TRACKING_FOLDER}/artifacts/{uuid.uuid4().hex[:12]}-{file_name}'
+
+
+def start_model_version() -> str:
+    """Key of a new model version, known immediately: the version is created in the backend by the writer."""
+    return f'{NEPTUNE_MODEL_ID}-{uuid.uuid4().hex[:12]}'
+
+
+def log_values(version_key: str, values: dict):
+    """Queue field values of a model version. Lists and dicts are stored as strings in neptune."""
+    for field, value in values.items():
+        _append(OrderedDict([('key', version_key), ('op', 'assign'), ('field', field),
+                             ('value', _json_value(value))]))
+
+
+def log_file(version_key: str, field: str, path: str):
+    """Queue a file upload to a model version field. The file is copied, so it can be removed once this returns."""
+    artifact_path = _artifact_path(os.path.basename(path))
+    shutil.copyfile(path, artifact_path)
+    _append(OrderedDict([('key', version_key), ('op', 'upload'), ('field', field), ('path', artifact_path)]))
+
+
+def log_table(version_key: str, field: str, df: pandas.DataFrame):
+    """Queue a data frame upload to a model version field, as an HTML table."""
+    artifact_path = _artifact_path(f'{field.replace("/", "_")}.html')
+    df.to_html(artifact_path)
+    _append(OrderedDict([('key', version_key), ('op', 'upload'), ('field', field), ('path', artifact_path)]))
+
+
+def close_model_version(version_key: str):
+    """Queue the end of logging to a model version, which releases it in the backend."""
+    _append(OrderedDict([('key', version_key), ('op', 'close')]))
+
+
+def flush_tracking(timeout: float = None) -> bool:
+    """Wait until the records logged so far are applied to the backend, or until the timeout. Returns whether they
+    were. Records that are not applied stay in the journal."""
+    if 'file' not in _JOURNAL:
+        return True
+    deadline = None if timeout is None else time.monotonic() + timeout
+    _JOURNAL['new_records'].set()
+    while _JOURNAL['applied'] < _JOURNAL['written']:
+        if deadline is not None and time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def _connect() -> sqlite3.Connection:
+    """Open the map of version keys to backend version ids, creating it on first use."""
+    os.makedirs(TRACKING_FOLDER, exist_ok=True)
+    connection = sqlite3.connect(f'{TRACKING_FOLDER}/tracking.sqlite')
+    connection.execute('CREATE TABLE IF NOT EXISTS backend_versions (version_key TEXT PRIMARY KEY, '
+                       'backend_id TEXT NOT NULL)')
+    return connection
+
+
+def _neptune_version(version_key: str):
+    """Neptune model version of a version key, created on its first record with the key as local_version_id. The
+    neptune id is stored before any other field is logged, so that a replay never creates the version twice."""
+    if version_key in _NEPTUNE_VERSIONS:
+        return _NEPTUNE_VERSIONS[version_key]
+    import neptune
+    with contextlib.closing(_connect()) as connection, connection:
+        backend_id = connection.execute('SELECT backend_id FROM backend_versions WHERE version_key = ?',
+                                        (version_key,)).fetchone()
+    if backend_id is not None:
+        model_version = neptune.init_model_version(with_id=backend_id[0], project=NEPTUNE_PROJECT_NAME)
+    else:
+        model_version = neptune.init_model_version(model=neptune_model_id(), project=NEPTUNE_PROJECT_NAME)
+        model_version['local_version_id'] = version_key
+        model_version.wait()
+        with contextlib.closing(_connect()) as connection, connection:
+            connection.execute('INSERT INTO backend_versions VALUES (?, ?)',
+                               (version_key, model_version['sys/id'].fetch()))
+    _NEPTUNE_VERSIONS[version_key] = model_version
+    return model_version
+
+
+def _apply_neptune(batch: list[dict]):
+    """Apply a batch of records to neptune model versions, waiting until neptune has sent them."""
+    from neptune.utils import stringify_unsupported
+    touched, closed = OrderedDict(), []
+    for record in batch:
+        model_version = touched[record['key']] = _neptune_version(record['key'])
+        if record['op'] == 'assign':
+            model_version[record['field']] = stringify_unsupported(record['value']) \
+                if isinstance(record['value'], (list, dict)) else record['value']
+        elif record['op'] == 'upload':
+            model_version[record['field']].upload(record['path'])
+        elif record['op'] == 'close':
+            closed.append(record['key'])
+    for model_version in touched.values():
+        model_version.wait()
+    for version_key in closed:
+        _NEPTUNE_VERSIONS.pop(version_key).stop()
+
+
+def local_version_fields(version_key: str) -> OrderedDict:
+    """Fields of a model version logged to the local backend, with uploads as paths of the stored files."""
+    fields_path = f'{TRACKING_FOLDER}/local/{version_key}/fields.json'
+    if not os.path.exists(fields_path):
+        return OrderedDict()
+    with open(fields_path) as fields_file:
+        return json.load(fields_file, object_pairs_hook=OrderedDict)
+
+
+def _apply_local(batch: list[dict]):
+    """Apply a batch of records to a local stand-in for the backend, for offline runs: a folder per model version,
+    with its fields in fields.json and its uploads under files."""
+    fields = OrderedDict()
+    for record in batch:
+        version_folder = f'{TRACKING_FOLDER}/local/{record["key"]}'
+        if record['key'] not in fields:
+            os.makedirs(f'{version_folder}/files', exist_ok=True)
+            fields[record['key']] = local_version_fields(record['key'])
+        if record['op'] == 'assign':
+            fields[record['key']][record['field']] = record['value']
+        elif record['op'] == 'upload':
+            stored_path = f'{version_folder}/files/{record["field"].replace("/", "_")}' \
+                          f'{os.path.splitext(record["path"])[1]}'
+            shutil.copyfile(record['path'], stored_path)
+            fields[record['key']][record['field']] = stored_path
+    for version_key, version_fields in fields.items():
+        with open(f'{TRACKING_FOLDER}/local/{version_key}/fields.json', 'w') as fields_file:
+            json.dump(version_fields, fields_file, indent=2)
+
+
+BACKENDS = OrderedDict([('neptune', _apply_neptune), ('local', _apply_local)])
+
+
+def _read_offset(journal_path: str) -> int:
+    offset_path = journal_path + '.offset'
+    if not os.path.exists(offset_path):
+        return 0
+    with open(offset_path) as offset_file:
+        return int(offset_file.read())
+
+
+def _write_offset(journal_path: str, offset: int):
+    with open(journal_path + '.offset.tmp', 'w') as offset_file:
+        offset_file.write(str(offset))
+    os.replace(journal_path + '.offset.tmp', journal_path + '.offset')
+
+
+def _apply_journal(journal_path: str, backend: str = TRACKING_BACKEND) -> int:
+    """Apply the complete records of a journal after its applied offset, in batches, to the backend. The offset is
+    stored after each batch and artifacts of applied uploads are removed. Returns the new offset."""
+    offset = _read_offset(journal_path)
+    with open(journal_path, 'rb') as journal_file:
+        journal_file.seek(offset)
+        lines = journal_file.read().split(b'\n')[:-1]
+    for batch_start in range(0, lines.__len__(), TRACKING_BATCH_SIZE):
+        batch_lines = lines[batch_start:batch_start + TRACKING_BATCH_SIZE]
+        batch = [json.loads(line) for line in batch_lines]
+        BACKENDS[backend](batch)
+        offset += sum(line.__len__() + 1 for line in batch_lines)
+        _write_offset(journal_path, offset)
+        for record in batch:
+            if record['op'] == 'upload' and os.path.exists(record['path']):
+                os.remove(record['path'])
+    return offset
+
+
+def replay_journals(backend: str = TRACKING_BACKEND) -> int:
+    """Apply and remove the journals of processes that ended before their records reached the backend. Journals of
+    running processes are locked and skipped. Returns the number of journals replayed."""
+    replayed = 0
+    for journal_path in sorted(glob.glob(f'{TRACKING_FOLDER}/journal-*.jsonl')):
+        if journal_path == _JOURNAL.get('path'):
+            continue
+        with open(journal_path, 'ab') as journal_file:
+            try:
+                fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            _apply_journal(journal_path, backend)
+            os.remove(journal_path)
+            if os.path.exists(journal_path + '.offset'):
+                os.remove(journal_path + '.offset')
+            replayed += 1
+    return replayed
+
+
+def _write_journal():
+    """Writer thread: replay journals left by earlier processes, then apply new records of this process's journal as
+    they come, in batches. While the backend fails, records stay in the journal and are retried with backoff."""
+    retry_secs = TRACKING_RETRY_SECS[0]
+    replayed = False
+    while True:
+        _JOURNAL['new_records'].wait(TRACKING_FLUSH_SECS)
+        _JOURNAL['new_records'].clear()
+        try:
+            if not replayed:
+                replay_journals()
+                replayed = True
+            if _JOURNAL['applied'] < _JOURNAL['written']:
+                _JOURNAL['applied'] = _apply_journal(_JOURNAL['path'])
+            retry_secs = TRACKING_RETRY_SECS[0]
+        except Exception as error:
+            LOGGER.warning(f'Tracking backend unavailable, records kept in {_JOURNAL["path"]}: {error!r}')
+            time.sleep(retry_secs)
+            retry_secs = min(retry_secs * 2, TRACKING_RETRY_SECS[1])
+
+
+def _test_tracking() -> OrderedDict:
+    """Log a model version through the journal and return its fields, as stored by the local backend when
+    TRACKING_BACKEND is local."""
+    version_key = start_model_version()
+    log_values(version_key, OrderedDict([('predictors', ['due_per_month']), ('monthly_mape_test', numpy.float64(0.1))]))
+    log_table(version_key, 'feature_importance', pandas.DataFrame({'variable': ['due_per_month'], 'scaled': [1.0]}))
+    close_model_version(version_key)
+    assert flush_tracking(10), 'Records were not applied to the backend'
+    return local_version_fields(version_key)
+
+
+if __name__ == '__main__':
+    print(f'Replayed {replay_journals()} journals')
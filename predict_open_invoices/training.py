@@ -1,40 +1,53 @@
 from collections import OrderedDict
 import pandas
-import random
 import numpy
 import h2o
 from h2o.automl import H2OAutoML
-from predict_open_invoices import ID_COLUMNS
-from predict_open_invoices.utils import months_between, apply_filters
+from predict_open_invoices.utils import apply_filters, get_h2o_frame
+from predict_open_invoices.compact_dtypes import memory_report
+from predict_open_invoices.stage_cache import cached_stage, stage_cache_stats
+from predict_open_invoices.profiling import profiled_stage, enable_profiling, reset_profile, profile_report, \
+    join_filter_stats, save_profile_report
+from predict_open_invoices.dates import month_index, months_between
 from predict_open_invoices.csv_test_data_io import get_csv_test_data
 from predict_open_invoices.pre_processing import preprocess_invoices_with_payments
 from predict_open_invoices.feature_engineering import feature_engineering
 
 
-def __select_forecast_date(invoice_id, invoice_date, max_forecast_date, forecast_frequency: str = 'M',
-                           first_transaction_date: pandas.Timestamp = None) -> pandas.Timestamp:
-    """Given a set of invoice data with end dates, which can vary per row, and an overall start date, sample a date
-    period with the range during which the invoice was OPEN."""
-    if pandas.isnull(max_forecast_date):
-        return None
-    # begin forecast window when the invoice is active and the payments data is complete
-    period_start = max(invoice_date, first_transaction_date) if first_transaction_date else invoice_date
-    period_range = pandas.period_range(period_start, max_forecast_date, freq=forecast_frequency)
-    if len(period_range) == 0:
-        return None
-    # ensure consistent forecast month per invoice across payments
-    pseudorandom = random.Random(invoice_id)
-    return pseudorandom.choice(period_range).to_timestamp()
+def _counter_hash(keys: numpy.ndarray, counter: numpy.ndarray) -> numpy.ndarray:
+    """Counter-based pseudorandom hash (splitmix64 finalizer): the same key and counter always give the same uint64."""
+    with numpy.errstate(over='ignore'):
+        z = keys[:, None] + (counter[None, :].astype(numpy.uint64) + numpy.uint64(1)) \
+            * numpy.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+    return z ^ (z >> numpy.uint64(31))
 
 
-_select_forecast_date = numpy.vectorize(__select_forecast_date)
+def _select_forecast_date(invoice_id: pandas.Series, invoice_date: pandas.Series, max_forecast_date: pandas.Series,
+                          n_samples: int = 1) -> numpy.ndarray:
+    """Given one row per invoice with end dates, which can vary per row, sample month start dates within the range
+    during which the invoice was OPEN. Returns NaT where the range is empty, and one column per sample if n_samples > 1.
+    The same invoice always gets the same months, independent of the other invoices in the data."""
+    start_month = month_index(invoice_date)
+    months_in_range = months_between(start_month, max_forecast_date).to_numpy(dtype=numpy.float64) + 1
+    start_month = start_month.to_numpy(dtype=numpy.int64, na_value=0)
+    valid = months_in_range > 0
+    keys = pandas.util.hash_array(invoice_id.astype(str).values)
+    # top 53 bits of the hash as a uniform draw in [0, 1)
+    uniform = (_counter_hash(keys, numpy.arange(n_samples)) >> numpy.uint64(11)) * 2.0 ** -53
+    months = start_month[:, None] + (uniform * numpy.where(valid, months_in_range, 1)[:, None]).astype(numpy.int64)
+    forecast_dates = numpy.where(valid[:, None], months, 0).astype('datetime64[M]').astype('datetime64[ns]')
+    forecast_dates[~valid] = numpy.datetime64('NaT')
+    return forecast_dates[:, 0] if n_samples == 1 else forecast_dates
 
 
 def _normalize_by_company(invoice_point_in_time: pandas.DataFrame) -> pandas.DataFrame:
     """Add row weights to invoices for training."""
     invoice_point_in_time['converted_amount_inv'] = (
             invoice_point_in_time.amount_inv * invoice_point_in_time.root_exchange_rate_value_inv)
-    totals_by_company = invoice_point_in_time.groupby("company_id", as_index=False).converted_amount_inv.sum()
+    totals_by_company = invoice_point_in_time.groupby("company_id", as_index=False, observed=True)\
+        .converted_amount_inv.sum()
     data = invoice_point_in_time.merge(totals_by_company, on="company_id", suffixes=('', '_company'))
     inv_pct_of_company_total = data.converted_amount_inv / data.converted_amount_inv_company
     data['inv_pct_of_company_total'] = inv_pct_of_company_total
@@ -44,55 +57,86 @@ def _normalize_by_company(invoice_point_in_time: pandas.DataFrame) -> pandas.Dat
     return data
 
 
-def _assign_open_forecast_date(invoices_with_payments: pandas.DataFrame) -> pandas.DataFrame:
+def _forecast_date_ranges(invoices_with_payments: pandas.DataFrame) -> pandas.DataFrame:
+    """Earliest and latest sampled forecast dates for collected and uncollected invoices."""
+    return invoices_with_payments[['forecast_date_collected', 'forecast_date_uncollected']].agg(['min', 'max'])
+
+
+def _check_forecast_date_ranges(date_ranges: pandas.DataFrame):
+    # should be the same date ranges for both options
+    assert (date_ranges.forecast_date_uncollected.values == date_ranges.forecast_date_collected.values).max(), \
+        'Forecast date ranges differ between collected and uncollected invoices'
+
+
+def _assign_open_forecast_date(invoices_with_payments: pandas.DataFrame, check_date_ranges: bool = True) \
+        -> pandas.DataFrame:
     """Add a randomly sampled forecast date while the invoice was open."""
-    invoices_with_payments['forecast_date_collected'] = _select_forecast_date(
-        invoices_with_payments.invoice_id, invoices_with_payments.invoice_date, invoices_with_payments.collected_date)
-    assert invoices_with_payments.groupby("invoice_id").forecast_date_collected.nunique().max() == 1, \
-        'Multiple forecast dates per collected invoice'
+    invoices = invoices_with_payments[['invoice_id', 'invoice_date', 'collected_date', 'final_date_open']]\
+        .drop_duplicates()
+    assert invoices.invoice_id.value_counts().max() == 1, 'Multiple collected or final open dates per invoice'
+    forecast_dates = pandas.DataFrame({'invoice_id': invoices.invoice_id})
+    forecast_dates['forecast_date_collected'] = _select_forecast_date(
+        invoices.invoice_id, invoices.invoice_date, invoices.collected_date)
     # Open invoices can be used in training.
-    invoices_with_payments['forecast_date_uncollected'] = _select_forecast_date(
-        invoices_with_payments.invoice_id, invoices_with_payments.invoice_date, invoices_with_payments.final_date_open)
-    assert invoices_with_payments.groupby("invoice_id").forecast_date_uncollected.nunique().max() == 1, \
-        'Multiple forecast dates per uncollected invoice'
-    # should be the same date ranges for both options
-    assert (invoices_with_payments.forecast_date_uncollected.agg(['min', 'max']).values ==
-            invoices_with_payments.forecast_date_collected.agg(['min', 'max']).values).max()
+    forecast_dates['forecast_date_uncollected'] = _select_forecast_date(
+        invoices.invoice_id, invoices.invoice_date, invoices.final_date_open)
+    invoices_with_payments = invoices_with_payments.merge(forecast_dates, on="invoice_id", how="left")
+    if check_date_ranges:
+        _check_forecast_date_ranges(_forecast_date_ranges(invoices_with_payments))
     invoices_with_payments['forecast_date'] = invoices_with_payments.forecast_date_collected.fillna(
             invoices_with_payments.forecast_date_uncollected)
     return invoices_with_payments
 
 
-def _post_process_invoice_outcomes(invoices_with_payments: pandas.DataFrame) -> (pandas.DataFrame, pandas.DataFrame):
-    """ Process, validate, filter, and assign collection date to invoices with payments.
-     Sample forecast dates between invoice date and collection date (if present) per invoice for training."""
+@profiled_stage
+def _add_invoice_outcomes(invoices_with_payments: pandas.DataFrame, check_date_ranges: bool = True) \
+        -> pandas.DataFrame:
+    """ Assign collection date to invoices with payments and sample forecast dates between invoice date and collection
+    date (if present) per invoice."""
     # invoice is collected if/when payments accumulate to the invoice amount in the original currency.
     invoices_with_payments = invoices_with_payments.merge(
         invoices_with_payments.loc[invoices_with_payments.amount_pmt_pct_cum == 1, ['invoice_id', 'transaction_date']]
         .rename(columns={"transaction_date": "collected_date"}), on="invoice_id", how="left")
-    assert invoices_with_payments.groupby("invoice_id").collected_date.nunique().max() == 1, \
+    assert invoices_with_payments.groupby("invoice_id", observed=True).collected_date.nunique().max() == 1, \
         'Multiple collected dates per invoice'
-    invoices_with_payments = _assign_open_forecast_date(invoices_with_payments)
+    return _assign_open_forecast_date(invoices_with_payments, check_date_ranges)
+
+
+@profiled_stage
+def _filter_invoice_outcomes(invoices_with_payments: pandas.DataFrame, collected_date_range: tuple = None) -> \
+        (pandas.DataFrame, pandas.DataFrame):
+    """ Summarize invoices with outcomes to their final state and filter them for training. When only part of the data
+    is filtered, the range of collected dates over all the data must be given."""
     # data is sorted by invoice and transaction date.
     invoices = invoices_with_payments.drop_duplicates(subset=['invoice_id', 'forecast_date'], keep='last').copy()
     assert invoices.invoice_id.value_counts().max() == 1, 'Multiple forecast dates per invoice'
     invoices['final_remaining_inv_pct'] = 1 - invoices.amount_pmt_pct_cum.fillna(0)
+    if collected_date_range is None:
+        collected_date_range = (invoices.collected_date.min(), invoices.collected_date.max())
     filters = OrderedDict()
-    filters['Collected < opened'] = invoices.query("collected_date<invoice_date")
-    filters['Collected, not cleared'] = invoices[(invoices.collected_date.isnull() is False)
-                                                 & (invoices.status != 'CLEARED')]
-    filters['Cleared < collected'] = invoices.query("cleared_date<collected_date")
+    filters['Collected < opened'] = lambda invoices: invoices.collected_date < invoices.invoice_date
+    filters['Collected, not cleared'] = \
+        lambda invoices: (invoices.collected_date.isnull() is False) & (invoices.status != 'CLEARED')
+    filters['Cleared < collected'] = lambda invoices: invoices.cleared_date < invoices.collected_date
     filters['Opened outside of collections date range: could be missing payments'] = \
-        invoices[((invoices.invoice_date < invoices.collected_date.min()) |
-                  (invoices.invoice_date > invoices.collected_date.max()))]
-    filters['NZD currency: not enough rows'] = invoices.query("currency=='NZD'")
+        lambda invoices: (invoices.invoice_date < collected_date_range[0]) \
+        | (invoices.invoice_date > collected_date_range[1])
+    filters['NZD currency: not enough rows'] = lambda invoices: invoices.currency == 'NZD'
     data, filter_stats = apply_filters(filters, invoices)
     return data, filter_stats
 
 
-def _get_h2o_training_data(feature_data: pandas.DataFrame) -> OrderedDict[str: h2o.H2OFrame]:
-    """Given a set of featurized invoices, return h2o data frames split sequentially into training, testing, and
-    validation based on forecast date, weighted by the invoice amount's percentage of the client company's total."""
+@profiled_stage
+def _post_process_invoice_outcomes(invoices_with_payments: pandas.DataFrame) -> (pandas.DataFrame, pandas.DataFrame):
+    """ Process, validate, filter, and assign collection date to invoices with payments.
+     Sample forecast dates between invoice date and collection date (if present) per invoice for training."""
+    return _filter_invoice_outcomes(_add_invoice_outcomes(invoices_with_payments))
+
+
+@profiled_stage
+def _get_training_data(feature_data: pandas.DataFrame) -> pandas.DataFrame:
+    """Given a set of featurized invoices, add outcome variables, forecast date folds and row weights based on the
+    invoice amount's percentage of the client company's total."""
     normalized_feature_data = _normalize_by_company(feature_data)
     normalized_feature_data['inv_company_weight'] = normalized_feature_data.inv_pct_of_company_total \
         * normalized_feature_data.invoice_id.nunique() / normalized_feature_data.company_id.nunique()
@@ -105,10 +149,14 @@ def _get_h2o_training_data(feature_data: pandas.DataFrame) -> OrderedDict[str: h
         / normalized_feature_data.month_collected
     assert (normalized_feature_data.collected_per_month.isnull()).sum() == 0, 'Collection rate not populated'
     normalized_feature_data['forecast_date_fold'] = (normalized_feature_data.forecast_date.rank(pct=True) * 6).round()
-    id_columns_h2o = [col for col in ID_COLUMNS if col in feature_data.columns]
-    h2o.init(nthreads=-1, max_mem_size=12)
-    invoices_to_model_h2o = h2o.H2OFrame(normalized_feature_data.select_dtypes(exclude='datetime'),
-                                         column_types=dict(zip(id_columns_h2o, ["string"] * len(id_columns_h2o))))
+    return normalized_feature_data
+
+
+@profiled_stage
+def _split_h2o_training_data(training_data: pandas.DataFrame) -> OrderedDict[str: h2o.H2OFrame]:
+    """Upload training data to h2o and split it sequentially into training, testing, and validation frames based on
+    forecast date fold."""
+    invoices_to_model_h2o = get_h2o_frame(training_data)
     h2o_frames = OrderedDict()
     # time-based split: cross-validating on future data relative to what is being trained
     h2o_frames['train'] = invoices_to_model_h2o[invoices_to_model_h2o['forecast_date_fold'] <= 3]
@@ -118,36 +166,83 @@ def _get_h2o_training_data(feature_data: pandas.DataFrame) -> OrderedDict[str: h
     return h2o_frames
 
 
-def get_training_data_from_csvs() -> (OrderedDict[str: h2o.H2OFrame], pandas.DataFrame):
+def _get_h2o_training_data(feature_data: pandas.DataFrame) -> OrderedDict[str: h2o.H2OFrame]:
+    """Given a set of featurized invoices, return h2o data frames split sequentially into training, testing, and
+    validation based on forecast date, weighted by the invoice amount's percentage of the client company's total."""
+    return _split_h2o_training_data(_get_training_data(feature_data))
+
+
+@profiled_stage
+def get_training_frame_from_csvs(compact: bool = False, use_stage_cache: bool = True) -> \
+        (pandas.DataFrame, pandas.DataFrame):
     """Pre-filter raw CSV test data, preprocess, create outcome variables, sample forecast dates,
-    featurize inputs, and return train/test/validation data with a report summarizing all the data filters."""
-    invoices, payments = get_csv_test_data()
+    featurize inputs, and return the training data before it is split, with a report summarizing all the data filters.
+    With compact dtypes, string IDs are only restored when the data is uploaded to H2O. With the stage cache, stages
+    are only recomputed when their inputs or the pipeline code change."""
+    stage = cached_stage if use_stage_cache else (lambda stage_function: stage_function)
+    invoices, payments = get_csv_test_data(compact=compact)
     payments_training_filters = OrderedDict()
     # last month of payments data is incomplete and not from a representative period in the month
-    payments_training_filters['Incomplete month (2021-05)'] = payments[payments.transaction_date >= '2021-5-1']
+    payments_training_filters['Incomplete month (2021-05)'] = lambda payments: payments.transaction_date >= '2021-5-1'
     payments_to_model, training_payments_filter_stats = apply_filters(payments_training_filters, payments)
     training_payments_filter_stats = pandas.concat([training_payments_filter_stats], names=['Dataset'],
                                                    keys=['payments'])
-    invoices_with_payments, preprocess_filter_stats = preprocess_invoices_with_payments(invoices, payments_to_model)
-    invoices_to_model, post_process_filter_stats = _post_process_invoice_outcomes(invoices_with_payments)
+    invoices_with_payments, preprocess_filter_stats = stage(preprocess_invoices_with_payments)(invoices,
+                                                                                               payments_to_model)
+    invoices_to_model, post_process_filter_stats = stage(_post_process_invoice_outcomes)(invoices_with_payments)
     post_process_filter_stats = pandas.concat([post_process_filter_stats], names=['Dataset'],
                                               keys=['preprocessed invoices'])
     filter_stats = pandas.concat([training_payments_filter_stats, preprocess_filter_stats, post_process_filter_stats],
                                  names=['Step Type'], keys=['Filtering', 'Pre-processing', 'Filtering'])
-    h2o_frames = _get_h2o_training_data(feature_engineering(invoices_to_model))
+    training_data = stage(_get_training_data)(stage(feature_engineering)(invoices_to_model))
+    return training_data, filter_stats
+
+
+@profiled_stage
+def get_training_data_from_csvs(compact: bool = False, use_stage_cache: bool = True) -> \
+        (OrderedDict[str: h2o.H2OFrame], pandas.DataFrame):
+    """Pre-filter raw CSV test data, preprocess, create outcome variables, sample forecast dates,
+    featurize inputs, and return train/test/validation data with a report summarizing all the data filters."""
+    training_data, filter_stats = get_training_frame_from_csvs(compact, use_stage_cache)
+    h2o_frames = _split_h2o_training_data(training_data)
     return h2o_frames, filter_stats
 
 
+def _test_compact_dtypes() -> pandas.DataFrame:
+    """Report memory per pipeline stage on CSV test data with and without compact dtypes."""
+    reports = OrderedDict()
+    for compact in [False, True]:
+        invoices, payments = get_csv_test_data(compact=compact)
+        invoices_with_payments, _ = preprocess_invoices_with_payments(invoices, payments)
+        invoices_to_model, _ = _post_process_invoice_outcomes(invoices_with_payments)
+        feature_data = feature_engineering(invoices_to_model)
+        reports['compact' if compact else 'default'] = memory_report(OrderedDict(
+            [('invoices', invoices), ('payments', payments), ('preprocessed', invoices_with_payments),
+             ('post-processed', invoices_to_model), ('features', feature_data)]))
+    return pandas.concat(reports, axis=1)
+
+
+def _test_profiling_on_csvs(report_path: str = None) -> pandas.DataFrame:
+    """Profile the stages of the training data pipeline on local CSV data, without the stage cache, and join the cost
+    of each filter rule to the filter report. The profile report is saved as JSON if a path is given."""
+    enable_profiling()
+    reset_profile()
+    _, filter_stats = get_training_frame_from_csvs(use_stage_cache=False)
+    if report_path is not None:
+        save_profile_report(report_path)
+    return join_filter_stats(filter_stats, profile_report())
+
+
 def train_model(train: h2o.H2OFrame, test: h2o.H2OFrame, predictors: list[str] = ['due_per_month'],
                 metric: str = 'mae', y: str = 'collected_per_month', distribution: str = 'huber',
                 max_runtime_secs: int = 60, exclude_algos: list[str] = ['StackedEnsemble'], nfolds: int = 0,
-                stopping_tolerance: float = 0.01) -> h2o.estimators.H2OEstimator:
+                stopping_tolerance: float = 0.01, project_name: str = None) -> h2o.estimators.H2OEstimator:
     """Given training and testing h2oframes, list of predictors, outcome variable, outcome distribution,
-    and ML metric, return a trained H2O model."""
+    and ML metric, return a trained H2O model. Runs with the same project name add models to one leaderboard."""
     # some hyperparameter tuning options are addressed by using AutoML and specifying sort and stopping metrics.
     aml = H2OAutoML(max_runtime_secs=max_runtime_secs, distribution=distribution, exclude_algos=exclude_algos,
                     sort_metric=metric, stopping_metric=metric if metric != 'r2' else 'mae',
-                    stopping_tolerance=stopping_tolerance, nfolds=nfolds)
+                    stopping_tolerance=stopping_tolerance, nfolds=nfolds, project_name=project_name)
     aml_model = aml.train(training_frame=train, blending_frame=test, x=predictors, y=y,
                           weights_column='inv_company_weight')
     return aml_model
@@ -168,6 +263,7 @@ if __name__ == "__main__":
     ml_metric = 'mae'
     baseline_model, split_h2o_frames, training_filter_stats = _test_training_on_csvs(ml_metric)
     print(training_filter_stats)
+    print(stage_cache_stats())
     for split in split_h2o_frames.keys():
         h2o_frame = split_h2o_frames[split]
         print(f"Baseline model {ml_metric} on {split} data: {baseline_model.model_performance(h2o_frame)[ml_metric]}")
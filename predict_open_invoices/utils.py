@@ -1,37 +1,70 @@
+import numpy
 import pandas
 from collections import OrderedDict
 import h2o
 from predict_open_invoices import ID_COLUMNS
+from predict_open_invoices.compact_dtypes import restore_ids
+from predict_open_invoices.h2o_frames import upload_frame
+from predict_open_invoices.profiling import profile
 
 
-def months_between(start_date: pandas.Series, end_date: pandas.Series) -> int:
-    """ Calculate number of months between two dates in a pandas Dataframe """
-    months = (end_date.dt.to_period('M') - start_date.dt.to_period('M'))
-    months = months.map(lambda m: m.n if not pandas.isnull(m) else None)
-    return months
+def _exclude_mask(exclude_rows, apply_to_df: pandas.DataFrame) -> numpy.ndarray:
+    """Boolean mask of rows to exclude, from a mask aligned with the data, a sub-DataFrame of excluded rows or a
+    function of the data returning either."""
+    if callable(exclude_rows):
+        exclude_rows = exclude_rows(apply_to_df)
+    if isinstance(exclude_rows, pandas.DataFrame):
+        return apply_to_df.index.isin(exclude_rows.index)
+    exclude_mask = numpy.asarray(exclude_rows, dtype=bool)
+    assert exclude_mask.shape == (apply_to_df.__len__(),), 'Filter mask does not match the filtered data'
+    return exclude_mask
 
 
 def apply_filters(filters: OrderedDict, apply_to_df: pandas.DataFrame) -> (pandas.DataFrame, pandas.DataFrame):
-    """ Perform sequential filter steps on a pandas Dataframe and report impact on the input data """
+    """ Perform sequential filter steps on a pandas Dataframe and report impact on the input data.
+    Each filter step is a boolean mask of rows to exclude (or a sub-DataFrame of excluded rows), or a function of the
+    data returning one, which is evaluated and profiled as part of its step. Step statistics are computed from the
+    stacked masks in one pass and the data is filtered once at the end."""
     filter_stats = pandas.DataFrame(columns=['Bad Data', '% of Unfiltered Data', 'Rows Filter Applied To',
                                              '% Filtered at Step'])
-    filtered_data = apply_to_df.copy()
-    step_num = 0
+    if len(filters) == 0:
+        return apply_to_df.copy(), filter_stats
+    exclude_masks, step_profiles = [], []
     for filter_step, exclude_rows in filters.items():
-        step_num += 1
-        rows_applied_to = filtered_data.__len__()
-        filtered_data = filtered_data.loc[~filtered_data.index.isin(exclude_rows.index)]
+        with profile('apply_filters', bad_data=filter_step) as step_profile:
+            exclude_masks.append(_exclude_mask(exclude_rows, apply_to_df))
+        step_profiles.append(step_profile)
+    exclude_masks = numpy.stack(exclude_masks)
+    excluded_by_step = numpy.logical_or.accumulate(exclude_masks, axis=0)
+    rows_remaining = numpy.concatenate([[apply_to_df.__len__()], apply_to_df.__len__() - excluded_by_step.sum(axis=1)])
+    rows_excluded = exclude_masks.sum(axis=1)
+    for step_num, filter_step in enumerate(filters.keys(), start=1):
+        rows_applied_to = int(rows_remaining[step_num - 1])
         step_stats = [filter_step,
-                      exclude_rows.__len__() / apply_to_df.__len__(),
+                      int(rows_excluded[step_num - 1]) / apply_to_df.__len__(),
                       rows_applied_to,
-                      1 - filtered_data.__len__() / rows_applied_to]
+                      1 - int(rows_remaining[step_num]) / rows_applied_to if rows_applied_to else 0.0]
         filter_stats.loc[step_num] = step_stats
+        step_profiles[step_num - 1].update([('Rows In', rows_applied_to), ('Rows Out', int(rows_remaining[step_num]))])
+    filtered_data = apply_to_df.loc[~excluded_by_step[-1]]
     return filtered_data, filter_stats
 
 
-def get_h2o_frame(df: pandas.DataFrame) -> h2o.H2OFrame:
-    """Convert a pandas dataframe to a properly formatted H2O frame for training and prediction."""
-    h2o.init(nthreads=-1, max_mem_size=12)
+def validate_columns(df: pandas.DataFrame, not_null: OrderedDict, positive: OrderedDict = OrderedDict()):
+    """ Assert that columns have no missing values and that columns are positive, with one pass over each group of
+    columns. Keys are column names and values are the assertion messages."""
+    missing = df.__len__() - df[list(not_null.keys())].count()
+    for column, message in not_null.items():
+        assert missing[column] == 0, message
+    minimums = df[list(positive.keys())].min()
+    for column, message in positive.items():
+        assert minimums[column] > 0, message
+
+
+def get_h2o_frame(df: pandas.DataFrame, destination_frame: str = None, reuse: bool = True) -> h2o.H2OFrame:
+    """Convert a pandas dataframe to a properly formatted H2O frame for training and prediction.
+    Frames are transferred as Parquet, and unless reuse is False, a frame already in the cluster under
+    destination_frame, by default a hash of the content, is reused instead of uploaded again."""
     id_columns_h2o = [col for col in ID_COLUMNS if col in df.columns]
-    return h2o.H2OFrame(df.select_dtypes(exclude='datetime'),
-                        column_types=dict(zip(id_columns_h2o, ["string"] * len(id_columns_h2o))))
+    return upload_frame(restore_ids(df).select_dtypes(exclude='datetime'), destination_frame,
+                        column_types=dict(zip(id_columns_h2o, ["string"] * len(id_columns_h2o))), reuse=reuse)